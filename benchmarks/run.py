@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Benchmarks for the parts of flatpaker that run on the host.
+
+Synthetic Ren'Py and RPGMaker MZ games are generated, and the steps that
+flatpaker runs before handing off to flatpak-builder are timed. flatpak-builder
+itself is replaced by a stub that does nothing.
+
+Results are written to .benchmarks/<commit>.json, and can be compared with
+an earlier run with --compare.
+"""
+
+from __future__ import annotations
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import typing
+import zipfile
+
+ROOT = pathlib.Path(__file__).parent.parent
+sys.path.insert(0, ROOT.as_posix())
+
+from flatpaker import api, archive, icons, util  # noqa: E402
+from flatpaker.description import load_description  # noqa: E402
+import flatpaker.entry  # noqa: E402
+
+if typing.TYPE_CHECKING:
+    from flatpaker.description import Description
+
+    class Arguments(typing.Protocol):
+        size: int
+        files: int
+        repeat: int
+        output: typing.Optional[str]
+        compare: typing.Optional[str]
+        filter: typing.Optional[str]
+
+    Results = typing.Dict[str, typing.Dict[str, float]]
+
+
+_STUB = textwrap.dedent('''\
+    #!/bin/sh
+    exit 0
+    ''')
+
+
+def _payload(i: int, size: int) -> bytes:
+    # Cheap to generate, but not trivially compressible
+    seed = f'{i:08d}'.encode() * 64
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def _write_zip(dest: pathlib.Path, files: typing.Dict[str, int]) -> None:
+    # Store rather than compress, so generating large archives is fast. Game
+    # assets are usually already compressed anyway
+    with zipfile.ZipFile(dest, 'w', zipfile.ZIP_STORED) as z:
+        for i, (name, size) in enumerate(files.items()):
+            z.writestr(name, _payload(i, size))
+
+
+def _renpy(workdir: pathlib.Path, size: int, count: int) -> pathlib.Path:
+    files: typing.Dict[str, int] = {
+        'Bench-1.0-pc/Bench.sh': 1024,
+        'Bench-1.0-pc/Bench.py': 1024,
+        'Bench-1.0-pc/renpy/vc_version.py': 64,
+        'Bench-1.0-pc/lib/py3-linux-x86_64/python': 1024,
+    }
+    each = max(size // count, 1)
+    for i in range(count - len(files)):
+        if i % 10 == 0:
+            files[f'Bench-1.0-pc/game/script{i}.rpy'] = min(each, 64 * 1024)
+        else:
+            files[f'Bench-1.0-pc/game/images/dir{i // 1000}/img{i}.png'] = each
+
+    dest = workdir / 'renpy.zip'
+    _write_zip(dest, files)
+    return _description(workdir, 'renpy', dest)
+
+
+def _rpgmaker(workdir: pathlib.Path, size: int, count: int) -> pathlib.Path:
+    files: typing.Dict[str, int] = {
+        'Bench/nw': 1024 * 1024,
+        'Bench/package.json': 128,
+        'Bench/js/rmmz_core.js': 1024,
+        'Bench/icon/icon.png': 1024,
+        'Bench/locales/en-US.pak': 1024,
+    }
+    each = max(size // count, 1)
+    for i in range(count - len(files)):
+        if i % 20 == 0:
+            files[f'Bench/data/Map{i:03d}.json'] = min(each, 64 * 1024)
+        elif i % 2:
+            files[f'Bench/img/pictures/pic{i}.png'] = each
+        else:
+            files[f'Bench/audio/se/sound{i}.ogg'] = each
+
+    dest = workdir / 'rpgmaker.zip'
+    _write_zip(dest, files)
+    return _description(workdir, 'rpgmaker', dest)
+
+
+def _description(workdir: pathlib.Path, engine: str, source: pathlib.Path) -> pathlib.Path:
+    dest = workdir / f'{engine}.toml'
+    dest.write_text(textwrap.dedent(f'''\
+        [common]
+          name = 'Bench {engine}'
+          reverse_url = 'com.example'
+          engine = '{engine}'
+
+        [appdata]
+          summary = "A benchmark"
+          description = "A generated game for benchmarking"
+
+        [[sources.archives]]
+          path = "{source.name}"
+        '''))
+    return dest
+
+
+@contextlib.contextmanager
+def _cache(path: pathlib.Path) -> typing.Iterator[None]:
+    """Use an empty cache directory for the duration of a benchmark."""
+    old = os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(dir=path)
+    try:
+        yield
+    finally:
+        if old is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = old
+
+
+def _benchmarks(toml: pathlib.Path, workdir: pathlib.Path
+                ) -> typing.Dict[str, typing.Tuple[typing.Callable[[], object], bool]]:
+    """The benchmarks for one game.
+
+    :return: A mapping of names to a callable and whether it needs an
+        empty cache
+    """
+    description = load_description(toml.as_posix())
+    appid = util.get_appid(description)
+    a = description['sources']['archives'][0]
+    impl = flatpaker.entry.select_impl(description['common']['engine'])
+
+    def write_rules(d: Description) -> None:
+        desktop = util.create_desktop(d, workdir, appid)
+        appdata = util.create_appdata(d, workdir, appid)
+        impl(d, workdir, appid, desktop, appdata)
+
+    class Args:
+        repo = (workdir / 'repo').as_posix()
+        gpg = None
+        install = False
+        export = False
+        cleanup = True
+        force = True
+        state_dir = (workdir / '.flatpak-builder').as_posix()
+        state_dir_max_size = None
+        shared_runtime = False
+        optimize_assets = None
+        warm_cache = False
+        batch_export = False
+
+    return {
+        'load_description': (lambda: load_description(toml.as_posix()), False),
+        'extract_sources (cold)': (lambda: util.extract_sources(description), True),
+        'extract_sources (warm)': (lambda: util.extract_sources(description), False),
+        'create_appdata': (lambda: util.create_appdata(description, workdir, appid), False),
+        'create_desktop': (lambda: util.create_desktop(description, workdir, appid), False),
+        'archive.index (cold)': (lambda: archive.index(a['path']), True),
+        'archive.index (warm)': (lambda: archive.index(a['path']), False),
+        'icons.extract (cold)': (lambda: icons.extract(a), True),
+        'write_rules (cold)': (lambda: write_rules(description), True),
+        'write_rules (warm)': (lambda: write_rules(description), False),
+        'api.generate (warm)': (lambda: api.generate(description), False),
+        'build (stub flatpak-builder)': (
+            lambda: flatpaker.entry.build(typing.cast('flatpaker.entry.BaseArguments', Args), description), False),
+    }
+
+
+def run(args: Arguments) -> Results:
+    results: Results = {}
+    with tempfile.TemporaryDirectory() as t:
+        tdir = pathlib.Path(t)
+        bindir = tdir / 'bin'
+        bindir.mkdir()
+        stub = bindir / 'flatpak-builder'
+        stub.write_text(_STUB)
+        stub.chmod(0o755)
+        os.environ['PATH'] = f'{bindir}{os.pathsep}{os.environ["PATH"]}'
+        os.chdir(tdir)
+
+        for engine, generate in [('renpy', _renpy), ('rpgmaker', _rpgmaker)]:
+            gdir = tdir / engine
+            gdir.mkdir()
+            print(f'Generating {engine} game with {args.files} files, {args.size} MiB...', file=sys.stderr)
+            toml = generate(gdir, args.size * 1024 * 1024, args.files)
+
+            with _cache(tdir):
+                for name, (func, cold) in _benchmarks(toml, gdir).items():
+                    name = f'{engine}: {name}'
+                    if args.filter and args.filter not in name:
+                        continue
+                    if not cold:
+                        # Make sure anything this relies on is cached
+                        func()
+                    times: typing.List[float] = []
+                    for _ in range(args.repeat):
+                        with _cache(tdir) if cold else contextlib.nullcontext():
+                            start = time.perf_counter()
+                            func()
+                            times.append(time.perf_counter() - start)
+                    results[name] = {'min': min(times), 'median': statistics.median(times)}
+                    print(f'{name:<50} {results[name]["min"]:10.4f}s', file=sys.stderr)
+
+    return results
+
+
+def compare(old: Results, new: Results) -> None:
+    for name, r in new.items():
+        if name not in old:
+            continue
+        before = old[name]['min']
+        change = (r['min'] - before) / before * 100 if before else 0.0
+        print(f'{name:<50} {before:10.4f}s {r["min"]:10.4f}s {change:+8.1f}%')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default=256, type=int, help='The size of each game in MiB')
+    parser.add_argument('--files', default=2000, type=int, help='The number of files in each game')
+    parser.add_argument('--repeat', default=3, type=int, help='How many times to run each benchmark')
+    parser.add_argument('--filter', action='store', help='Only run benchmarks containing this string')
+    parser.add_argument('--output', action='store', help='Where to write the results, defaults to .benchmarks/<commit>.json')
+    parser.add_argument('--compare', action='store', help='Results from an earlier run to compare with')
+    args = typing.cast('Arguments', parser.parse_args())
+
+    results = run(args)
+
+    output = args.output
+    if output is None:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip() or 'unknown'
+        output = (ROOT / '.benchmarks' / f'{commit}.json').as_posix()
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'size': args.size, 'files': args.files, 'results': results}, f, indent=4)
+    print(f'Results written to {output}', file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f)['results'], results)
+
+
+if __name__ == '__main__':
+    main()
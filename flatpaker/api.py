@@ -0,0 +1,121 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Generate flatpak manifests from descriptions, without building them.
+
+This is the library interface to flatpaker. Everything is generated in memory,
+the desktop file and appstream metadata are embedded in the manifest as inline
+sources, so nothing is written to a temporary directory, and the manifest can
+be passed to flatpak-builder as is once it has been serialized with
+:func:`dump_json`, which always gives the same bytes for the same manifest::
+
+    import flatpaker.api
+
+    for result in flatpaker.api.generate_all(['a.toml', 'b.toml']):
+        with open(f'{result.appid}.json', 'w') as f:
+            f.write(flatpaker.api.dump_json(result.manifest))
+
+Sources given by url are downloaded into the local mirror first, if they
+haven't been already, as their contents are needed to generate the manifest.
+The shared runtime that ``shared_runtime`` refers to is not generated, it must
+be built with the build command.
+"""
+
+from __future__ import annotations
+import collections
+import concurrent.futures
+import itertools
+import os
+import typing
+
+from . import entry, fetch, util
+from .description import load_description
+from .util import dump_json
+
+if typing.TYPE_CHECKING:
+    from .description import Description
+    from .entry import Optimize
+
+__all__ = ['Result', 'dump_json', 'generate', 'generate_all', 'load_description']
+
+
+class Result(typing.NamedTuple):
+
+    """The generated files of a description."""
+
+    appid: str
+    manifest: typing.Dict[str, typing.Any]
+    desktop: str
+    appdata: str
+
+
+def generate(description: Description, *, shared_runtime: bool = False,
+             optimize: typing.Optional[Optimize] = None, warm_cache: bool = False) -> Result:
+    """Generate the manifest of a description.
+
+    The options are the same as the command line options of the same names.
+    If the engine of the description isn't set, it is detected, and filled in.
+
+    :param shared_runtime: If True use the shared runtime of the engine, if
+        one is configured for the version of the engine the game uses
+    :param optimize: If set, how to shrink the game's assets after installing it
+    :param warm_cache: If True generate Ren'Py's startup caches during the build
+    :raises ValueError: If the engine cannot be detected, or a source given by
+        url can't be downloaded, or doesn't match its sha256
+    :raises FileNotFoundError: If a local source doesn't exist
+    """
+    appid = util.get_appid(description)
+    fetch.fetch([description])
+    runtime = entry.shared_runtime(description) if shared_runtime else None
+    manifest, desktop, appdata = entry.generate(
+        description, appid, runtime[1] if runtime is not None else None, optimize, warm_cache)
+    return Result(appid, manifest, desktop, appdata.decode())
+
+
+def _generate(description: typing.Union[Description, str], options: typing.Dict[str, typing.Any]) -> Result:
+    if isinstance(description, str):
+        description = load_description(description)
+    return generate(description, **options)
+
+
+def generate_all(descriptions: typing.Iterable[typing.Union[Description, str]], *,
+                 jobs: typing.Optional[int] = None, shared_runtime: bool = False,
+                 optimize: typing.Optional[Optimize] = None,
+                 warm_cache: bool = False) -> typing.Iterator[Result]:
+    """Generate the manifests of many descriptions.
+
+    Most of the time spent generating a manifest is hashing and reading the
+    archives, so descriptions are generated by a pool of threads. Only a few
+    more than ``jobs`` descriptions are loaded at a time, so this can be used
+    on an arbitrarily large number of them.
+
+    :param descriptions: Descriptions, or paths to descriptions to load
+    :param jobs: How many descriptions to generate at once, defaults to the
+        number of cpus
+    :return: A generator of results, in the same order as the descriptions
+    :raises ValueError: If a description is invalid, its engine cannot be
+        detected, or its sources can't be downloaded, when that description's
+        result is reached
+    :raises FileNotFoundError: If a local source doesn't exist, when that
+        description's result is reached
+    """
+    options: typing.Dict[str, typing.Any] = {
+        'shared_runtime': shared_runtime,
+        'optimize': optimize,
+        'warm_cache': warm_cache,
+    }
+    jobs = jobs or os.cpu_count() or 1
+    it = iter(descriptions)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        window = jobs * 2
+        pending: typing.Deque[concurrent.futures.Future[Result]] = collections.deque(
+            executor.submit(_generate, d, options) for d in itertools.islice(it, window))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for d in itertools.islice(it, 1):
+                    pending.append(executor.submit(_generate, d, options))
+                yield result
+        finally:
+            for f in pending:
+                f.cancel()
@@ -0,0 +1,306 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Inspect source archives without extracting them."""
+
+from __future__ import annotations
+import fnmatch
+import json
+import os
+import pathlib
+import re
+import tarfile
+import tempfile
+import typing
+import zipfile
+
+from flatpaker import util
+
+if typing.TYPE_CHECKING:
+    from flatpaker.description import Archive
+
+    class Index(typing.TypedDict):
+
+        format: typing.Literal['zip', 'tar']
+        files: int
+        size: int
+        members: typing.Dict[str, int]
+        strip_components: int
+        engine: typing.Optional[typing.Literal['renpy', 'rpgmaker']]
+        engine_version: typing.Optional[str]
+
+
+# Bump this when the contents of the index change, to invalidate the cache
+_INDEX_VERSION = 3
+
+# Files that identify the engine version, and how much of them to read.
+_VERSION_FILES = {
+    'renpy/vc_version.py': 4096,
+    'renpy/__init__.py': 16384,
+    'www/js/rpg_core.js': 1024,
+    'js/rmmz_core.js': 1024,
+}
+
+_RENPY_VERSION = re.compile(r'''^version\s*=\s*['"]([0-9.]+)['"]''', re.MULTILINE)
+_RENPY_VERSION_TUPLE = re.compile(r'^\s*version_tuple\s*=\s*\w*\((\d+),\s*(\d+),\s*(\d+)', re.MULTILINE)
+_RPGMAKER_VERSION = re.compile(r'(?:rpg|rmmz)_core\.js v([0-9.]+)')
+
+
+def _version_file(name: str) -> typing.Optional[int]:
+    """How many bytes of a member to read for engine detection, if any."""
+    for suffix, size in _VERSION_FILES.items():
+        if name == suffix or name.endswith(f'/{suffix}'):
+            return size
+    return None
+
+
+def _scan_zip(path: pathlib.Path) -> typing.Tuple[typing.Dict[str, int], typing.Dict[str, str]]:
+    # Only reads the central directory at the end of the file, and then the
+    # start of the few files needed to find the engine version
+    members: typing.Dict[str, int] = {}
+    heads: typing.Dict[str, str] = {}
+    with zipfile.ZipFile(path) as z:
+        for i in z.infolist():
+            if i.is_dir():
+                continue
+            members[i.filename] = i.file_size
+            size = _version_file(i.filename)
+            if size is not None:
+                with z.open(i) as f:
+                    heads[i.filename] = f.read(size).decode('utf-8', 'replace')
+    return members, heads
+
+
+def _scan_tar(path: pathlib.Path) -> typing.Tuple[typing.Dict[str, int], typing.Dict[str, str]]:
+    # Use stream mode, so compressed tarballs are only decompressed once, and
+    # never seeked in
+    members: typing.Dict[str, int] = {}
+    heads: typing.Dict[str, str] = {}
+    with tarfile.open(path, 'r|*') as t:
+        for m in t:
+            if m.isdir():
+                continue
+            members[m.name] = m.size
+            size = _version_file(m.name)
+            if size is not None and m.isfile():
+                f = t.extractfile(m)
+                assert f is not None, 'regular files can always be read'
+                heads[m.name] = f.read(size).decode('utf-8', 'replace')
+    return members, heads
+
+
+def _head(heads: typing.Dict[str, str], suffix: str) -> str:
+    """The start of the least nested member that matched a version file."""
+    found = [name for name in heads if name == suffix or name.endswith(f'/{suffix}')]
+    return heads[min(found, key=lambda n: n.count('/'))] if found else ''
+
+
+def _detect(top: typing.Set[str], heads: typing.Dict[str, str]
+            ) -> typing.Tuple[typing.Optional[typing.Literal['renpy', 'rpgmaker']], typing.Optional[str]]:
+    """Find the engine and its version from the top level layout of an archive.
+
+    :param top: The top level files and directories, after removing the
+        leading directories shared by all members
+    :param heads: The start of the files used to identify the version, by
+        member name
+    """
+    if 'renpy' in top and 'game' in top and fnmatch.filter(top, '*.sh'):
+        version: typing.Optional[str] = None
+        if m := _RENPY_VERSION.search(_head(heads, 'renpy/vc_version.py')):
+            version = m.group(1)
+        elif m := _RENPY_VERSION_TUPLE.search(_head(heads, 'renpy/__init__.py')):
+            version = '.'.join(m.groups())
+        return 'renpy', version
+
+    if 'nw' in top and ('package.json' in top or 'package.nw' in top):
+        # MZ games may be laid out like MV games, with their files under www
+        for f in ['www/js/rpg_core.js', 'js/rmmz_core.js']:
+            if m := _RPGMAKER_VERSION.search(_head(heads, f)):
+                return 'rpgmaker', m.group(1)
+        return 'rpgmaker', None
+
+    return None, None
+
+
+def _common_dirs(members: typing.Iterable[str]) -> int:
+    """Count the directories that every member is nested in."""
+    common: typing.Optional[typing.List[str]] = None
+    for m in members:
+        parts = m.strip('/').split('/')[:-1]
+        if common is None:
+            common = parts
+            continue
+        i = 0
+        while i < min(len(common), len(parts)) and common[i] == parts[i]:
+            i += 1
+        del common[i:]
+        if not common:
+            break
+    return len(common or [])
+
+
+def _scan(path: pathlib.Path) -> typing.Optional[Index]:
+    fmt: typing.Literal['zip', 'tar']
+    if zipfile.is_zipfile(path):
+        fmt, (members, heads) = 'zip', _scan_zip(path)
+    elif tarfile.is_tarfile(path):
+        fmt, (members, heads) = 'tar', _scan_tar(path)
+    else:
+        return None
+
+    strip = _common_dirs(members)
+    engine, version = _detect({m.split('/', 1)[0] for m in _strip(members, strip)}, heads)
+
+    return {
+        'format': fmt,
+        'files': len(members),
+        'size': sum(members.values()),
+        'members': members,
+        'strip_components': strip,
+        'engine': engine,
+        'engine_version': version,
+    }
+
+
+def index(path: pathlib.Path) -> typing.Optional[Index]:
+    """Get the index of an archive.
+
+    Indexes are cached by the sha256 of the archive.
+
+    :return: The index, or None if this is not an archive format that can be read.
+    """
+    cache = util.cache_dir() / 'index' / f'{util.sha256(path)}-{_INDEX_VERSION}.json'
+    if cache.exists():
+        with cache.open('r') as f:
+            return typing.cast('Index', json.load(f))
+
+    idx = _scan(path)
+    if idx is not None:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=cache.parent, delete=False) as f:
+            json.dump(idx, f)
+        os.replace(f.name, cache)
+    return idx
+
+
+def _strip(names: typing.Iterable[str], strip_components: int) -> typing.Iterator[str]:
+    for m in names:
+        parts = m.strip('/').split('/')
+        if len(parts) > strip_components:
+            yield '/'.join(parts[strip_components:])
+
+
+def read_member(path: pathlib.Path, name: str) -> bytes:
+    """Read a single member of an archive, without extracting anything else.
+
+    :raises KeyError: If the member doesn't exist
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z:
+            return z.read(name)
+    with tarfile.open(path, 'r|*') as t:
+        for m in t:
+            if m.name == name and m.isfile():
+                f = t.extractfile(m)
+                assert f is not None, 'regular files can always be read'
+                return f.read()
+    raise KeyError(name)
+
+
+def read_members(path: pathlib.Path, names: typing.Iterable[str]) -> typing.Iterator[typing.Tuple[str, bytes]]:
+    """Read several members of an archive, without extracting anything else.
+
+    Tarballs are only read through once, however many members are wanted.
+    Members that don't exist are skipped.
+
+    :return: An iterator of the name and contents of each member found
+    """
+    wanted = set(names)
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z:
+            for name in sorted(wanted & set(z.namelist())):
+                yield name, z.read(name)
+        return
+    with tarfile.open(path, 'r|*') as t:
+        for m in t:
+            if m.name in wanted and m.isfile():
+                f = t.extractfile(m)
+                assert f is not None, 'regular files can always be read'
+                yield m.name, f.read()
+
+
+def members(idx: Index, strip_components: int) -> typing.Iterator[str]:
+    """The members of an archive, with strip_components leading directories removed."""
+    return _strip(idx['members'], strip_components)
+
+
+def member_names(idx: Index, strip_components: int) -> typing.Dict[str, str]:
+    """Map the members, with strip_components leading directories removed, to their original names."""
+    return {s: name for name in idx['members'] for s in _strip([name], strip_components)}
+
+
+def member_sizes(idx: Index, strip_components: int) -> typing.Dict[str, int]:
+    """The size of each member, with strip_components leading directories removed."""
+    return {s: size for name, size in idx['members'].items() for s in _strip([name], strip_components)}
+
+
+def find_members(idx: Index, strip_components: int, pattern: str) -> typing.List[str]:
+    """Find members that match a pattern once strip_components have been removed.
+
+    The pattern is matched with fnmatch, but wildcards do not match across
+    directories.
+
+    :return: The sorted original names of the matching members
+    """
+    found: typing.List[str] = []
+    for name in idx['members']:
+        stripped = next(_strip([name], strip_components), None)
+        if (stripped is not None and stripped.count('/') == pattern.count('/')
+                and fnmatch.fnmatchcase(stripped, pattern)):
+            found.append(name)
+    return sorted(found)
+
+
+def toplevel(idx: Index, strip_components: int) -> typing.Set[str]:
+    """The files and directories that will be extracted to the top level."""
+    return {m.split('/', 1)[0] for m in members(idx, strip_components)}
+
+
+def check_layout(a: Archive, required: typing.Iterable[str]) -> typing.Optional[Index]:
+    """Check that an archive source contains the required top level files.
+
+    :param a: The archive source to check
+    :param required: fnmatch style patterns that must match a top level entry
+    :raises ValueError: If any of the required entries are missing
+    :return: The index, or None if the archive can't be inspected
+    """
+    idx = index(a['path'])
+    if idx is None:
+        return None
+
+    strip = a.get('strip_components', 1)
+    top = toplevel(idx, strip)
+    missing = [r for r in required if not fnmatch.filter(top, r)]
+    if missing:
+        msg = f"{a['path']} is missing {', '.join(missing)} with strip_components = {strip}"
+        if idx['strip_components'] != strip:
+            msg += f" (strip_components = {idx['strip_components']} would remove all common directories)"
+        raise ValueError(msg)
+
+    return idx
+
+
+def detect_engine(path: pathlib.Path) -> typing.Tuple[typing.Optional[typing.Literal['renpy', 'rpgmaker']], typing.Optional[str]]:
+    """Find the engine, and if possible its version, used by an archive.
+
+    If the archive has not been hashed yet it is inspected directly rather
+    than hashing it to look up the index, as hashing requires reading the
+    whole file, while inspecting a zip only requires reading a few parts of it.
+
+    :return: A tuple of engine and version, either of which may be None if
+        they can't be determined
+    """
+    idx = index(path) if util.cached_sha256(path) is not None else _scan(path)
+    if idx is None:
+        return None, None
+    return idx['engine'], idx['engine_version']
@@ -0,0 +1,189 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Find the images, audio, and movies that RPGMaker games never use.
+
+RPGMaker MV and MZ refer to assets by name, without an extension, from their
+data files: maps, common events, and the database. Every string in those
+files, and in the plugins and their parameters, is collected, along with the
+words in them, and an asset is used if its name is one of them. This finds far
+more names than are really used, which is the safe direction to be wrong in.
+
+Plugins can also build names at runtime, such as "pic_" + n, which can't be
+found this way. Directories that the engine loads fixed names from are always
+kept, and descriptions can keep more with the keep_assets workaround.
+
+Only the data files and plugins are read from the archive, and the result is
+cached by the sha256 of the archive, so this is fast even for games with a
+hundred thousand files. The unused assets are written to a list, which is
+removed during the build by a single command, rather than being listed in the
+manifest.
+"""
+
+from __future__ import annotations
+import fnmatch
+import hashlib
+import json
+import os
+import pathlib
+import re
+import tempfile
+import typing
+
+from . import archive, util
+
+if typing.TYPE_CHECKING:
+    from .description import Archive
+
+# Bump this when the analysis changes, to invalidate the cache
+_VERSION = 1
+
+# Directories that hold a type of asset each, in which assets are referred to
+# by their path relative to that directory, without the extension. img and
+# audio have a directory for each type under them.
+_ASSET_DIRS = {'img': 2, 'audio': 2, 'movies': 1}
+
+# Assets the engine loads by fixed names, rather than from the data
+_ALWAYS_KEEP = re.compile(fnmatch.translate('img/system/*'))
+
+# Splits strings into the words that might be names, such as the "Foo" in
+# plugin notetags like <Portrait: Foo>, or in escape codes like \pic[Foo]
+_SEPARATORS = re.compile(r'[\[\]<>\\|,:;=(){}"\'\n\r\t]+')
+
+# String literals in plugin source
+_JS_STRING = re.compile(r'''"((?:[^"\\\n]|\\.)*)"|'((?:[^'\\\n]|\\.)*)'|`([^`\\]*)`''')
+
+def _add(value: str, found: typing.Set[str]) -> None:
+    found.add(value)
+    for word in _SEPARATORS.split(value):
+        word = word.strip()
+        if word:
+            found.add(word)
+            # A name given with its extension
+            found.add(word.rsplit('.', 1)[0])
+
+
+def _strings(value: object, found: typing.Set[str]) -> None:
+    # Maps can be deeply nested, so walk them without recursing
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, str):
+            _add(v, found)
+        elif isinstance(v, list):
+            stack.extend(v)
+        elif isinstance(v, dict):
+            stack.extend(v.values())
+
+
+def _split(name: str) -> typing.Optional[typing.Tuple[str, str]]:
+    """Split a member of the game into its asset directory and asset name.
+
+    :return: The directory and name, or None if it isn't in an asset directory
+    """
+    parts = name.split('/')
+    depth = _ASSET_DIRS.get(parts[0])
+    if depth is None or len(parts) <= depth:
+        return None
+    return '/'.join(parts[:depth]), '/'.join(parts[depth:]).rsplit('.', 1)[0]
+
+
+def _root(names: typing.Iterable[str]) -> typing.Optional[str]:
+    """Find the directory the game is in, www for MV, or the top level for MZ."""
+    for root in ['www/', '']:
+        if f'{root}data/System.json' in names:
+            return root
+    return None
+
+
+def _analyze(a: Archive, idx: archive.Index) -> typing.Tuple[str, typing.List[str]]:
+    """Find the unused assets.
+
+    :return: The directory the game is in, and the unused assets
+    """
+    names = archive.member_names(idx, a.get('strip_components', 1))
+    root = _root(names)
+    if root is None:
+        return '', []
+
+    sources = [
+        n for n in names
+        if (n.startswith(f'{root}data/') and n.endswith('.json') and n.count('/') == root.count('/') + 1)
+        or n == f'{root}js/plugins.js'
+        or (n.startswith(f'{root}js/plugins/') and n.endswith('.js'))
+    ]
+    found: typing.Set[str] = set()
+    for original, data in archive.read_members(a['path'], [names[s] for s in sources]):
+        text = data.decode('utf-8-sig', 'replace')
+        if original.endswith('.json'):
+            try:
+                _strings(json.loads(text), found)
+            except ValueError:
+                # Anything could be referenced from a file that can't be read
+                return root, []
+        else:
+            for m in _JS_STRING.finditer(text):
+                _add(next(g for g in m.groups() if g is not None), found)
+
+    unused: typing.List[str] = []
+    for n in sorted(names):
+        if not n.startswith(root):
+            continue
+        rel = n[len(root):]
+        split = _split(rel)
+        if split is None or _ALWAYS_KEEP.match(rel):
+            continue
+        asset = split[1]
+        if asset not in found and asset.rsplit('/', 1)[-1] not in found:
+            unused.append(n)
+    return root, unused
+
+
+def unused(a: Archive, keep: typing.Iterable[str] = ()) -> typing.List[str]:
+    """Find the assets in an RPGMaker game's archive that are never referenced.
+
+    :param a: The archive of the game
+    :param keep: fnmatch patterns of more assets to keep, relative to the game
+        directory, such as 'img/pictures/pic_*'
+    :return: The sorted paths of the unused assets, as they will be installed.
+        This is empty if the game can't be analyzed.
+    """
+    idx = archive.index(a['path'])
+    if idx is None:
+        return []
+
+    cache = util.cache_dir() / 'assets' / f'{util.sha256(a["path"])}-{a.get("strip_components", 1)}-{_VERSION}.json'
+    if cache.exists():
+        with cache.open('r') as f:
+            root, found = json.load(f)
+    else:
+        root, found = _analyze(a, idx)
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=cache.parent, delete=False) as f:
+            json.dump([root, found], f)
+        os.replace(f.name, cache)
+
+    keep = list(keep)
+    return [n for n in found if not any(fnmatch.fnmatchcase(n[len(root):], p) for p in keep)]
+
+
+def unused_list(a: Archive, keep: typing.Iterable[str] = (), prefix: str = '') -> typing.Optional[pathlib.Path]:
+    """Write the unused assets of a game to a file, to remove them in the build.
+
+    The paths are separated by NUL bytes, so the file can be passed to
+    ``xargs -0``. It is named by its sha256, so it is only written once.
+
+    :param prefix: Prepended to each path, such as where the game is installed
+    :return: The file, or None if every asset is used
+    """
+    names = unused(a, keep)
+    if not names:
+        return None
+    data = b''.join(f'{prefix}{n}'.encode() + b'\0' for n in names)
+    path = util.cache_dir() / 'assets' / f'{hashlib.sha256(data).hexdigest()}.lst'
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=path.parent, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+    return path
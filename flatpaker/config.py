@@ -17,12 +17,32 @@ if typing.TYPE_CHECKING:
         {
             'gpg-key': str,
             'repo': str,
+            'state-dir': str,
+            'state-dir-max-size': typing.Union[str, int],
         },
         total=False,
     )
 
+    Repo = typing.TypedDict(
+        'Repo',
+        {
+            'history': int,
+            'deltas': int,
+            'delta-memory': typing.Union[str, int],
+        },
+        total=False,
+    )
+
+    class Runtime(typing.TypedDict):
+        url: str
+        sha256: str
+
     class Config(typing.TypedDict):
         common: Common
+        repo: Repo
+        # The engine source each shared runtime is built from, by engine
+        # and version
+        runtimes: typing.Dict[str, typing.Dict[str, Runtime]]
 
 
 def load_config() -> Config:
@@ -38,4 +58,8 @@ def load_config() -> Config:
 
     if 'common' not in raw:
         raw['common'] = {}
+    if 'repo' not in raw:
+        raw['repo'] = {}
+    if 'runtimes' not in raw:
+        raw['runtimes'] = {}
     return typing.cast('Config', raw)
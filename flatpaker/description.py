@@ -12,6 +12,8 @@ try:
 except ImportError:
     import tomli as tomllib  # type: ignore[import-not-found,no-redef]
 
+from . import fetch, schema
+
 if typing.TYPE_CHECKING:
     from typing_extensions import NotRequired
 
@@ -19,7 +21,7 @@ if typing.TYPE_CHECKING:
 
         reverse_url: str
         name: str
-        engine: typing.Literal['renpy', 'rpgmaker']
+        engine: NotRequired[typing.Literal['renpy', 'rpgmaker']]
         categories: NotRequired[typing.List[str]]
 
     class _AppData(typing.TypedDict):
@@ -32,15 +34,20 @@ if typing.TYPE_CHECKING:
 
     class _Workarounds(typing.TypedDict, total=False):
         use_x11: bool
+        keep_assets: typing.List[str]
 
     class Archive(typing.TypedDict):
 
         path: pathlib.Path
+        url: NotRequired[str]
+        sha256: NotRequired[str]
         strip_components: NotRequired[int]
 
     class File(typing.TypedDict):
 
         path: pathlib.Path
+        url: NotRequired[str]
+        sha256: NotRequired[str]
         dest: NotRequired[str]
 
     class Sources(typing.TypedDict):
@@ -57,20 +64,63 @@ if typing.TYPE_CHECKING:
         sources: NotRequired[Sources]
 
 
+def _fixup_path(relpath: pathlib.Path, source: typing.Union[Archive, File]) -> None:
+    """Make a path absolute, or point sources with a url at the local mirror."""
+    if 'url' in source:
+        if 'sha256' not in source:
+            raise ValueError(f"source {source['url']} has a url, but no sha256")
+        source['path'] = fetch.mirror_path(source['url'], source['sha256'])
+    else:
+        source['path'] = relpath / source['path']
+
+
+def check_description(name: str) -> typing.List[str]:
+    """Load and validate a description, and check that its sources exist.
+
+    :return: Every problem found, which is empty if the description is valid
+    """
+    try:
+        with open(name, 'rb') as f:
+            raw = tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        return [f'{name}: {e}']
+
+    errors = [f'{name}: {e}' for e in schema.validate(raw)]
+
+    # The schema errors cover sources with the wrong structure, so skip those
+    relpath = pathlib.Path(name).parent.absolute()
+    sources = raw.get('sources')
+    for kind in ['archives', 'files', 'patches']:
+        entries = sources.get(kind) if isinstance(sources, dict) else None
+        for i, s in enumerate(entries if isinstance(entries, list) else []):
+            path = s.get('path') if isinstance(s, dict) else None
+            if isinstance(path, str) and not (relpath / path).exists():
+                errors.append(f"{name}: sources.{kind}[{i}]: {path} does not exist")
+    return errors
+
+
 def load_description(name: str) -> Description:
+    """Load and validate a description.
+
+    :raises ValueError: If the description doesn't match the schema
+    """
     relpath = pathlib.Path(name).parent.absolute()
     with open(name, 'rb') as f:
-        d = typing.cast('Description', tomllib.load(f))
+        raw = tomllib.load(f)
+    errors = schema.validate(raw)
+    if errors:
+        raise ValueError(f'{name} is not a valid description:\n  ' + '\n  '.join(errors))
+    d = typing.cast('Description', raw)
 
     # Fixup relative paths
     if 'sources' in d:
         for a in d['sources']['archives']:
-            a['path'] = relpath / a['path']
+            _fixup_path(relpath, a)
         if 'files' in d['sources']:
             for s in d['sources']['files']:
-                s['path'] = relpath / s['path']
+                _fixup_path(relpath, s)
         if 'patches' in d['sources']:
             for a in d['sources']['patches']:
-                a['path'] = relpath / a['path']
+                _fixup_path(relpath, a)
 
     return d
@@ -3,60 +3,656 @@
 
 from __future__ import annotations
 import argparse
+import concurrent.futures
+import contextlib
+import copy
+import functools
 import importlib
 import importlib.resources
 import os
 import pathlib
+import shutil
 import subprocess
+import sys
+import threading
 import typing
 
-from flatpaker.description import load_description
+from flatpaker.description import check_description, load_description
+import flatpaker.archive
 import flatpaker.config
+import flatpaker.farm
+import flatpaker.fetch
+import flatpaker.report
+import flatpaker.repo
 import flatpaker.util
+import flatpaker.watch
 
 if typing.TYPE_CHECKING:
-    from flatpaker.description import Description
+    from flatpaker.description import Archive, Description
+    from flatpaker.util import GeneratedFile
 
-    JsonWriterImpl = typing.Callable[[Description, pathlib.Path, str, pathlib.Path, pathlib.Path], None]
+    Optimize = typing.Literal['lossless', 'repack']
+
+    class JsonWriterImpl(typing.Protocol):
+
+        def __call__(self, description: Description, workdir: pathlib.Path, appid: str,
+                     desktop_file: pathlib.Path, appdata_file: pathlib.Path, *,
+                     optimize: typing.Optional[Optimize] = None) -> None: ...
+
+    class ManifestImpl(typing.Protocol):
+
+        def __call__(self, description: Description, appid: str,
+                     desktop_file: GeneratedFile, appdata_file: GeneratedFile, *,
+                     optimize: typing.Optional[Optimize] = None) -> typing.Dict[str, typing.Any]: ...
+
+    HarvestImpl = typing.Callable[[Description, str, pathlib.Path], None]
 
     class ImplMod(typing.Protocol):
 
         write_rules: JsonWriterImpl
+        manifest: ManifestImpl
+
+    class RuntimeImplMod(ImplMod, typing.Protocol):
+
+        RUNTIME_ID: str
+
+        def shared_runtime(self, description: Description,
+                           sources: typing.Dict[str, Archive]) -> typing.Optional[str]: ...
+
+        def runtime_manifest(self, source: Archive, version: str,
+                             optimize: typing.Optional[Optimize] = None) -> typing.Dict[str, typing.Any]: ...
+
+        def write_runtime_rules(self, source: Archive, workdir: pathlib.Path,
+                                name: str, version: str, optimize: typing.Optional[Optimize] = None) -> None: ...
+
+        def write_rules(self, description: Description, workdir: pathlib.Path, appid: str,
+                        desktop_file: pathlib.Path, appdata_file: pathlib.Path,
+                        runtime: typing.Optional[str] = None,
+                        optimize: typing.Optional[Optimize] = None,
+                        warm_cache: bool = False) -> None: ...
+
+        def manifest(self, description: Description, appid: str,
+                     desktop_file: GeneratedFile, appdata_file: GeneratedFile,
+                     runtime: typing.Optional[str] = None,
+                     optimize: typing.Optional[Optimize] = None,
+                     warm_cache: bool = False) -> typing.Dict[str, typing.Any]: ...
 
     class BaseArguments(typing.Protocol):
-        action: typing.Literal['build', 'install-deps']
+        action: typing.Literal['build', 'check', 'coordinator', 'detect', 'fetch', 'install-deps', 'maintain',
+                               'watch', 'worker']
         repo: str
         gpg: typing.Optional[str]
         install: bool
         export: bool
         cleanup: bool
+        force: bool
+        shared_runtime: bool
+        batch_export: bool
+        optimize_assets: typing.Optional[Optimize]
+        warm_cache: bool
+        state_dir: str
+        state_dir_max_size: typing.Optional[typing.Union[str, int]]
 
-    class BuildArguments(BaseArguments, typing.Protocol):
+    class FetchArguments(BaseArguments, typing.Protocol):
         descriptions: typing.List[str]
+        fetch_jobs: int
 
+    class MaintainArguments(BaseArguments, typing.Protocol):
+        history: int
+        deltas: int
+        delta_memory: typing.Union[str, int]
 
-def select_impl(name: typing.Literal['renpy', 'rpgmaker']) -> JsonWriterImpl:
+    class BuildArguments(FetchArguments, MaintainArguments, typing.Protocol):
+        jobs: int
+        report: typing.Optional[str]
+        maintain: bool
+
+    class CheckArguments(BaseArguments, typing.Protocol):
+        descriptions: typing.List[str]
+        jobs: typing.Optional[int]
+
+    class WatchArguments(BaseArguments, typing.Protocol):
+        directory: str
+        jobs: int
+        debounce: float
+
+    class CoordinatorArguments(FetchArguments, typing.Protocol):
+        listen: str
+        heartbeat_timeout: float
+        retries: int
+
+    class WorkerArguments(BaseArguments, typing.Protocol):
+        url: str
+        name: str
+        directory: typing.Optional[str]
+
+    class DetectArguments(BaseArguments, typing.Protocol):
+        archives: typing.List[str]
+
+
+def load_impl(name: typing.Literal['renpy', 'rpgmaker']) -> ImplMod:
     mod = typing.cast('ImplMod', importlib.import_module(f'flatpaker.impl.{name}'))
     assert hasattr(mod, 'write_rules'), 'should be good enough'
-    return mod.write_rules
+    return mod
+
+
+def select_impl(name: typing.Literal['renpy', 'rpgmaker']) -> JsonWriterImpl:
+    return load_impl(name).write_rules
+
+
+def detect_engine(description: Description) -> None:
+    """Fill in the engine of a description from its first archive, if it is unset."""
+    if 'engine' in description['common']:
+        return
+    archives = description.get('sources', {}).get('archives', [])
+    engine = flatpaker.archive.detect_engine(archives[0]['path'])[0] if archives else None
+    if engine is None:
+        raise ValueError(f"Could not detect the engine of {description['common']['name']}, "
+                         "it must be set in the description")
+    description['common']['engine'] = engine
+
+
+# Builds exported to a staging repo, and their fingerprints, to be recorded
+# once they are published to the repo
+_STAGED: typing.Dict[str, str] = {}
+_STAGED_LOCK = threading.Lock()
+
+
+def exported(args: BaseArguments, appid: str, fingerprint: str) -> None:
+    """Record the fingerprint of an export, or save it until the batch is published."""
+    if args.batch_export:
+        with _STAGED_LOCK:
+            _STAGED[appid] = fingerprint
+    else:
+        flatpaker.util.record_fingerprint(args.repo, appid, fingerprint)
+
+
+def take_staged() -> typing.Dict[str, str]:
+    """Get the builds that have been staged, and their fingerprints, and forget them."""
+    with _STAGED_LOCK:
+        staged = dict(_STAGED)
+        _STAGED.clear()
+    return staged
+
+
+def publish_staged(args: BaseArguments) -> bool:
+    """Publish all staged builds to the repo, and record their fingerprints.
+
+    :return: True if publishing succeeded, otherwise False
+    """
+    staged = take_staged()
+    try:
+        flatpaker.util.publish(args, sorted(staged))
+    except subprocess.CalledProcessError as e:
+        print(f'Publishing to {args.repo} failed: {e}', file=sys.stderr)
+        return False
+    for appid, fingerprint in staged.items():
+        flatpaker.util.record_fingerprint(args.repo, appid, fingerprint)
+    return True
+
+
+# Shared runtimes that have been built (or were already up to date) by this
+# process, and locks so that only one thread builds each one
+_RUNTIMES_BUILT: typing.Set[str] = set()
+_RUNTIME_LOCKS: typing.Dict[str, threading.Lock] = {}
+_RUNTIME_LOCKS_LOCK = threading.Lock()
+
+
+def runtime_sources(engine: str) -> typing.Dict[str, Archive]:
+    """The pinned sources of an engine that shared runtimes are built from.
+
+    These are set in the configuration file, and are located in the mirror,
+    but not downloaded.
+
+    :return: The sources by engine version
+    :raises ValueError: If a source doesn't have both a url and a sha256
+    """
+    sources: typing.Dict[str, Archive] = {}
+    for version, pin in flatpaker.config.load_config()['runtimes'].get(engine, {}).items():
+        if 'url' not in pin or 'sha256' not in pin:
+            raise ValueError(f'The {engine} {version} runtime must have a url and a sha256')
+        sources[version] = {
+            'url': pin['url'],
+            'sha256': pin['sha256'],
+            'path': flatpaker.fetch.mirror_path(pin['url'], pin['sha256']),
+        }
+    return sources
+
+
+def runtime_source(engine: str, version: str) -> Archive:
+    """The pinned source of a shared runtime, downloaded if it is missing.
+
+    :raises ValueError: If the source cannot be downloaded
+    """
+    source = runtime_sources(engine)[version]
+    flatpaker.fetch.fetch([typing.cast('Description', {'sources': {'archives': [source]}})])
+    return source
+
+
+def shared_runtime(description: Description) -> typing.Optional[typing.Tuple[RuntimeImplMod, str]]:
+    """Find the shared runtime a game can use.
+
+    :return: The engine implementation and the version of its runtime, or
+        None if the engine has no shared runtime, or there isn't one for the
+        engine version the game uses
+    :raises ValueError: If the engine cannot be detected
+    """
+    detect_engine(description)
+    impl = load_impl(description['common']['engine'])
+    if not hasattr(impl, 'shared_runtime'):
+        return None
+    runtime_impl = typing.cast('RuntimeImplMod', impl)
+    version = runtime_impl.shared_runtime(description, runtime_sources(description['common']['engine']))
+    return (runtime_impl, version) if version is not None else None
+
+
+def runtime_name(impl: RuntimeImplMod, version: str) -> str:
+    return f'{impl.RUNTIME_ID}-{version}'
+
+
+def _build_runtime(args: BaseArguments, impl: RuntimeImplMod, description: Description, version: str,
+                   export_lock: typing.Optional[threading.Lock] = None,
+                   previous: typing.Optional[str] = None) -> None:
+    """Build and install a shared runtime, unless it is unchanged since the last export.
+
+    The runtime is built from the engine source pinned for its version, and
+    installed for the user, as the games using it can't be built otherwise.
+
+    :param previous: The fingerprint of the last export, by default the one
+        recorded for the repo
+    :raises ValueError: If the engine source cannot be downloaded
+    """
+    name = runtime_name(impl, version)
+    source = runtime_source(description['common']['engine'], version)
+    with flatpaker.report.phase(name, 'manifest'):
+        struct = impl.runtime_manifest(source, version, args.optimize_assets)
+    fingerprint = flatpaker.util.fingerprint(struct)
+    if previous is None and args.export:
+        previous = flatpaker.util.exported_fingerprint(args.repo, name)
+    if args.export and not args.force and previous == fingerprint:
+        if flatpaker.util.runtime_installed(impl.RUNTIME_ID, version):
+            return
+        # Such as a worker that doesn't share the coordinator's repo, which
+        # builds it again instead
+        if pathlib.Path(args.repo).is_dir():
+            flatpaker.util.install_runtime(name, pathlib.Path(args.repo), impl.RUNTIME_ID, version)
+            return
+
+    # The runtime is installed from the repo it is exported to, so without
+    # --export it is exported to a staging repo of its own. flatpak-builder
+    # would only install the Sdk.
+    runtime_args = copy.copy(args)
+    runtime_args.install = False
+    if not args.export:
+        runtime_args.export = runtime_args.batch_export = True
+    with flatpaker.util.tmpdir(name, args.cleanup, fingerprint) as d:
+        flatpaker.util.write_json(d / f'{name}.json', struct)
+        flatpaker.util.build_flatpak(runtime_args, d, name, export_lock)
+
+    repo = flatpaker.util.staging_repo(name) if runtime_args.batch_export else pathlib.Path(args.repo)
+    flatpaker.util.install_runtime(name, repo, impl.RUNTIME_ID, version)
+    if args.export:
+        exported(args, name, fingerprint)
+    else:
+        shutil.rmtree(repo, ignore_errors=True)
+
+
+def build_runtime(args: BaseArguments, impl: RuntimeImplMod, description: Description,
+                  version: str, export_lock: typing.Optional[threading.Lock] = None) -> None:
+    """Build the shared runtime for a game, unless it has already been built."""
+    name = runtime_name(impl, version)
+    with _RUNTIME_LOCKS_LOCK:
+        lock = _RUNTIME_LOCKS.setdefault(name, threading.Lock())
+
+    with lock:
+        if name not in _RUNTIMES_BUILT:
+            _build_runtime(args, impl, description, version, export_lock)
+            _RUNTIMES_BUILT.add(name)
+
+
+def generate(description: Description, appid: str, runtime: typing.Optional[str] = None,
+             optimize: typing.Optional[Optimize] = None, warm_cache: bool = False
+             ) -> typing.Tuple[typing.Dict[str, typing.Any], str, bytes]:
+    """Generate the manifest of a description, with its desktop file and appdata.
+
+    This is used by both build and flatpaker.api, so that they always agree.
+
+    :param runtime: The version of the shared runtime to use, if any
+    :param optimize: If set, how to shrink the game's assets after installing it
+    :param warm_cache: If True generate Ren'Py's startup caches during the
+        build, this is ignored for other engines
+    :return: The manifest, desktop file, and appdata
+    :raises ValueError: If the engine cannot be detected
+    """
+    detect_engine(description)
+    impl = load_impl(description['common']['engine'])
+
+    options: typing.Dict[str, typing.Any] = {}
+    if runtime is not None:
+        options['runtime'] = runtime
+    if optimize is not None:
+        options['optimize'] = optimize
+    if warm_cache and description['common']['engine'] == 'renpy':
+        options['warm_cache'] = True
+
+    with flatpaker.report.phase(appid, 'metadata'):
+        desktop = flatpaker.util.desktop(description, appid)
+        appdata = flatpaker.util.appdata(description, appid)
+
+    with flatpaker.report.phase(appid, 'manifest'):
+        struct = impl.manifest(
+            description, appid, (f'{appid}.desktop', desktop), (f'{appid}.metainfo.xml', appdata), **options)
+    return struct, desktop, appdata
+
+
+def build(args: BaseArguments, description: Description,
+          export_lock: typing.Optional[threading.Lock] = None,
+          previous: typing.Optional[str] = None, with_runtime: bool = True) -> bool:
+    """Build a single description.
+
+    :param previous: The fingerprint of the last export, by default the one
+        recorded for the repo
+    :param with_runtime: If False, the shared runtime the game uses has
+        already been built for the repo elsewhere, such as by another farm
+        worker, and is only built here if it isn't installed
+    :return: False if the build was skipped because it is unchanged since the
+        last export, otherwise True
+    """
+    appid = flatpaker.util.get_appid(description)
+
+    detect_engine(description)
+    impl = load_impl(description['common']['engine'])
+    harvest: typing.Optional[typing.Callable[[pathlib.Path], None]] = None
+    if hasattr(impl, 'harvest'):
+        harvest = functools.partial(typing.cast('HarvestImpl', getattr(impl, 'harvest')), description, appid)
+
+    version: typing.Optional[str] = None
+    runtime = shared_runtime(description) if args.shared_runtime else None
+    if runtime is not None:
+        runtime_impl, version = runtime
+        if with_runtime:
+            build_runtime(args, runtime_impl, description, version, export_lock)
+        elif not flatpaker.util.runtime_installed(runtime_impl.RUNTIME_ID, version):
+            # The game is built against the runtime, but this copy of it
+            # isn't exported, the one built for the repo is
+            local = copy.copy(args)
+            local.export = False
+            build_runtime(local, runtime_impl, description, version, export_lock)
+
+    # The desktop file and appdata are inline sources, so the manifest is
+    # everything that is generated for the build
+    struct, _, _ = generate(description, appid, version, args.optimize_assets, args.warm_cache)
+    with flatpaker.report.phase(appid, 'hash'):
+        fingerprint = flatpaker.util.fingerprint(struct)
+    if previous is None and args.export:
+        previous = flatpaker.util.exported_fingerprint(args.repo, appid)
+    if args.export and not args.force and previous == fingerprint:
+        return False
+
+    with flatpaker.util.tmpdir(appid, args.cleanup, fingerprint) as wd:
+        flatpaker.util.write_json(wd / f'{appid}.json', struct)
+        flatpaker.util.build_flatpak(args, wd, appid, export_lock, harvest)
+
+    if args.export:
+        exported(args, appid, fingerprint)
+    return True
 
 
-def build(args: BaseArguments, description: Description) -> None:
-    # TODO: This could be common
-    appid = f"{description['common']['reverse_url']}.{flatpaker.util.sanitize_name(description['common']['name'])}"
+def _load_and_build(args: BaseArguments, name: str,
+                    export_lock: typing.Optional[threading.Lock] = None) -> bool:
+    timer = flatpaker.report.Timer()
+    description = load_description(name)
+    appid = flatpaker.util.get_appid(description)
+    timer.stop(appid, 'load')
+    flatpaker.report.record(appid, 'description', name)
+    return build(args, description, export_lock)
 
-    write_build_rules = select_impl(description['common']['engine'])
 
-    with flatpaker.util.tmpdir(description['common']['name'], args.cleanup) as d:
-        wd = pathlib.Path(d)
-        desktop_file = flatpaker.util.create_desktop(description, wd, appid)
-        appdata_file = flatpaker.util.create_appdata(description, wd, appid)
-        write_build_rules(description, wd, appid, desktop_file, appdata_file)
-        flatpaker.util.build_flatpak(args, wd, appid)
+def check_all(args: CheckArguments) -> bool:
+    """Check every description, printing all of the problems found.
+
+    Parsing toml is CPU bound, so this uses processes rather than threads.
+
+    :return: True if every description is valid, otherwise False
+    """
+    # Give each process a good sized batch, as the work for each is small
+    chunksize = max(1, len(args.descriptions) // ((args.jobs or os.cpu_count() or 1) * 4))
+    valid = True
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        for errors in executor.map(check_description, args.descriptions, chunksize=chunksize):
+            for e in errors:
+                print(e, file=sys.stderr)
+            valid = valid and not errors
+    return valid
+
+
+def fetch_all(args: FetchArguments) -> bool:
+    """Download the sources of each description that aren't already mirrored.
+
+    :return: True if all downloads succeeded, otherwise False
+    """
+    try:
+        flatpaker.fetch.fetch([load_description(d) for d in args.descriptions], args.fetch_jobs)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return False
+    return True
+
+
+def _detect(archive: str) -> typing.Union[str, OSError]:
+    try:
+        engine, version = flatpaker.archive.detect_engine(pathlib.Path(archive))
+    except OSError as e:
+        return e
+    return f'{engine or "unknown"} {version or ""}'.rstrip()
+
+
+def detect_all(args: DetectArguments) -> bool:
+    """Print the engine and version used by each archive.
+
+    :return: True if every archive could be read, otherwise False
+    """
+    valid = True
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for a, result in zip(args.archives, executor.map(_detect, args.archives)):
+            if isinstance(result, OSError):
+                print(f'{a}: {result.strerror or result}', file=sys.stderr)
+                valid = False
+            else:
+                print(f'{a}: {result}')
+    return valid
+
+
+def build_all(args: BuildArguments) -> bool:
+    """Build each description, running up to `args.jobs` builds at once.
+
+    :return: True if all builds succeeded, otherwise False
+    """
+    skipped: typing.List[str] = []
+    failed: typing.List[str] = []
+
+    # Download everything up front, so that downloads aren't limited by how
+    # many builds are running
+    if not fetch_all(args):
+        return False
+
+    # With one job this is still used, so that a failure is recorded the same
+    # way, rather than stopping the remaining builds
+    export_lock = threading.Lock()
+    with concurrent.futures.ThreadPoolExecutor(max(1, args.jobs)) as executor:
+        futures = {
+            executor.submit(_load_and_build, args, d, export_lock): d
+            for d in args.descriptions
+        }
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                if not f.result():
+                    skipped.append(futures[f])
+            except Exception as e:
+                print(f'Building {futures[f]} failed: {e}', file=sys.stderr)
+                failed.append(futures[f])
+
+    # Titles that built are published even if others failed
+    published = not args.batch_export or publish_staged(args)
+
+    if skipped:
+        print('Skipped (unchanged since last export):', *sorted(skipped), sep='\n  ')
+    if failed:
+        print('Failed to build:', *sorted(failed), sep='\n  ', file=sys.stderr)
+    return published and not failed
+
+
+def _build_and_publish(args: BaseArguments, description: Description,
+                       export_lock: typing.Optional[threading.Lock] = None) -> bool:
+    """Build a description, and publish it at once if exports are batched.
+
+    :return: False if the build was skipped, otherwise True
+    :raises RuntimeError: If publishing fails
+    """
+    if not build(args, description, export_lock):
+        return False
+    if args.batch_export:
+        with export_lock or contextlib.nullcontext():
+            if not publish_staged(args):
+                raise RuntimeError(f'publishing to {args.repo} failed')
+    return True
+
+
+def _build_staged(args: BaseArguments, description: Description,
+                  previous: typing.Optional[str], runtime: bool) -> typing.Dict[str, str]:
+    """Build a description for a coordinator, and get what was staged.
+
+    :param runtime: If True build only the shared runtime the description
+        uses, otherwise build only the description, as the coordinator has the
+        runtime built first
+    """
+    try:
+        if runtime:
+            found = shared_runtime(description)
+            if found is None:
+                raise ValueError(f"{description['common']['name']} doesn't use a shared runtime")
+            _build_runtime(args, found[0], description, found[1], previous=previous)
+        else:
+            build(args, description, previous=previous, with_runtime=False)
+    finally:
+        staged = take_staged()
+    return staged
+
+
+def _coordinated_runtime(description: Description) -> typing.Optional[str]:
+    """The name of the shared runtime a description uses, if it can be found."""
+    try:
+        found = shared_runtime(description)
+    except ValueError:
+        # The worker that builds it reports this
+        return None
+    return runtime_name(*found) if found is not None else None
+
+
+def coordinate(args: CoordinatorArguments) -> bool:
+    """Hand out the descriptions to workers, then publish what they build.
+
+    :return: True if all builds succeeded, otherwise False
+    """
+    try:
+        descriptions = [load_description(d) for d in args.descriptions]
+        flatpaker.fetch.fetch(descriptions, args.fetch_jobs)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return False
+
+    coordinator = flatpaker.farm.Coordinator(
+        {
+            'force': args.force,
+            'shared_runtime': args.shared_runtime,
+            'optimize_assets': args.optimize_assets,
+            'warm_cache': args.warm_cache,
+        },
+        args.heartbeat_timeout, args.retries)
+    # Sizing hashes every source, and finding runtimes reads the archives,
+    # which is mostly waiting on the disk
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        sizes = list(executor.map(flatpaker.farm.source_size, descriptions))
+        runtimes = list(executor.map(_coordinated_runtime, descriptions)) if args.shared_runtime \
+            else [None] * len(descriptions)
+
+    def previous(appid: str) -> typing.Optional[str]:
+        return None if args.force else flatpaker.util.exported_fingerprint(args.repo, appid)
+
+    # Each shared runtime is built once, by one worker, before the games that
+    # use it
+    runtime_jobs: typing.Dict[str, flatpaker.farm.Job] = {}
+    jobs: typing.List[flatpaker.farm.Job] = []
+    for path, description, size, runtime in zip(args.descriptions, descriptions, sizes, runtimes):
+        path = os.path.abspath(path)
+        if runtime is not None and runtime not in runtime_jobs:
+            runtime_jobs[runtime] = flatpaker.farm.Job(path, runtime, 0, previous(runtime), runtime=True)
+        if runtime is not None:
+            # Handing out the runtimes that block the most work first
+            runtime_jobs[runtime].size += size
+        appid = flatpaker.util.get_appid(description)
+        jobs.append(flatpaker.farm.Job(path, appid, size, previous(appid), requires=runtime))
+    for job in [*runtime_jobs.values(), *jobs]:
+        coordinator.add(job)
+
+    host, _, port = args.listen.rpartition(':')
+    with coordinator.serve(host, int(port)):
+        print(f'Waiting for workers to build {len(descriptions)} descriptions at http://{args.listen}')
+        coordinator.wait()
+        for name, fingerprint in coordinator.staged.items():
+            exported(args, name, fingerprint)
+        published = publish_staged(args)
+
+    if coordinator.skipped:
+        print('Skipped (unchanged since last export):', *sorted(coordinator.skipped), sep='\n  ')
+    if coordinator.failed:
+        print('Failed to build:', *sorted(coordinator.failed), sep='\n  ', file=sys.stderr)
+    return published and not coordinator.failed
+
+
+def maintain(args: MaintainArguments) -> bool:
+    """Generate deltas and prune the repo, then print the size of each update.
+
+    :return: True if maintaining the repo succeeded, otherwise False
+    """
+    if args.history < 1:
+        print('At least one commit of each flatpak must be kept', file=sys.stderr)
+        return False
+    # A delta from a pruned commit can't be used
+    policy = flatpaker.repo.Policy(args.history, min(args.deltas, args.history - 1),
+                                   flatpaker.util.parse_size(args.delta_memory))
+    try:
+        flatpaker.repo.maintain(args, policy)
+    except subprocess.CalledProcessError as e:
+        print(f'Maintaining {args.repo} failed: {e}', file=sys.stderr)
+        return False
+    flatpaker.repo.print_sizes(pathlib.Path(args.repo))
+    return True
+
+
+def _add_maintain_arguments(parser: argparse.ArgumentParser, policy: flatpaker.repo.Policy) -> None:
+    parser.add_argument(
+        '--history',
+        default=policy.history,
+        type=int,
+        action='store',
+        help='How many commits of each flatpak to keep in the repo')
+    parser.add_argument(
+        '--deltas',
+        default=policy.deltas,
+        type=int,
+        action='store',
+        help='How many previous commits of each flatpak to generate static deltas from')
+    parser.add_argument(
+        '--delta-memory',
+        default=policy.delta_memory,
+        action='store',
+        help='How much memory generating a delta may use, which limits how many are generated at once')
 
 
 def main() -> None:
     config = flatpaker.config.load_config()
+    policy = flatpaker.repo.Policy.from_config(config['repo'])
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--repo',
@@ -68,25 +664,205 @@ def main() -> None:
         default=config['common'].get('gpg-key'),
         action='store',
         help='A GPG key to sign the output to when writing to a repo')
+    parser.add_argument(
+        '--state-dir',
+        default=config['common'].get('state-dir', flatpaker.util.default_state_root().as_posix()),
+        action='store',
+        help='Where to keep flatpak-builder caches, one directory per application')
+    parser.add_argument(
+        '--state-dir-max-size',
+        default=config['common'].get('state-dir-max-size'),
+        action='store',
+        help='Remove the least recently used caches from the state dir when it grows larger than this (such as 20G)')
     parser.add_argument('--export', action='store_true', help='Export to the provided repo')
     parser.add_argument('--install', action='store_true', help="Install for the user (useful for testing)")
     parser.add_argument('--no-cleanup', action='store_false', dest='cleanup', help="don't delete the temporary directory")
+    parser.add_argument(
+        '--batch-export',
+        action='store_true',
+        help='With --export, export each build to a staging repo, and update the repo once at the end')
+    parser.add_argument('--force', action='store_true', help='Rebuild even if nothing has changed since the last export')
+    parser.add_argument(
+        '--shared-runtime',
+        action='store_true',
+        help="Use a shared runtime for engine versions that have one configured, rather than putting the engine in every flatpak")
+    parser.add_argument(
+        '--optimize-assets',
+        choices=['lossless', 'repack'],
+        action='store',
+        help=("Losslessly recompress png files. "
+              "'repack' also packs loose images and audio into an archive (Ren'Py 8 and later only)"))
+    parser.add_argument(
+        '--warm-cache',
+        action='store_true',
+        help="Boot each game once during the build to generate its startup caches (Ren'Py only)")
 
     subparsers = parser.add_subparsers()
     build_parser = subparsers.add_parser('build', help='Build flatpaks from descriptions')
     build_parser.add_argument('descriptions', nargs='+', help="A Toml description file")
+    build_parser.add_argument(
+        '-j', '--jobs',
+        default=1,
+        type=int,
+        action='store',
+        help='How many descriptions to build at once')
+    build_parser.add_argument(
+        '--fetch-jobs',
+        default=4,
+        type=int,
+        action='store',
+        help='How many sources to download at once')
+    build_parser.add_argument(
+        '--report',
+        action='store',
+        help='Write timing and size information about the builds to this json file')
+    build_parser.add_argument(
+        '--maintain',
+        action='store_true',
+        help='After exporting, generate deltas and prune the repo, as the maintain command does')
+    _add_maintain_arguments(build_parser, policy)
     build_parser.set_defaults(action='build')
 
+    check_parser = subparsers.add_parser('check', help='Check that descriptions are valid, and that their sources exist')
+    check_parser.add_argument('descriptions', nargs='+', help="A Toml description file")
+    check_parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        action='store',
+        help='How many processes to check with, defaults to the number of CPUs')
+    check_parser.set_defaults(action='check')
+
+    fetch_parser = subparsers.add_parser('fetch', help='Download the sources of descriptions into the local mirror')
+    fetch_parser.add_argument('descriptions', nargs='+', help="A Toml description file")
+    fetch_parser.add_argument(
+        '-j', '--jobs',
+        default=4,
+        type=int,
+        action='store',
+        dest='fetch_jobs',
+        help='How many sources to download at once')
+    fetch_parser.set_defaults(action='fetch')
+
+    detect_parser = subparsers.add_parser('detect', help='Detect the engine and version used by archives')
+    detect_parser.add_argument('archives', nargs='+', help="A game archive")
+    detect_parser.set_defaults(action='detect')
+
+    maintain_parser = subparsers.add_parser('maintain', help='Generate static deltas for, and prune old commits from, the repo')
+    _add_maintain_arguments(maintain_parser, policy)
+    maintain_parser.set_defaults(action='maintain')
+
+    watch_parser = subparsers.add_parser('watch', help='Rebuild descriptions in a directory when they or their sources change')
+    watch_parser.add_argument('directory', help='A directory of Toml description files')
+    watch_parser.add_argument(
+        '-j', '--jobs',
+        default=1,
+        type=int,
+        action='store',
+        help='How many descriptions to build at once')
+    watch_parser.add_argument(
+        '--debounce',
+        default=1.0,
+        type=float,
+        action='store',
+        help='How many seconds to wait for changes to settle before building')
+    watch_parser.set_defaults(action='watch')
+
+    coordinator_parser = subparsers.add_parser(
+        'coordinator', help='Hand out descriptions to workers to build, and export what they build')
+    coordinator_parser.add_argument('descriptions', nargs='+', help="A Toml description file")
+    coordinator_parser.add_argument(
+        '--listen',
+        default='127.0.0.1:8710',
+        action='store',
+        help='The address and port to listen for workers on')
+    coordinator_parser.add_argument(
+        '--heartbeat-timeout',
+        default=60.0,
+        type=float,
+        action='store',
+        help='How many seconds without a heartbeat before a build is given to another worker')
+    coordinator_parser.add_argument(
+        '--retries',
+        default=2,
+        type=int,
+        action='store',
+        help='How many more times to try building a description after it fails')
+    coordinator_parser.add_argument(
+        '--fetch-jobs',
+        default=4,
+        type=int,
+        action='store',
+        help='How many sources to download at once')
+    coordinator_parser.set_defaults(action='coordinator')
+
+    worker_parser = subparsers.add_parser('worker', help='Build descriptions handed out by a coordinator')
+    worker_parser.add_argument('url', help='The url of the coordinator, such as http://127.0.0.1:8710')
+    worker_parser.add_argument(
+        '--name',
+        default=flatpaker.farm.default_name(),
+        action='store',
+        help='A name for this worker, defaults to the hostname and process id')
+    worker_parser.add_argument(
+        '--directory',
+        action='store',
+        help='Where to build, defaults to a directory under build named after the worker')
+    worker_parser.set_defaults(action='worker')
+
     install_deps_parser = subparsers.add_parser('install-deps', help='Install runtime and Sdk dependencies')
     install_deps_parser.set_defaults(action='install-deps')
 
     args = typing.cast('BaseArguments', parser.parse_args())
+    if args.batch_export and (not args.export or args.install):
+        parser.error('--batch-export requires --export, and cannot be used with --install')
 
     if args.action == 'build':
-        descriptions = typing.cast('BuildArguments', args).descriptions
-        for d in descriptions:
-            description = load_description(d)
-            build(args, description)
+        build_args = typing.cast('BuildArguments', args)
+        if build_args.report:
+            flatpaker.report.enable()
+        try:
+            success = build_all(build_args)
+        finally:
+            if build_args.report:
+                flatpaker.report.write(build_args.report)
+        if build_args.maintain and build_args.export:
+            success = maintain(build_args) and success
+        if not success:
+            sys.exit(1)
+    if args.action == 'maintain':
+        if not maintain(typing.cast('MaintainArguments', args)):
+            sys.exit(1)
+    if args.action == 'check':
+        if not check_all(typing.cast('CheckArguments', args)):
+            sys.exit(1)
+    if args.action == 'fetch':
+        if not fetch_all(typing.cast('FetchArguments', args)):
+            sys.exit(1)
+    if args.action == 'watch':
+        watch_args = typing.cast('WatchArguments', args)
+        flatpaker.watch.Watcher(
+            watch_args, pathlib.Path(watch_args.directory), _build_and_publish,
+            watch_args.jobs, watch_args.debounce).run()
+    if args.action in {'coordinator', 'worker'}:
+        # Builds are always staged, and exported by the coordinator
+        args.export = True
+        args.batch_export = True
+        args.install = False
+    if args.action == 'coordinator':
+        if not coordinate(typing.cast('CoordinatorArguments', args)):
+            sys.exit(1)
+    if args.action == 'worker':
+        worker_args = typing.cast('WorkerArguments', args)
+        directory = pathlib.Path(worker_args.directory or pathlib.Path('build', 'workers', worker_args.name))
+        directory.mkdir(parents=True, exist_ok=True)
+        # Paths given to the worker are relative to where it was started
+        worker_args.repo = os.path.abspath(worker_args.repo)
+        worker_args.state_dir = os.path.abspath(worker_args.state_dir)
+        os.chdir(directory)
+        if not flatpaker.farm.Worker(worker_args, worker_args.url, worker_args.name, _build_staged).run():
+            sys.exit(1)
+    if args.action == 'detect':
+        if not detect_all(typing.cast('DetectArguments', args)):
+            sys.exit(1)
     if args.action == 'install-deps':
         command = [
             'flatpak', 'install', '--no-auto-pin', '--user',
@@ -98,7 +874,9 @@ def main() -> None:
         sdk_file = importlib.resources.files('flatpaker') / 'data' / 'com.github.dcbaker.flatpaker.Sdk.yml'
         with importlib.resources.as_file(sdk_file) as sdk:
             build_command: typing.List[str] = [
-                'flatpak-builder', '--force-clean', '--user', 'build', sdk.as_posix()]
+                'flatpak-builder', '--force-clean', '--user',
+                '--state-dir', (pathlib.Path(args.state_dir) / 'com.github.dcbaker.flatpaker.Sdk').as_posix(),
+                'build/com.github.dcbaker.flatpaker.Sdk', sdk.as_posix()]
 
             if args.export:
                 build_command.extend(['--repo', args.repo])
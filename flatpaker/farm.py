@@ -0,0 +1,495 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Build descriptions on many machines at once.
+
+A coordinator holds a queue of descriptions, with the largest sources first,
+and hands them out to workers over http. Workers run the same build as the
+build command, exporting to staging repos as --batch-export does, and upload
+the staging repos to the coordinator, which publishes them all to its repo
+once the queue is finished. Each shared runtime is a job of its own, and the
+games that use it are only handed out once it has been built.
+
+Workers read the descriptions and their sources from the same paths as the
+coordinator, so they must share a filesystem with it. There is no
+authentication, so the coordinator must only be reachable by trusted machines.
+
+The protocol is json over http:
+
+    POST /next {"worker": name}
+        200 and a job, 204 if there is nothing to do yet, or 410 once the
+        queue is finished. A job with "runtime" set is for the shared runtime
+        the description uses, rather than the description itself.
+    POST /jobs/<lease>/heartbeat
+        200, or 409 if the job has since been given to another worker
+    POST /jobs/<lease>/failed {"error": message}
+    PUT /jobs/<lease>/result
+        A tar of staging repos, with the fingerprint of each as json in the
+        X-Flatpaker-Staged header
+"""
+
+from __future__ import annotations
+import contextlib
+import heapq
+import http.server
+import itertools
+import json
+import os
+import pathlib
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import typing
+import urllib.error
+import urllib.request
+
+from . import fetch, report, util
+from .description import load_description
+
+if typing.TYPE_CHECKING:
+    from .description import Description
+    from .entry import BaseArguments
+
+    StagedBuilder = typing.Callable[[BaseArguments, Description, typing.Optional[str], bool], typing.Dict[str, str]]
+
+# How often an idle worker asks for a job
+_POLL = 1.0
+
+# How long a worker keeps trying to reach the coordinator
+_CONNECT_TIMEOUT = 30.0
+
+# How long a worker waits for the coordinator to respond to a request
+_REQUEST_TIMEOUT = 60.0
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Only regular files and directories are accepted, but use the stricter
+# extraction filter where python has it
+_EXTRACT_FILTER: typing.Dict[str, typing.Any] = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+
+def default_name() -> str:
+    """The name a worker uses by default."""
+    return f'{os.uname().nodename}-{os.getpid()}'
+
+
+def source_size(description: Description) -> int:
+    """The total size of the sources of a description."""
+    size = 0
+    for s in util.extract_sources(description):
+        if 'url' in s:
+            path = fetch.mirror_path(s['url'], s['sha256'])
+        elif 'path' in s:
+            path = pathlib.Path(s['path'])
+        else:
+            continue
+        with contextlib.suppress(OSError):
+            size += path.stat().st_size
+    return size
+
+
+class Job:
+
+    """A description waiting for, or being built by, a worker.
+
+    :param runtime: If True, build the shared runtime named appid, which the
+        description uses, rather than the description
+    :param requires: The name of a runtime job that must finish first
+    """
+
+    def __init__(self, path: str, appid: str, size: int, previous: typing.Optional[str],
+                 runtime: bool = False, requires: typing.Optional[str] = None):
+        self.id = 0
+        self.path = path
+        self.appid = appid
+        self.size = size
+        self.previous = previous
+        self.runtime = runtime
+        self.requires = requires
+        self.attempts = 0
+        self.worker: typing.Optional[str] = None
+        self.heartbeat = 0.0
+
+    @property
+    def lease(self) -> str:
+        # Each attempt gets a new lease, so a worker that has lost a job
+        # can't report on it
+        return f'{self.id}.{self.attempts}'
+
+
+class Coordinator:
+
+    """Hand out descriptions to workers, and collect what they build.
+
+    A job is given to another worker if its build fails, or its worker stops
+    sending heartbeats, until it has been tried `retries` more times.
+    """
+
+    def __init__(self, options: typing.Dict[str, typing.Any], heartbeat_timeout: float = 60.0, retries: int = 2):
+        self.options = options
+        self.heartbeat_timeout = heartbeat_timeout
+        self.retries = retries
+
+        # The fingerprints of what has been built, and the paths of the
+        # descriptions that were skipped or failed
+        self.staged: typing.Dict[str, str] = {}
+        self.built: typing.List[str] = []
+        self.skipped: typing.List[str] = []
+        self.failed: typing.List[str] = []
+
+        self._cond = threading.Condition()
+        self._order = itertools.count()
+        self._queue: typing.List[typing.Tuple[int, int, Job]] = []
+        self._running: typing.Dict[str, Job] = {}
+        # Jobs waiting for a runtime, and the runtimes that are done
+        self._waiting: typing.Dict[str, typing.List[Job]] = {}
+        self._ready: typing.Set[str] = set()
+        self._workers: typing.Set[str] = set()
+        self._told: typing.Set[str] = set()
+        self._extract_lock = threading.Lock()
+
+    def add(self, job: Job) -> None:
+        """Queue a job, the largest are handed out first.
+
+        Jobs that require a runtime wait until that runtime's job is done.
+        """
+        with self._cond:
+            job.id = next(self._order)
+            if job.requires is not None and job.requires not in self._ready:
+                self._waiting.setdefault(job.requires, []).append(job)
+            else:
+                heapq.heappush(self._queue, (-job.size, job.id, job))
+
+    def _finished(self) -> bool:
+        return not self._queue and not self._running and not self._waiting
+
+    def next(self, worker: str) -> typing.Tuple[int, typing.Optional[typing.Dict[str, typing.Any]]]:
+        """Give a worker its next job.
+
+        :return: An http status, and the job if there is one
+        """
+        with self._cond:
+            self._workers.add(worker)
+            if self._finished():
+                self._told.add(worker)
+                self._cond.notify_all()
+                return 410, None
+            if not self._queue:
+                return 204, None
+            _, _, job = heapq.heappop(self._queue)
+            job.worker = worker
+            job.heartbeat = time.monotonic()
+            self._running[job.lease] = job
+        print(f'{job.appid}: building on {worker}')
+        return 200, {
+            'lease': job.lease,
+            'path': job.path,
+            'appid': job.appid,
+            'runtime': job.runtime,
+            'previous': job.previous,
+            'heartbeat': self.heartbeat_timeout / 4,
+            'options': self.options,
+        }
+
+    def heartbeat(self, lease: str) -> bool:
+        """Note that a job's worker is still alive.
+
+        :return: False if the job has been given to another worker
+        """
+        with self._cond:
+            job = self._running.get(lease)
+            if job is None:
+                return False
+            job.heartbeat = time.monotonic()
+            return True
+
+    def _retry(self, job: Job, reason: str) -> None:
+        # Must be called with the lock held, and the job removed from running
+        job.attempts += 1
+        if job.attempts > self.retries:
+            print(f'{job.appid}: {reason}, giving up', file=sys.stderr)
+            if not job.runtime:
+                self.failed.append(job.path)
+            for waiting in self._waiting.pop(job.appid, []):
+                print(f'{waiting.appid}: {job.appid} could not be built', file=sys.stderr)
+                self.failed.append(waiting.path)
+        else:
+            print(f'{job.appid}: {reason}, retrying', file=sys.stderr)
+            heapq.heappush(self._queue, (-job.size, next(self._order), job))
+        self._cond.notify_all()
+
+    def fail(self, lease: str, error: str) -> None:
+        """Record that a job's build failed."""
+        with self._cond:
+            job = self._running.pop(lease, None)
+            if job is not None:
+                self._retry(job, f'failed on {job.worker}: {error}')
+
+    def _extract(self, staged: typing.Dict[str, str], result: typing.IO[bytes]) -> None:
+        with tarfile.open(fileobj=result, mode='r') as tar:
+            members = tar.getmembers()
+            for m in members:
+                parts = pathlib.PurePosixPath(m.name).parts
+                if (not parts or parts[0] not in staged or '..' in parts or m.name.startswith('/')
+                        or not (m.isfile() or m.isdir())):
+                    raise ValueError(f'unexpected file in result: {m.name}')
+            # Workers may upload the same runtime at the same time
+            with self._extract_lock:
+                for name in staged:
+                    shutil.rmtree(util.staging_repo(name), ignore_errors=True)
+                tar.extractall(util.staging_repo(''), members, **_EXTRACT_FILTER)
+
+    def finish(self, lease: str, staged: typing.Dict[str, str], result: typing.Optional[typing.IO[bytes]]) -> bool:
+        """Collect the staging repos a worker built.
+
+        :param staged: The name and fingerprint of each staging repo
+        :param result: A tar of the staging repos
+        :return: False if the job has been given to another worker
+        """
+        with self._cond:
+            job = self._running.get(lease)
+            if job is None:
+                return False
+        if result is not None:
+            try:
+                self._extract(staged, result)
+            except (tarfile.TarError, ValueError) as e:
+                self.fail(lease, f'could not read result: {e}')
+                return True
+        with self._cond:
+            if self._running.pop(lease, None) is None:
+                return False
+            self.staged.update(staged)
+            if job.runtime:
+                print(f'{job.appid}: built on {job.worker}' if job.appid in staged
+                      else f'{job.appid}: unchanged')
+                self._ready.add(job.appid)
+                for waiting in self._waiting.pop(job.appid, []):
+                    heapq.heappush(self._queue, (-waiting.size, waiting.id, waiting))
+            elif job.appid in staged:
+                self.built.append(job.path)
+                print(f'{job.appid}: built on {job.worker}')
+            else:
+                self.skipped.append(job.path)
+            self._cond.notify_all()
+        return True
+
+    def _reap(self) -> None:
+        now = time.monotonic()
+        with self._cond:
+            for lease, job in list(self._running.items()):
+                if now - job.heartbeat > self.heartbeat_timeout:
+                    del self._running[lease]
+                    self._retry(job, f'no heartbeat from {job.worker}')
+
+    def wait(self) -> None:
+        """Wait until every job has been built, or has failed."""
+        while True:
+            with self._cond:
+                if self._finished():
+                    return
+                self._cond.wait(self.heartbeat_timeout / 4)
+            self._reap()
+
+    @contextlib.contextmanager
+    def serve(self, host: str, port: int) -> typing.Iterator[typing.Tuple[str, int]]:
+        """Serve workers in the background.
+
+        When leaving, idle workers are given a little time to learn that the
+        queue is finished, so that they exit cleanly.
+
+        :return: The address being served, which has the port chosen if port
+            is 0
+        """
+        server = _Server((host, port), self)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield typing.cast('typing.Tuple[str, int]', server.server_address[:2])
+        finally:
+            deadline = time.monotonic() + _POLL * 5
+            with self._cond:
+                while self._workers - self._told and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+            server.shutdown()
+            server.server_close()
+
+
+class _Server(http.server.ThreadingHTTPServer):
+
+    def __init__(self, address: typing.Tuple[str, int], coordinator: Coordinator):
+        super().__init__(address, _Handler)
+        self.coordinator = coordinator
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    server: _Server
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+    def _reply(self, status: int, body: typing.Optional[typing.Dict[str, typing.Any]] = None) -> None:
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _json(self) -> typing.Dict[str, typing.Any]:
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        return typing.cast('typing.Dict[str, typing.Any]', json.loads(data or b'{}'))
+
+    def do_POST(self) -> None:
+        coordinator = self.server.coordinator
+        parts = self.path.strip('/').split('/')
+        if parts == ['next']:
+            self._reply(*coordinator.next(self._json().get('worker', self.client_address[0])))
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'heartbeat':
+            self._reply(200 if coordinator.heartbeat(parts[1]) else 409)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'failed':
+            coordinator.fail(parts[1], self._json().get('error', 'unknown error'))
+            self._reply(200)
+        else:
+            self._reply(404)
+
+    def do_PUT(self) -> None:
+        coordinator = self.server.coordinator
+        parts = self.path.strip('/').split('/')
+        if not (len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result'):
+            self._reply(404)
+            return
+
+        staged: typing.Dict[str, str] = json.loads(self.headers.get('X-Flatpaker-Staged', '{}'))
+        remaining = int(self.headers.get('Content-Length', 0))
+        if not remaining:
+            self._reply(200 if coordinator.finish(parts[1], staged, None) else 409)
+            return
+        with tempfile.TemporaryFile() as f:
+            while remaining:
+                chunk = self.rfile.read(min(remaining, _CHUNK_SIZE))
+                if not chunk:
+                    self._reply(400)
+                    return
+                f.write(chunk)
+                remaining -= len(chunk)
+            f.seek(0)
+            self._reply(200 if coordinator.finish(parts[1], staged, f) else 409)
+
+
+class Worker:
+
+    """Build the jobs a coordinator hands out, until its queue is finished."""
+
+    def __init__(self, args: BaseArguments, url: str, name: str, builder: StagedBuilder):
+        self.args = args
+        self.url = url.rstrip('/')
+        self.name = name
+        self.builder = builder
+
+    def _request(self, method: str, path: str, data: typing.Union[bytes, typing.IO[bytes], None] = None,
+                 headers: typing.Optional[typing.Dict[str, str]] = None) -> typing.Tuple[int, bytes]:
+        request = urllib.request.Request(f'{self.url}{path}', data=data, method=method, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=_REQUEST_TIMEOUT) as r:
+                return r.status, r.read()
+        except urllib.error.HTTPError as e:
+            return e.code, b''
+        except urllib.error.URLError:
+            raise
+        except OSError as e:
+            # Such as a timeout while reading the response, which is handled
+            # the same as not being able to reach the coordinator
+            raise urllib.error.URLError(e) from e
+
+    def _post(self, path: str, body: typing.Dict[str, typing.Any]) -> typing.Tuple[int, bytes]:
+        return self._request('POST', path, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+
+    def _next(self) -> typing.Tuple[int, bytes]:
+        # Keep trying for a while, so workers can be started before the
+        # coordinator
+        deadline = time.monotonic() + _CONNECT_TIMEOUT
+        while True:
+            try:
+                return self._post('/next', {'worker': self.name})
+            except urllib.error.URLError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(_POLL)
+
+    def run(self) -> bool:
+        """Build jobs until the coordinator's queue is finished.
+
+        :return: False if the coordinator could not be reached, otherwise True
+        """
+        while True:
+            try:
+                status, body = self._next()
+            except urllib.error.URLError as e:
+                print(f'Could not reach the coordinator at {self.url}: {e.reason}', file=sys.stderr)
+                return False
+            if status == 410:
+                return True
+            if status == 200:
+                self._run(json.loads(body))
+            else:
+                time.sleep(_POLL)
+
+    def _heartbeat(self, job: typing.Dict[str, typing.Any], stop: threading.Event, lost: threading.Event) -> None:
+        while not stop.wait(job['heartbeat']):
+            try:
+                status, _ = self._post(f'/jobs/{job["lease"]}/heartbeat', {})
+            except urllib.error.URLError:
+                continue
+            if status == 409:
+                print(f'{job["appid"]} was given to another worker, stopping its build', file=sys.stderr)
+                lost.set()
+                report.cancel(job['appid'])
+                return
+
+    def _upload(self, lease: str, staged: typing.Dict[str, str]) -> None:
+        headers = {'X-Flatpaker-Staged': json.dumps(staged), 'Content-Type': 'application/x-tar'}
+        if not staged:
+            headers['Content-Length'] = '0'
+            self._request('PUT', f'/jobs/{lease}/result', b'', headers)
+            return
+        with tempfile.TemporaryFile() as f:
+            with tarfile.open(fileobj=f, mode='w') as tar:
+                for name in staged:
+                    tar.add(util.staging_repo(name), arcname=name)
+            headers['Content-Length'] = str(f.tell())
+            f.seek(0)
+            self._request('PUT', f'/jobs/{lease}/result', f, headers)
+
+    def _run(self, job: typing.Dict[str, typing.Any]) -> None:
+        for k, v in job['options'].items():
+            setattr(self.args, k, v)
+
+        stop = threading.Event()
+        lost = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, stop, lost), daemon=True)
+        heartbeat.start()
+        try:
+            label = job['appid'] if job['runtime'] else job['path']
+            print(f'Building {label}')
+            try:
+                staged = self.builder(self.args, load_description(job['path']), job['previous'], job['runtime'])
+            except Exception as e:
+                if not lost.is_set():
+                    print(f'Building {label} failed: {e}', file=sys.stderr)
+                    self._post(f'/jobs/{job["lease"]}/failed', {'error': str(e)})
+                return
+            if not lost.is_set():
+                self._upload(job['lease'], staged)
+            if self.args.cleanup:
+                for name in staged:
+                    shutil.rmtree(util.staging_repo(name), ignore_errors=True)
+        except urllib.error.URLError as e:
+            print(f'Could not report {job["appid"]} to the coordinator: {e.reason}', file=sys.stderr)
+        finally:
+            stop.set()
+            heartbeat.join()
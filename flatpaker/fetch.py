@@ -0,0 +1,114 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Download sources into a local mirror.
+
+The mirror is content addressed, and laid out the same way as the downloads
+directory of flatpak-builder, so that it can be passed to flatpak-builder with
+--extra-sources.
+"""
+
+from __future__ import annotations
+import asyncio
+import hashlib
+import os
+import pathlib
+import posixpath
+import tempfile
+import typing
+import urllib.parse
+import urllib.request
+
+from . import util
+
+if typing.TYPE_CHECKING:
+    from .description import Description
+
+_CHUNK_SIZE = 1024 * 1024
+
+# How long to wait for a server to respond or send more data, in seconds
+_TIMEOUT = 60
+
+
+def mirror_path(url: str, sha256: str) -> pathlib.Path:
+    """Where a source with this url and digest is stored in the mirror."""
+    name = posixpath.basename(urllib.parse.unquote(urllib.parse.urlparse(url).path)) or sha256
+    return util.mirror_dir() / 'downloads' / sha256.lower() / name
+
+
+def _download(url: str, sha256: str, dest: pathlib.Path) -> None:
+    """Download a file, checking its digest as it is written.
+
+    The file is written to a temporary name and only moved into place once the
+    digest matches, so the mirror never contains a partial or corrupt file.
+
+    :raises ValueError: If the download fails or stalls, or the digest does not
+        match
+    """
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    h = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=dest.parent, prefix=f'.{dest.name}.', delete=False) as f:
+        try:
+            try:
+                with urllib.request.urlopen(url, timeout=_TIMEOUT) as r:
+                    for chunk in iter(lambda: r.read(_CHUNK_SIZE), b''):
+                        h.update(chunk)
+                        f.write(chunk)
+            except OSError as e:
+                raise ValueError(f'Downloading {url} failed: {e}') from e
+            if h.hexdigest() != sha256.lower():
+                raise ValueError(f'{url} has a sha256 of {h.hexdigest()}, but {sha256} was expected')
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, dest)
+
+
+async def _fetch(url: str, sha256: str, dest: pathlib.Path, limit: asyncio.Semaphore) -> None:
+    async with limit:
+        print(f'Downloading {url}')
+        await asyncio.to_thread(_download, url, sha256, dest)
+
+
+async def _fetch_all(wanted: typing.Dict[pathlib.Path, str], jobs: int) -> typing.List[BaseException]:
+    limit = asyncio.Semaphore(jobs)
+    results = await asyncio.gather(
+        *(_fetch(url, dest.parent.name, dest, limit) for dest, url in wanted.items()),
+        return_exceptions=True)
+    return [r for r in results if isinstance(r, BaseException)]
+
+
+def missing(description: Description) -> typing.Dict[pathlib.Path, str]:
+    """Find the sources of a description that need to be downloaded.
+
+    :return: A mapping of mirror paths to urls
+    """
+    sources = description.get('sources')
+    if sources is None:
+        return {}
+    return {
+        s['path']: s['url']
+        for s in [*sources['archives'], *sources.get('files', []), *sources.get('patches', [])]
+        if 'url' in s and not s['path'].exists()
+    }
+
+
+def fetch(descriptions: typing.Iterable[Description], jobs: int = 4) -> None:
+    """Download every source of these descriptions that isn't already mirrored.
+
+    Sources shared by several descriptions are only downloaded once.
+
+    :param jobs: The most downloads to run at once
+    :raises ValueError: If any download fails or has the wrong digest, after
+        all of the other downloads have finished
+    """
+    wanted: typing.Dict[pathlib.Path, str] = {}
+    for d in descriptions:
+        wanted.update(missing(d))
+    if not wanted:
+        return
+
+    errors = asyncio.run(_fetch_all(wanted, jobs))
+    if errors:
+        raise ValueError('Failed to download sources:\n  ' + '\n  '.join(str(e) for e in errors))
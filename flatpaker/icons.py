@@ -0,0 +1,193 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Extract icons from Windows executables and MacOS icns files in archives.
+
+This is done on the host rather than in the sandbox so that the results can
+be cached, and so that no tools beyond the standard Sdk are needed.
+"""
+
+from __future__ import annotations
+import pathlib
+import shutil
+import struct
+import tempfile
+import typing
+import zlib
+
+from flatpaker import archive, util
+
+if typing.TYPE_CHECKING:
+    from flatpaker.description import Archive
+
+# The sizes that will be installed into the hicolor theme. Flatpak will not
+# export icons larger than 512x512
+SIZES = {16, 22, 24, 32, 48, 64, 96, 128, 256, 512}
+
+_PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+_RT_ICON = 3
+
+
+def _png_size(data: bytes) -> int:
+    width, height = struct.unpack_from('>II', data, 16)
+    return typing.cast('int', width) if width == height else 0
+
+
+def _encode_png(width: int, height: int, rows: typing.Iterable[bytes]) -> bytes:
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    raw = b''.join(b'\0' + r for r in rows)
+    return b''.join([
+        _PNG_MAGIC,
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw, 9)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def _dib_to_png(data: bytes) -> typing.Optional[bytes]:
+    """Convert a 32bit uncompressed icon bitmap into a PNG.
+
+    Lower bit depths are ignored, any icon that has them will also have
+    better versions.
+    """
+    _, width, height, _, bits, compression = struct.unpack_from('<IiiHHI', data)
+    # The height includes the 1bit AND mask, which isn't needed with an alpha channel
+    height //= 2
+    if bits != 32 or compression != 0 or width != height:
+        return None
+
+    start = 40
+    stride = width * 4
+    rows: typing.List[bytes] = []
+    for y in range(height):
+        bgra = data[start + y * stride:start + (y + 1) * stride]
+        rgba = bytearray(bgra)
+        rgba[0::4] = bgra[2::4]
+        rgba[2::4] = bgra[0::4]
+        rows.append(bytes(rgba))
+
+    # Bitmaps are stored bottom to top
+    rows.reverse()
+    return _encode_png(width, height, rows)
+
+
+def _pe_icons(data: bytes) -> typing.Iterator[bytes]:
+    """Find the icon resources in a Windows PE executable."""
+    pe = struct.unpack_from('<I', data, 0x3c)[0]
+    if data[pe:pe + 4] != b'PE\0\0':
+        return
+    nsections, = struct.unpack_from('<H', data, pe + 6)
+    opt_size, = struct.unpack_from('<H', data, pe + 20)
+    opt = pe + 24
+    magic, = struct.unpack_from('<H', data, opt)
+    # The resource table is the third data directory
+    res_rva, = struct.unpack_from('<I', data, opt + (96 if magic == 0x10b else 112) + 16)
+
+    sections = [struct.unpack_from('<IIII', data, opt + opt_size + i * 40 + 8) for i in range(nsections)]
+
+    def offset(rva: int) -> int:
+        for vsize, vaddr, rawsize, rawptr in sections:
+            if vaddr <= rva < vaddr + max(vsize, rawsize):
+                return typing.cast('int', rva - vaddr + rawptr)
+        raise ValueError(f'RVA {rva:#x} is not in any section')
+
+    base = offset(res_rva)
+
+    def entries(off: int) -> typing.Iterator[typing.Tuple[int, int]]:
+        named, ids = struct.unpack_from('<HH', data, base + off + 12)
+        for i in range(named + ids):
+            yield typing.cast('typing.Tuple[int, int]', struct.unpack_from('<II', data, base + off + 16 + i * 8))
+
+    # The resource tree is type -> name -> language -> data
+    for type_, sub in entries(0):
+        if type_ != _RT_ICON or not sub & 0x80000000:
+            continue
+        for _, name in entries(sub & 0x7fffffff):
+            leaf = name
+            while leaf & 0x80000000:
+                leaf = next(entries(leaf & 0x7fffffff))[1]
+            rva, size = struct.unpack_from('<II', data, base + leaf)
+            start = offset(rva)
+            yield data[start:start + size]
+
+
+def _icns_icons(data: bytes) -> typing.Iterator[bytes]:
+    """Find the PNG icons in a MacOS icns file.
+
+    Older icns files use a custom RLE format, those are ignored.
+    """
+    if data[:4] != b'icns':
+        return
+    off = 8
+    while off + 8 <= len(data):
+        length, = struct.unpack_from('>I', data, off + 4)
+        if length < 8:
+            break
+        payload = data[off + 8:off + length]
+        if payload.startswith(_PNG_MAGIC):
+            yield payload
+        off += length
+
+
+def _decode(name: str, data: bytes) -> typing.Dict[int, bytes]:
+    found: typing.Dict[int, bytes] = {}
+    icons = _pe_icons(data) if name.endswith('.exe') else _icns_icons(data)
+    for icon in icons:
+        png = icon if icon.startswith(_PNG_MAGIC) else _dib_to_png(icon)
+        if png is None:
+            continue
+        size = _png_size(png)
+        # When there are several versions of one size, assume the biggest is
+        # the best
+        if size in SIZES and len(png) > len(found.get(size, b'')):
+            found[size] = png
+    return found
+
+
+def _find_source(a: Archive) -> typing.Optional[str]:
+    """Find the executable or icns file to take icons from."""
+    idx = archive.index(a['path'])
+    if idx is None:
+        return None
+    strip = a.get('strip_components', 1)
+    for pattern in ['*.exe', '*.app/Contents/Resources/icon.icns']:
+        found = archive.find_members(idx, strip, pattern)
+        if found:
+            return found[0]
+    return None
+
+
+def extract(a: Archive) -> typing.Dict[int, pathlib.Path]:
+    """Extract icons from an archive source.
+
+    Icons are cached by the sha256 of the archive.
+
+    :return: A mapping of icon size to a PNG file
+    """
+    cache = util.cache_dir() / 'icons' / util.sha256(a['path'])
+    if not cache.is_dir():
+        icons: typing.Dict[int, bytes] = {}
+        source = _find_source(a)
+        if source is not None:
+            try:
+                icons = _decode(source, archive.read_member(a['path'], source))
+            except (struct.error, ValueError, KeyError):
+                pass
+
+        # Write to a temporary directory and rename it, so that a partially
+        # written cache is never used. An empty directory records that there
+        # were no usable icons
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp = pathlib.Path(tempfile.mkdtemp(dir=cache.parent))
+        for size, png in icons.items():
+            (tmp / f'{size}.png').write_bytes(png)
+        try:
+            tmp.rename(cache)
+        except OSError:
+            # Someone else got there first
+            shutil.rmtree(tmp)
+
+    return {int(p.stem): p for p in sorted(cache.glob('*.png'))}
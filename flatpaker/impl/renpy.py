@@ -2,19 +2,30 @@
 # Copyright © 2022-2024 Dylan Baker
 
 from __future__ import annotations
-import json
+import fnmatch
 import os
 import pathlib
+import shutil
 import textwrap
 import typing
 
-from flatpaker import util
+from flatpaker import archive, icons, util
 
 if typing.TYPE_CHECKING:
-    from flatpaker.description import Description
+    from flatpaker.description import Archive, Description
+    from flatpaker.util import GeneratedFile
 
 
-def _create_game_sh(use_x11: bool) -> str:
+# The runtime that holds the shared engine, and where the engine is in it
+RUNTIME_ID = 'com.github.dcbaker.flatpaker.RenPy'
+RUNTIME_DIR = '/usr/lib/renpy'
+
+# The module that compiles the game, and whose build directory the compiled
+# files are harvested from
+COMPILE_MODULE = 'compile'
+
+
+def _create_game_sh(use_x11: bool, runtime: bool = False) -> str:
     lines: typing.List[str] = [
         '#!/usr/bin/env sh',
         '',
@@ -24,10 +35,18 @@ def _create_game_sh(use_x11: bool) -> str:
     if not use_x11:
         lines.append('export SDL_VIDEODRIVER=wayland')
 
-    lines.extend([
-        'cd /app/lib/game',
-        'exec sh *.sh',
-    ])
+    lines.append('cd /app/lib/game')
+    if runtime:
+        # Run the engine from the shared runtime, with this game as the base
+        # directory. This is what the launcher script does, with different paths
+        lines.extend([
+            f'if [ -d {RUNTIME_DIR}/lib/py3-linux-x86_64 ]; then',
+            f'    exec {RUNTIME_DIR}/lib/py3-linux-x86_64/python -EO {RUNTIME_DIR}/renpy.py /app/lib/game "$@"',
+            'fi',
+            f'exec {RUNTIME_DIR}/lib/linux-x86_64/python -EO {RUNTIME_DIR}/renpy.py /app/lib/game "$@"',
+        ])
+    else:
+        lines.append('exec sh *.sh')
 
     return '\n'.join(lines)
 
@@ -36,8 +55,8 @@ def quote(s: str) -> str:
     return f'"{s}"'
 
 
-def bd_game(description: Description) -> typing.Dict[str, typing.Any]:
-    sh = _create_game_sh(description.get('workarounds', {}).get('use_x11', True))
+def bd_game(description: Description, runtime: bool = False) -> typing.Dict[str, typing.Any]:
+    sh = _create_game_sh(description.get('workarounds', {}).get('use_x11', True), runtime)
     return {
         'buildsystem': 'simple',
         'name': 'game_sh',
@@ -50,12 +69,20 @@ def bd_game(description: Description) -> typing.Dict[str, typing.Any]:
     }
 
 
-def bd_build_commands(description: Description, appid: str) -> typing.List[str]:
+def bd_build_commands(description: Description, appid: str,
+                      layout: typing.Optional[typing.Set[str]] = None,
+                      extract_icons: bool = True) -> typing.List[str]:
+    """Commands to install the game."""
+    # Some games don't have a top level python launcher, only the shell script
+    install = ['*.sh', '*.py', 'renpy', 'game', 'lib']
+    if layout is not None and not fnmatch.filter(layout, '*.py'):
+        install.remove('*.py')
+
     commands: typing.List[str] = [
         'mkdir -p /app/lib/game',
 
         # install the main game files
-        'mv *.sh *.py renpy game lib /app/lib/game/',
+        f'mv {" ".join(install)} /app/lib/game/',
 
         # Move archives that have not been strippped as they would conflict
         # with the main source archive
@@ -74,10 +101,14 @@ def bd_build_commands(description: Description, appid: str) -> typing.List[str]:
     commands.extend([
         # Patch the game to not require sandbox access
         '''sed -i 's@"~/.renpy/"@os.environ.get("XDG_DATA_HOME", "~/.local/share") + "/"@g' /app/lib/game/*.py''',
+    ])
 
-        # Extract the icon file from either a Windows exe or from MacOS resources.
-        # This gives more sizes, and is more likely to exists than the gui/window_icon.png
-        textwrap.dedent(f'''
+    # Extract the icon file from either a Windows exe or from MacOS resources.
+    # This gives more sizes, and is more likely to exists than the gui/window_icon.png
+    #
+    # This is only needed if the icons couldn't be extracted on the host
+    if extract_icons:
+        commands.append(textwrap.dedent(f'''
             ICNS=$(ls *.app/Contents/Resources/icon.icns)
             EXE=$(ls *.exe)
             if [[ -f "${{EXE}}" ]]; then
@@ -102,21 +133,91 @@ def bd_build_commands(description: Description, appid: str) -> typing.List[str]:
                 fi
                 install -D -m644 "${{icon}}" "/app/share/icons/hicolor/${{size}}/apps/{appid}.png"
             done
-        '''),
+        '''))
+
+    return commands
+
+
+def bd_compile_commands(runtime: bool = False, warm_cache: bool = False) -> typing.List[str]:
+    """Commands to compile the installed game.
+
+    These are a separate module from installing the game, with the compiled
+    files from earlier builds as its source. The install module is then only
+    rebuilt when the game changes, rather than whenever the cache does.
+
+    :param runtime: If True the engine is provided by the shared runtime, and
+        is removed once the game has been compiled
+    :param warm_cache: If True boot the game once to generate the caches that
+        Ren'Py would otherwise try to write on each launch
+    """
+    commands: typing.List[str] = [
+        # Restore compiled rpyc and pyc files from previous builds of this
+        # game. These are keyed by the engine version and the sha256 of the
+        # source file. pyc files embed the mtime of their source, and
+        # flatpak-builder removes them as stale if it doesn't match, so the
+        # source mtime is reset to the one recorded in the restored file.
+        textwrap.dedent('''
+            cache="$PWD/.flatpaker-compile-cache";
+            work="$PWD/.flatpaker-compile";
+            mkdir -p "$work";
+            pushd /app/lib/game;
+            cat renpy/vc_version.py renpy/__init__.py 2>/dev/null | sha256sum | cut -d' ' -f1 > "$work/engine";
+            engine="$(cat "$work/engine")";
+            if [ -d "lib/py3-linux-x86_64" ]; then offset=8; else offset=4; fi;
+            { find . -type f -name '*.rpy' -print0; find %s -type f -name '*.py' -print0; } |
+                xargs -0 -r sha256sum > "$work/sums";
+            : > "$work/py-misses";
+            while read -r sum f; do
+                cached="$cache/$engine/$sum.${f##*.}c";
+                if [[ -f "$cached" ]]; then
+                    cp "$cached" "${f}c";
+                    if [[ "$f" == *.py ]]; then
+                        touch -d "@$(od -An -tu4 -j $offset -N 4 "${f}c" | tr -d ' ')" "$f";
+                    fi;
+                elif [[ "$f" == *.py ]]; then
+                    printf '%%s\\0' "$f" >> "$work/py-misses";
+                fi;
+            done < "$work/sums";
+            popd;
+            ''' % ('game' if runtime else 'game renpy lib')),
 
         # Recompile all of the rpy files
+        #
+        # Each directory boots a full copy of the engine, so run them in
+        # parallel. Nested directories write to the same files, so each top
+        # level directory and its children are compiled serially in one job.
+        # Every boot loads renpy/common, and rewrites its rpyc files if they
+        # are stale, so it is compiled on its own before any jobs are started.
+        # Directories where all of the rpyc files are newer than the rpy files
+        # are already up to date, and are skipped.
         textwrap.dedent('''
             pushd /app/lib/game;
-            script="$PWD/$(ls *.sh)";
-            dirs="$(find . -type f -name '*.rpy' -printf '%h\\0' | sort -zu | sed -z 's@$@ @')";
-            for d in $dirs; do
-                bash $script $d compile --keep-orphan-rpyc;
-            done;
+            export script="$PWD/$(ls *.sh)";
+            compile_group() {
+                IFS=$'\\t' read -ra dirs <<< "$1";
+                for d in "${dirs[@]}"; do
+                    for f in "$d"*.rpy; do
+                        if [[ ! "${f}c" -nt "${f}" ]]; then
+                            bash "$script" "$d" compile --keep-orphan-rpyc || return 1;
+                            break;
+                        fi;
+                    done;
+                done;
+            };
+            export -f compile_group;
+            if [[ -d renpy/common ]]; then
+                compile_group ./renpy/common/ || exit 1;
+            fi;
+            find . -type f -name '*.rpy' -printf '%h/\\n' | LC_ALL=C sort -u |
+                awk 'root != "" && index($0, root) == 1 { printf "\\t%s", $0; next }
+                     { if (root != "") printf "\\n"; root = $0; printf "%s", $0 }
+                     END { if (root != "") printf "\\n" }' |
+                xargs -d '\\n' -r -n1 -P "${FLATPAK_BUILDER_N_JOBS:-$(nproc)}" bash -c 'compile_group "$1"' _ || exit 1;
             popd;
             '''),
 
-        # Recompile all python py files, so we can remove the py files
-        # form the final distribution
+        # Recompile all python py files that were not restored from the
+        # cache, so we can remove the py files form the final distribution
         #
         # Use -f to force the files mtimes to be updated, otherwise
         # flatpak-builder will delete them as "stale"
@@ -125,34 +226,238 @@ def bd_build_commands(description: Description, appid: str) -> typing.List[str]:
         # I have run into a couple of python2 based ren'py programs that lack
         # the python infrastructure to run with -m, so we'll just open code it to
         # make it more portable
+        #
+        # Only the game, renpy, and lib directories are compiled, as those are
+        # the only ones that have their .py files removed later. Only the game
+        # directory is compiled when using the shared runtime.
+        #
+        # The files are split between several compileall processes, as python2
+        # can't compile in parallel, and python3 only does so for directories.
         textwrap.dedent('''
+            work="$PWD/.flatpaker-compile";
             pushd /app/lib/game;
             if [ -d "lib/py3-linux-x86_64" ]; then
-                lib/py3-linux-x86_64/python -m compileall -b -f . || exit 1;
+                compile=(lib/py3-linux-x86_64/python -m compileall -b -f -q);
             else
-                lib/linux-x86_64/python -c 'import compileall; compileall.main()' -f . || exit 1;
+                compile=(lib/linux-x86_64/python -c 'import compileall; compileall.main()' -f -q);
             fi;
+            xargs -0 -r -n 256 -P "${FLATPAK_BUILDER_N_JOBS:-$(nproc)}" "${compile[@]}" < "$work/py-misses" || exit 1;
             popd;
-            ''')
-    ])
+            '''),
+
+        # Save the compiled files so that they can be reused by the next build
+        # of this game
+        textwrap.dedent('''
+            harvest="$PWD/.flatpaker-harvest";
+            work="$PWD/.flatpaker-compile";
+            engine="$(cat "$work/engine")";
+            mkdir -p "$harvest/$engine";
+            pushd /app/lib/game;
+            while read -r sum f; do
+                if [[ -f "${f}c" ]]; then
+                    cp "${f}c" "$harvest/$engine/$sum.${f##*.}c";
+                fi;
+            done < "$work/sums";
+            popd;
+            '''),
+    ]
+
+    if warm_cache:
+        # Ren'Py saves the bytecode and script analysis caches to game/cache
+        # after running the init code, but before handling the command. It
+        # can't write them to /app when the game is run, so without this every
+        # launch is a first launch. The cache names depend on the python the
+        # engine uses, so check for the ones this engine will look for, as a
+        # game that doesn't create them won't benefit from this.
+        #
+        # Shader caches depend on the GPU and driver, and can't be made here.
+        commands.append(textwrap.dedent('''
+            pushd /app/lib/game;
+            if [ -d "lib/py3-linux-x86_64" ]; then
+                version="$(lib/py3-linux-x86_64/python -c 'import sys; print("%d%d" % sys.version_info[:2])')";
+                caches=("bytecode-$version.rpyb" py3analysis.rpyb);
+            else
+                caches=(bytecode.rpyb pyanalysis.rpyb);
+            fi;
+            SDL_VIDEODRIVER=dummy SDL_AUDIODRIVER=dummy bash "$PWD/$(ls *.sh)" "$PWD" compile --keep-orphan-rpyc || exit 1;
+            for c in "${caches[@]}"; do
+                if [[ ! -f "game/cache/$c" && ! -f "game/$c" ]]; then
+                    echo "Ren'Py did not create $c, the startup cache cannot be generated for this game" >&2;
+                    exit 1;
+                fi;
+            done;
+            popd;
+            '''))
+
+    if runtime:
+        commands.append('rm -rf /app/lib/game/renpy /app/lib/game/lib /app/lib/game/*.sh /app/lib/game/*.py')
 
     return commands
 
 
-def write_rules(description: Description, workdir: pathlib.Path, appid: str, desktop_file: pathlib.Path, appdata_file: pathlib.Path) -> None:
+def shared_runtime(description: Description, sources: typing.Dict[str, Archive]) -> typing.Optional[str]:
+    """Find the version of the shared runtime this game can use.
+
+    :param sources: The pinned Ren'Py SDK for each version that has a runtime
+    :return: The Ren'Py version, or None if it cannot be determined or has no
+        runtime
+    """
+    archives = description.get('sources', {}).get('archives', [])
+    if not archives:
+        return None
+    version = archive.detect_engine(archives[0]['path'])[1]
+    return version if version in sources else None
+
+
+def runtime_manifest(source: Archive, version: str,
+                     optimize: typing.Optional[typing.Literal['lossless', 'repack']] = None) -> typing.Dict[str, typing.Any]:
+    """Generate the manifest for a shared runtime, from the Ren'Py SDK of that version.
+
+    The runtime is org.freedesktop.Platform with the engine added, which
+    games using that version of Ren'Py use as their runtime. flatpak-builder
+    also builds a matching Sdk, which isn't needed.
+
+    :param source: The Ren'Py SDK, by url
+    :param optimize: Unused, the engine is already compiled and stripped of
+        other platforms
+    """
+    struct = {
+        'id': f'{RUNTIME_ID}.Sdk',
+        'id-platform': RUNTIME_ID,
+        'branch': version,
+        'runtime': 'org.freedesktop.Platform',
+        'runtime-version': util.RUNTIME_VERSION,
+        'sdk': 'org.freedesktop.Sdk',
+        'build-runtime': True,
+        'separate-locales': False,
+        'build-options': {
+            'no-debuginfo': True,
+            'strip': False
+        },
+        'modules': [
+            {
+                'buildsystem': 'simple',
+                'name': 'renpy',
+                'sources': util.extract_sources(typing.cast('Description', {'sources': {'archives': [source]}})),
+                'build-commands': [
+                    f'mkdir -p {RUNTIME_DIR}',
+                    f'mv renpy renpy.py lib {RUNTIME_DIR}/',
+                    f'rm -rf {RUNTIME_DIR}/lib/*darwin-* {RUNTIME_DIR}/lib/*mac-* {RUNTIME_DIR}/lib/*windows-* {RUNTIME_DIR}/lib/*-i686',
+                    f'''sed -i 's@"~/.renpy/"@os.environ.get("XDG_DATA_HOME", "~/.local/share") + "/"@g' {RUNTIME_DIR}/renpy.py''',
+                    textwrap.dedent(f'''
+                        pushd {RUNTIME_DIR};
+                        if [ -d "lib/py3-linux-x86_64" ]; then
+                            lib/py3-linux-x86_64/python -m compileall -b -f -q -j 0 renpy lib || exit 1;
+                        else
+                            lib/linux-x86_64/python -c 'import compileall; compileall.main()' -f -q renpy lib || exit 1;
+                        fi;
+                        find renpy lib -name '*.py' -delete;
+                        find . -name __pycache__ -print | xargs -n1 rm -rf;
+                        popd;
+                        '''),
+                ],
+            },
+        ],
+    }
+
+    return struct
+
+
+def write_runtime_rules(source: Archive, workdir: pathlib.Path, name: str, version: str,
+                        optimize: typing.Optional[typing.Literal['lossless', 'repack']] = None) -> None:
+    """Write the manifest for a shared runtime.
+
+    See :func:`runtime_manifest`.
+    """
+    util.write_json(workdir / f'{name}.json', runtime_manifest(source, version, optimize))
+
+
+def compile_cache(appid: str) -> pathlib.Path:
+    """Location of the compiled rpyc and pyc files from previous builds of appid."""
+    return util.cache_dir() / 'compiled' / appid
+
+
+def harvest(description: Description, appid: str, builddirs: pathlib.Path) -> None:
+    """Save the compiled files from a finished build into the compile cache.
+
+    :param builddirs: The flatpak-builder directory of kept module build dirs
+    """
+    candidates = sorted(builddirs.glob(f'{COMPILE_MODULE}-*'), key=lambda p: p.stat().st_mtime)
+    if not candidates:
+        return
+    compiled = candidates[-1] / '.flatpaker-harvest'
+    if not compiled.is_dir():
+        return
+
+    # Replace the previous cache entirely, so that files from old versions of
+    # the game or engine don't accumulate
+    cache = compile_cache(appid)
+    shutil.rmtree(cache, ignore_errors=True)
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(compiled.as_posix(), cache.as_posix())
+
+
+def _check_layout(description: Description) -> typing.Optional[typing.Set[str]]:
+    """Check the main archive, and get its top level layout if it can be read."""
+    archives = description.get('sources', {}).get('archives', [])
+    if not archives:
+        return None
+    idx = archive.check_layout(archives[0], ['renpy', 'game', 'lib', '*.sh'])
+    if idx is None:
+        return None
+    return archive.toplevel(idx, archives[0].get('strip_components', 1))
+
+
+def _repack_supported(description: Description) -> bool:
+    """Whether the game is new enough to repack its assets into an archive.
+
+    The index of an archive is a pickle, and python 2 based versions of Ren'Py
+    would load the names in it as unicode rather than str.
+    """
+    archives = description.get('sources', {}).get('archives', [])
+    if not archives:
+        return False
+    version = archive.detect_engine(archives[0]['path'])[1]
+    return version is not None and int(version.split('.')[0]) >= 8
+
+
+def manifest(description: Description, appid: str, desktop_file: GeneratedFile, appdata_file: GeneratedFile,
+             runtime: typing.Optional[str] = None,
+             optimize: typing.Optional[typing.Literal['lossless', 'repack']] = None,
+             warm_cache: bool = False) -> typing.Dict[str, typing.Any]:
+    """Generate the manifest for a game.
+
+    :param runtime: If set, the version of the shared runtime to use instead
+        of shipping the engine. The game is still compiled with its own copy
+        of the engine, which is the same version, and then removes it.
+    :param optimize: If set, how to shrink the game's assets after installing it
+    :param warm_cache: If True generate Ren'Py's startup caches during the build
+    """
+    layout = _check_layout(description)
+    archives = description.get('sources', {}).get('archives', [])
+    icon_files = icons.extract(archives[0]) if archives else {}
     sources = util.extract_sources(description)
 
+    # The small modules that rarely change go first, as a change to any module
+    # invalidates flatpak-builder's cache of every module after it.
+    #
     # TODO: typing requires more thought
     modules: typing.List[typing.Dict[str, typing.Any]] = [
+        bd_game(description, runtime is not None),
+        util.bd_desktop(desktop_file),
+        util.bd_appdata(appdata_file),
+    ]
+    if icon_files:
+        modules.append(util.bd_icons(icon_files, appid))
+    modules.append(
         {
             'buildsystem': 'simple',
             'name': util.sanitize_name(description['common']['name']),
             'sources': sources,
-            'build-commands': bd_build_commands(description, appid),
+            'build-commands': bd_build_commands(description, appid, layout, not icon_files),
             'cleanup': [
                 '*.exe',
                 '*.app',
-                '*.rpyc.bak',
                 '*.txt',
                 '*.rpy',
                 '/lib/game/lib/*darwin-*',
@@ -160,22 +465,46 @@ def write_rules(description: Description, workdir: pathlib.Path, appid: str, des
                 '/lib/game/lib/*-i686',
             ],
         },
-    ]
-    modules.extend([
-        bd_game(description),
-        util.bd_desktop(desktop_file),
-        util.bd_appdata(appdata_file),
-    ])
+    )
+
+    # The compile cache is replaced after every build, so it is only a source
+    # of this module, and not of the one that installs the game
+    cache = compile_cache(appid)
+    modules.append(
+        {
+            'buildsystem': 'simple',
+            'name': COMPILE_MODULE,
+            'sources': [
+                {
+                    'type': 'dir',
+                    'path': cache.as_posix(),
+                    'dest': '.flatpaker-compile-cache',
+                },
+            ] if cache.is_dir() else [],
+            'build-commands': bd_compile_commands(runtime is not None, warm_cache),
+            # Only files written by this module are matched
+            'cleanup': ['*.rpyc.bak'],
+        },
+    )
+    if optimize is not None:
+        repack = optimize == 'repack' and _repack_supported(description)
+        modules.append(util.bd_optimize('/app/lib/game/game' if repack else None))
 
     if description.get('workarounds', {}).get('use_x11', True):
         finish_args = ['--socket=x11']
     else:
         finish_args = ['--socket=wayland', '--socket=fallback-x11']
 
+    # The custom Sdk is only needed for the tools to extract icons
+    sdk = 'com.github.dcbaker.flatpaker.Sdk//master' if not icon_files else 'org.freedesktop.Sdk'
+    if runtime is not None and '//' not in sdk:
+        # Otherwise the Sdk would have the runtime's version
+        sdk = f'{sdk}//{util.RUNTIME_VERSION}'
+
     struct = {
-        'sdk': 'com.github.dcbaker.flatpaker.Sdk//master',
-        'runtime': 'org.freedesktop.Platform',
-        'runtime-version': util.RUNTIME_VERSION,
+        'sdk': sdk,
+        'runtime': RUNTIME_ID if runtime is not None else 'org.freedesktop.Platform',
+        'runtime-version': runtime if runtime is not None else util.RUNTIME_VERSION,
         'id': appid,
         'build-options': {
             'no-debuginfo': True,
@@ -191,11 +520,24 @@ def write_rules(description: Description, workdir: pathlib.Path, appid: str, des
         'modules': modules,
         'cleanup-commands': [
             "find /app/lib/game/game -name '*.py' -delete",
-            "find /app/lib/game/lib -name '*.py' -delete",
-            "find /app/lib/game/renpy -name '*.py' -delete",
+            *([] if runtime is not None else [
+                "find /app/lib/game/lib -name '*.py' -delete",
+                "find /app/lib/game/renpy -name '*.py' -delete",
+            ]),
             'find /app/lib/game -name __pycache__ -print | xargs -n1 rm -vrf',
         ]
     }
 
-    with (pathlib.Path(workdir) / f'{appid}.json').open('w') as f:
-        json.dump(struct, f, indent=4)
+    return struct
+
+
+def write_rules(description: Description, workdir: pathlib.Path, appid: str, desktop_file: pathlib.Path, appdata_file: pathlib.Path,
+                runtime: typing.Optional[str] = None,
+                optimize: typing.Optional[typing.Literal['lossless', 'repack']] = None,
+                warm_cache: bool = False) -> None:
+    """Write the manifest for a game.
+
+    See :func:`manifest` for the options.
+    """
+    struct = manifest(description, appid, desktop_file, appdata_file, runtime=runtime, optimize=optimize, warm_cache=warm_cache)
+    util.write_json(pathlib.Path(workdir) / f'{appid}.json', struct)
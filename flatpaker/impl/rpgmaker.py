@@ -2,21 +2,255 @@
 # Copyright © 2022-2024 Dylan Baker
 
 from __future__ import annotations
-import json
+import fnmatch
+import hashlib
 import pathlib
+import shlex
 import typing
 
-from flatpaker import util
+from flatpaker import archive, assets, fetch, util
 
 if typing.TYPE_CHECKING:
-    from flatpaker.description import Description
+    from flatpaker.description import Archive, Description
+    from flatpaker.util import GeneratedFile
 
 
-def write_rules(description: Description, workdir: pathlib.Path, appid: str, desktop_file: pathlib.Path, appdata_file: pathlib.Path) -> None:
+# The runtime that holds a shared nw.js, and where nw.js is in it
+RUNTIME_ID = 'com.github.dcbaker.flatpaker.NWjs'
+RUNTIME_DIR = '/usr/lib/nwjs'
+
+# The top level files of the nw.js that RPGMaker ships, everything else is the
+# game
+_NWJS_FILES = [
+    'nw', 'lib', 'locales', 'swiftshader', 'chrome_crashpad_handler', 'nacl_*', 'credits.html',
+    'vk_swiftshader_icd.json', '*.pak', '*.so', '*.so.*', '*.bin', '*.dat',
+]
+
+# Helpers that aren't executable in the archive, and seem to only exist for
+# RPGMaker MZ, not MV
+_HELPERS = ['chrome_crashpad_handler', 'nacl_helper']
+
+
+def _check_layout(description: Description) -> typing.Optional[typing.Set[str]]:
+    """Check the main archive, and get its top level layout if it can be read."""
+    archives = description.get('sources', {}).get('archives', [])
+    if not archives:
+        return None
+    idx = archive.check_layout(archives[0], ['nw', 'icon'])
+    if idx is None:
+        return None
+    return archive.toplevel(idx, archives[0].get('strip_components', 1))
+
+
+def _nwjs_files(top: typing.Iterable[str]) -> typing.List[str]:
+    return sorted(t for t in top if any(fnmatch.fnmatchcase(t, p) for p in _NWJS_FILES))
+
+
+def _prune_locales(nwjs: str) -> str:
+    """A command to remove every nw.js locale other than en-US.
+
+    Chromium falls back to en-US, and the locales only translate the
+    browser's own messages.
+    """
+    return f"if [ -d {nwjs}/locales ]; then find {nwjs}/locales -type f ! -name 'en-US.*' -delete; fi"
+
+
+def nwjs_digest(a: Archive) -> typing.Optional[str]:
+    """Identify the build of nw.js in an archive.
+
+    nw.js doesn't record its version in a file, and reading it from the
+    binaries would mean decompressing most of the archive, so this is a
+    digest of the names and sizes of the nw.js files, from the archive's index.
+    Archives with the same build of nw.js get the same digest, whether it
+    was shipped with a game or is a release of nw.js.
+
+    :return: The digest, or None if the archive cannot be inspected or has no
+        nw.js
+    """
+    idx = archive.index(a['path'])
+    if idx is None:
+        return None
+    sizes = archive.member_sizes(idx, a.get('strip_components', 1))
+    files = set(_nwjs_files({m.split('/', 1)[0] for m in sizes}))
+    if 'nw' not in files:
+        return None
+
+    h = hashlib.sha256()
+    for name, size in sorted(sizes.items()):
+        if name.split('/', 1)[0] in files:
+            h.update(f'{name}\0{size}\0'.encode())
+    return h.hexdigest()[:16]
+
+
+def shared_runtime(description: Description, sources: typing.Dict[str, Archive]) -> typing.Optional[str]:
+    """Find the version of the shared nw.js runtime this game can use.
+
+    The game removes its own nw.js when it uses the runtime, so it is only
+    used if its nw.js has the same :func:`nwjs_digest` as the one the runtime
+    is built from. The pinned builds of nw.js are downloaded to check this.
+
+    :param sources: The pinned nw.js for each version that has a runtime
+    :return: The version, or None if the archive cannot be inspected or no
+        runtime has the same nw.js
+    :raises ValueError: If a pinned nw.js cannot be downloaded
+    """
+    archives = description.get('sources', {}).get('archives', [])
+    if not archives or not sources:
+        return None
+    digest = nwjs_digest(archives[0])
+    if digest is None:
+        return None
+    fetch.fetch([typing.cast('Description', {'sources': {'archives': list(sources.values())}})])
+    for version, source in sorted(sources.items()):
+        if nwjs_digest(source) == digest:
+            return version
+    return None
+
+
+def runtime_manifest(source: Archive, version: str,
+                     optimize: typing.Optional[typing.Literal['lossless', 'repack']] = None) -> typing.Dict[str, typing.Any]:
+    """Generate the manifest for a shared nw.js runtime, from the pinned build of it.
+
+    The runtime is org.freedesktop.Platform with nw.js added, which games
+    using that build of nw.js use as their runtime. flatpak-builder also
+    builds a matching Sdk, which isn't needed.
+
+    :param source: A release of nw.js, by url
+    :param optimize: If set, remove the nw.js locales other than en-US
+    """
+    idx = archive.index(source['path'])
+    if idx is None:
+        raise ValueError(f"Could not read {source['path']}")
+    strip = source.get('strip_components', 1)
+    files = _nwjs_files(archive.toplevel(idx, strip))
+
+    struct = {
+        'id': f'{RUNTIME_ID}.Sdk',
+        'id-platform': RUNTIME_ID,
+        'branch': version,
+        'runtime': 'org.freedesktop.Platform',
+        'runtime-version': util.RUNTIME_VERSION,
+        'sdk': 'org.freedesktop.Sdk',
+        'build-runtime': True,
+        'separate-locales': False,
+        'build-options': {
+            'no-debuginfo': True,
+            'strip': False
+        },
+        'modules': [
+            {
+                'buildsystem': 'simple',
+                'name': 'nwjs',
+                'sources': util.extract_sources(typing.cast('Description', {'sources': {'archives': [source]}})),
+                'build-commands': [
+                    f'mkdir -p {RUNTIME_DIR}',
+                    f'mv {" ".join(shlex.quote(f) for f in files)} {RUNTIME_DIR}/',
+                    *[f'chmod +x {RUNTIME_DIR}/{f}' for f in ['nw', *_HELPERS] if f in files],
+                    *([_prune_locales(RUNTIME_DIR)] if optimize is not None else []),
+                ],
+            },
+        ],
+    }
+
+    return struct
+
+
+def write_runtime_rules(source: Archive, workdir: pathlib.Path, name: str, version: str,
+                        optimize: typing.Optional[typing.Literal['lossless', 'repack']] = None) -> None:
+    """Write the manifest for a shared runtime.
+
+    See :func:`runtime_manifest`.
+    """
+    util.write_json(workdir / f'{name}.json', runtime_manifest(source, version, optimize))
+
+
+def _bd_unused_assets(description: Description) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """Remove the assets of the game that are never referenced.
+
+    These can number in the tens of thousands, so they are listed in a file
+    rather than the manifest.
+    """
+    sources = description.get('sources', {})
+    # Extra files and patches could add references that the archive doesn't
+    # have, so don't guess
+    if not sources.get('archives') or sources.get('files') or sources.get('patches'):
+        return None
+    keep = description.get('workarounds', {}).get('keep_assets', [])
+    unused = assets.unused_list(sources['archives'][0], keep, '/app/lib/game/')
+    if unused is None:
+        return None
+    return {
+        'buildsystem': 'simple',
+        'name': 'unused_assets',
+        'sources': [
+            {
+                'path': unused.as_posix(),
+                'sha256': util.sha256(unused),
+                'type': 'file',
+                'dest-filename': 'unused.lst',
+            },
+        ],
+        'build-commands': ['xargs -0 rm -f -- < unused.lst'],
+    }
+
+
+def manifest(description: Description, appid: str, desktop_file: GeneratedFile, appdata_file: GeneratedFile,
+             runtime: typing.Optional[str] = None,
+             optimize: typing.Optional[typing.Literal['lossless', 'repack']] = None) -> typing.Dict[str, typing.Any]:
+    """Generate the manifest for a game.
+
+    :param runtime: If set, the version of the shared nw.js runtime to use
+        instead of shipping nw.js
+    :param optimize: If set, how to shrink the game's assets after installing
+        it. This also removes every nw.js locale other than en-US, when
+        nw.js is shipped with the game, and :func:`runtime_manifest` does
+        the same for the shared runtime. RPGMaker has no archive format, so
+        instead repacking removes the images, audio, and movies that the game
+        never refers to.
+    """
+    layout = _check_layout(description)
     sources = util.extract_sources(description)
 
+    if runtime is not None:
+        # shared_runtime only finds a version when the layout can be read, and
+        # the runtime has the same nw.js
+        assert layout is not None, 'for mypy'
+        nwjs = [f'rm -rf {" ".join(shlex.quote(f) for f in _nwjs_files(layout))}']
+        exe = f'{RUNTIME_DIR}/nw /app/lib/game'
+    else:
+        # Only check for these at build time if the archive can't be inspected
+        if layout is None:
+            make_executable = [f'[[ -f "{h}" ]] && chmod +x {h}' for h in _HELPERS]
+        else:
+            make_executable = [f'chmod +x {h}' for h in _HELPERS if h in layout]
+        nwjs = [
+            # the main executable usually isn't executable
+            'chmod +x nw',
+
+            # Likewise, but seem to only exist for RPGMaker MZ, not MV
+            *make_executable,
+        ]
+        if optimize is not None:
+            nwjs.append(_prune_locales('.'))
+        exe = '/app/lib/game/nw'
+
+    # The small modules that rarely change go first, as a change to any module
+    # invalidates flatpak-builder's cache of every module after it.
+    #
     # TODO: typing requires more thought
     modules: typing.List[typing.Dict[str, typing.Any]] = [
+        {
+            'buildsystem': 'simple',
+            'name': 'game_sh',
+            'sources': [],
+            'build-commands': [
+                'mkdir -p /app/bin',
+                f'echo  \'exec {exe}\' > /app/bin/game.sh',
+                'chmod +x /app/bin/game.sh',
+            ],
+        },
+        util.bd_desktop(desktop_file),
+        util.bd_appdata(appdata_file),
         {
             'buildsystem': 'simple',
             'name': util.sanitize_name(description['common']['name']),
@@ -26,12 +260,7 @@ def write_rules(description: Description, workdir: pathlib.Path, appid: str, des
                 f'mv icon/*.png /app/share/icons/hicolor/256x256/apps/{appid}.png',
                 'rm -r icon',
 
-                # the main executable usually isn't executable
-                'chmod +x nw',
-
-                # Likewise, but seem to only exist for RPGMaker MZ, not MV
-                '[[ -f "chrome_crashpad_handler" ]] && chmod +x chrome_crashpad_handler',
-                '[[ -f "nacl_helper" ]] && chmod +x nacl_helper',
+                *nwjs,
 
                 # install the main game files
                 'mkdir -p /app/lib/game',
@@ -41,25 +270,20 @@ def write_rules(description: Description, workdir: pathlib.Path, appid: str, des
                 '*.desktop',  # is incorrect
             ],
         },
-        {
-            'buildsystem': 'simple',
-            'name': 'game_sh',
-            'sources': [],
-            'build-commands': [
-                'mkdir -p /app/bin',
-                'echo  \'exec /app/lib/game/nw\' > /app/bin/game.sh',
-                'chmod +x /app/bin/game.sh',
-            ],
-        },
-        util.bd_desktop(desktop_file),
-        util.bd_appdata(appdata_file),
     ]
+    if optimize == 'repack':
+        unused = _bd_unused_assets(description)
+        if unused is not None:
+            modules.append(unused)
+    if optimize is not None:
+        modules.append(util.bd_optimize())
 
     # TODO: share this somehow?
     struct = {
-        'sdk': 'org.freedesktop.Sdk',
-        'runtime': 'org.freedesktop.Platform',
-        'runtime-version': util.RUNTIME_VERSION,
+        # Otherwise the Sdk would have the version of the shared runtime
+        'sdk': f'org.freedesktop.Sdk//{util.RUNTIME_VERSION}' if runtime is not None else 'org.freedesktop.Sdk',
+        'runtime': RUNTIME_ID if runtime is not None else 'org.freedesktop.Platform',
+        'runtime-version': runtime if runtime is not None else util.RUNTIME_VERSION,
         'id': appid,
         'build-options': {
             'no-debuginfo': True,
@@ -74,5 +298,15 @@ def write_rules(description: Description, workdir: pathlib.Path, appid: str, des
         'modules': modules,
     }
 
-    with (pathlib.Path(workdir) / f'{appid}.json').open('w') as f:
-        json.dump(struct, f)
+    return struct
+
+
+def write_rules(description: Description, workdir: pathlib.Path, appid: str, desktop_file: pathlib.Path, appdata_file: pathlib.Path,
+                runtime: typing.Optional[str] = None,
+                optimize: typing.Optional[typing.Literal['lossless', 'repack']] = None) -> None:
+    """Write the manifest for a game.
+
+    See :func:`manifest` for the options.
+    """
+    struct = manifest(description, appid, desktop_file, appdata_file, runtime=runtime, optimize=optimize)
+    util.write_json(pathlib.Path(workdir) / f'{appid}.json', struct)
@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Losslessly shrink the assets of an installed game.
+
+This is run inside of the flatpak build sandbox, by the Sdk's python, so it
+must only use the standard library, and must not import the rest of flatpaker.
+"""
+
+from __future__ import annotations
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import pickle
+import struct
+import sys
+import typing
+import zlib
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Loose files that Ren'Py can load from an archive just as well. Scripts,
+# python, and fonts are left alone, as games often read those directly.
+_RPA_EXTENSIONS = frozenset({
+    '.png', '.jpg', '.jpeg', '.webp', '.avif',
+    '.ogg', '.opus', '.mp3', '.wav', '.flac',
+})
+_RPA_NAME = 'flatpaker'
+
+# The extensions of the archives Ren'Py loads from the game directory
+_RPA_ARCHIVES = ('.rpa', '.rpi')
+
+
+def disk_usage(root: str) -> int:
+    """The size of a tree on disk, counting hardlinked files once."""
+    seen: typing.Set[typing.Tuple[int, int]] = set()
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for f in filenames:
+            st = os.lstat(os.path.join(dirpath, f))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def _files(root: str) -> typing.Iterator[str]:
+    for dirpath, _, filenames in os.walk(root):
+        for f in filenames:
+            p = os.path.join(dirpath, f)
+            if not os.path.islink(p):
+                yield p
+
+
+def _replace(path: str, data: bytes) -> None:
+    tmp = f'{path}.flatpaker-tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp, os.stat(path).st_mode)
+    os.replace(tmp, path)
+
+
+def _chunks(data: bytes) -> typing.Iterator[typing.Tuple[bytes, bytes]]:
+    offset = len(_PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, = struct.unpack_from('>I', data, offset)
+        yield data[offset + 4:offset + 8], data[offset + 8:offset + 8 + length]
+        offset += length + 12
+
+
+def _chunk(type_: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I', len(payload)) + type_ + payload + struct.pack('>I', zlib.crc32(type_ + payload))
+
+
+def recompress_png(path: str) -> bool:
+    """Recompress the image data of a png at the highest zlib level.
+
+    The pixels, filters, and every other chunk are kept exactly as they were,
+    only the deflate stream changes, so this is lossless.
+
+    :return: True if the file was made smaller
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(_PNG_SIGNATURE):
+        return False
+
+    try:
+        chunks = list(_chunks(data))
+        raw = zlib.decompress(b''.join(p for t, p in chunks if t == b'IDAT'))
+    except (struct.error, zlib.error):
+        return False
+
+    best: typing.Optional[bytes] = None
+    for strategy in [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]:
+        c = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        candidate = c.compress(raw) + c.flush()
+        if best is None or len(candidate) < len(best):
+            best = candidate
+    assert best is not None, 'for mypy'
+
+    out = [_PNG_SIGNATURE]
+    written = False
+    for t, p in chunks:
+        if t != b'IDAT':
+            out.append(_chunk(t, p))
+        elif not written:
+            out.append(_chunk(t, best))
+            written = True
+    new = b''.join(out)
+    if len(new) >= len(data):
+        return False
+
+    _replace(path, new)
+    return True
+
+
+def rpa_name(game: str) -> str:
+    """Find a name for the archive that loose assets are moved into.
+
+    Ren'Py looks for a file in the loose files first, and then in each archive
+    in reverse sorted order of their names. The archive is named so that it
+    sorts after every existing archive, so the files moved into it still
+    override the same files in those, as they did when they were loose.
+    """
+    existing = [os.path.splitext(f)[0] for f in os.listdir(game) if f.lower().endswith(_RPA_ARCHIVES)]
+    name = _RPA_NAME
+    if existing and max(existing) >= name:
+        name = f'{max(existing)}_{_RPA_NAME}'
+    return f'{name}.rpa'
+
+
+def repack(game: str) -> int:
+    """Move loose assets in a Ren'Py game directory into an RPA-3.0 archive.
+
+    :return: The number of files moved into the archive
+    """
+    archive = rpa_name(game)
+    names = sorted(
+        os.path.relpath(p, game).replace(os.sep, '/') for p in _files(game)
+        if os.path.splitext(p)[1].lower() in _RPA_EXTENSIONS)
+    if not names:
+        return 0
+
+    # The offsets and lengths in the index are xored with a key, this archive
+    # doesn't need obfuscation, so a key of 0 is used.
+    # Identical files are only stored once.
+    header = 'RPA-3.0 {:016x} {:08x}\n'
+    index: typing.Dict[str, typing.List[typing.Tuple[int, int, bytes]]] = {}
+    stored: typing.Dict[str, typing.Tuple[int, int, bytes]] = {}
+    with open(os.path.join(game, archive), 'wb') as f:
+        f.write(header.format(0, 0).encode())
+        for name in names:
+            p = os.path.join(game, name)
+            with open(p, 'rb') as asset:
+                data = asset.read()
+            digest = hashlib.sha256(data).hexdigest()
+            if digest not in stored:
+                stored[digest] = (f.tell(), len(data), b'')
+                f.write(data)
+            index[name] = [stored[digest]]
+        offset = f.tell()
+        f.write(zlib.compress(pickle.dumps(index, 2), 9))
+        f.seek(0)
+        f.write(header.format(offset, 0).encode())
+
+    for name in names:
+        os.unlink(os.path.join(game, name))
+    for dirpath, dirnames, filenames in os.walk(game, topdown=False):
+        if not dirnames and not filenames and dirpath != game:
+            os.rmdir(dirpath)
+
+    return len(names)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', help='The installed game')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='How many files to work on at once')
+    parser.add_argument('--rpa', action='store', help="A Ren'Py game directory to pack loose assets into an archive in")
+    args = parser.parse_args()
+
+    before = disk_usage(args.root)
+
+    # zlib releases the GIL, so threads are enough
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+        pngs = [p for p in _files(args.root) if p.lower().endswith('.png')]
+        recompressed = sum(executor.map(recompress_png, pngs))
+        packed = repack(args.rpa) if args.rpa else 0
+
+    # This line is read by the build report
+    print(f'flatpaker-optimize: saved {before - disk_usage(args.root)} bytes '
+          f'({recompressed} of {len(pngs)} png files recompressed, '
+          f'{packed} files packed)')
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Maintenance of the repo that flatpaks are exported to.
+
+This generates static deltas, so that users only download what changed in an
+update, and prunes old commits.
+"""
+
+from __future__ import annotations
+import base64
+import concurrent.futures
+import os
+import pathlib
+import shutil
+import subprocess
+import typing
+
+from . import util
+
+if typing.TYPE_CHECKING:
+    from .config import Repo
+    from .entry import BaseArguments
+
+
+class Policy(typing.NamedTuple):
+
+    """How much history to keep, and how many deltas to generate."""
+
+    history: int
+    deltas: int
+    delta_memory: int
+
+    @classmethod
+    def from_config(cls, config: Repo) -> Policy:
+        return cls(
+            config.get('history', 3),
+            config.get('deltas', 1),
+            util.parse_size(config.get('delta-memory', '2G')),
+        )
+
+
+def refs(repo: pathlib.Path) -> typing.Dict[str, str]:
+    """Get every ref in the repo, and the commit it points to."""
+    heads = repo / 'refs' / 'heads'
+    return {
+        p.relative_to(heads).as_posix(): p.read_text().strip()
+        for p in sorted(heads.glob('**/*'))
+        if p.is_file() and p.relative_to(heads).parts[0] in {'app', 'runtime'}
+    }
+
+
+def _b64(checksum: str) -> str:
+    # ostree's "modified base64", which can be used in paths
+    return base64.b64encode(bytes.fromhex(checksum)).decode().rstrip('=').replace('/', '_')
+
+
+def _hex(b64: str) -> str:
+    return base64.b64decode(b64.replace('_', '/') + '=').hex()
+
+
+def deltas(repo: pathlib.Path) -> typing.Dict[str, typing.Dict[typing.Optional[str], int]]:
+    """Find the static deltas in a repo, and their download sizes.
+
+    :return: A mapping of target commits, to the commits that deltas start
+        from (None for a delta from nothing), to the size of that delta
+    """
+    found: typing.Dict[str, typing.Dict[typing.Optional[str], int]] = {}
+    root = repo / 'deltas'
+    if not root.is_dir():
+        return found
+    for prefix in root.iterdir():
+        for d in prefix.iterdir():
+            if not (d / 'superblock').exists():
+                continue
+            name = prefix.name + d.name
+            if '-' in name:
+                from_, to = name.split('-', 1)
+                found.setdefault(_hex(to), {})[_hex(from_)] = util.disk_usage(d)
+            else:
+                found.setdefault(_hex(name), {})[None] = util.disk_usage(d)
+    return found
+
+
+def _delta_path(repo: pathlib.Path, from_: str, to: str) -> pathlib.Path:
+    name = f'{_b64(from_)}-{_b64(to)}'
+    return repo / 'deltas' / name[:2] / name[2:]
+
+
+def _history(repo: pathlib.Path, ref: str, depth: int) -> typing.List[str]:
+    """Get up to depth commits of a ref, newest first."""
+    commits: typing.List[str] = []
+    for i in range(depth):
+        proc = subprocess.run(['ostree', 'rev-parse', f'--repo={repo}', f'{ref}{"^" * i}'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        if proc.returncode != 0:
+            break
+        commits.append(proc.stdout.strip())
+    return commits
+
+
+def delta_jobs(memory: int) -> int:
+    """How many deltas can be generated at once, given how much memory each needs."""
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return 1
+    return max(1, min(os.cpu_count() or 1, available // memory))
+
+
+def _older_deltas(repo: pathlib.Path, policy: Policy, jobs: int) -> None:
+    """Generate deltas to the newest commit of each ref from older commits.
+
+    flatpak only generates deltas from the previous commit, so these cover
+    users who have skipped updates.
+    """
+    if policy.deltas < 2:
+        return
+    if shutil.which('ostree') is None:
+        print('ostree is not installed, so only deltas from the previous commit will be generated')
+        return
+
+    commands: typing.List[typing.List[str]] = []
+    for ref, newest in refs(repo).items():
+        for old in _history(repo, ref, policy.deltas + 1)[2:]:
+            if not _delta_path(repo, old, newest).exists():
+                commands.append(['ostree', 'static-delta', 'generate', f'--repo={repo}',
+                                 f'--from={old}', f'--to={newest}'])
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        for f in [executor.submit(subprocess.run, c, check=True) for c in commands]:
+            f.result()
+
+
+def maintain(args: BaseArguments, policy: Policy) -> None:
+    """Generate deltas, prune old commits, and update the summary of the repo.
+
+    :raises subprocess.CalledProcessError: If any command fails
+    """
+    repo = pathlib.Path(args.repo)
+    jobs = delta_jobs(policy.delta_memory)
+    _older_deltas(repo, policy, jobs)
+
+    command = [
+        'flatpak', 'build-update-repo',
+        '--generate-static-deltas', f'--static-delta-jobs={jobs}',
+        '--prune', f'--prune-depth={policy.history - 1}',
+    ]
+    if args.gpg:
+        command.append(f'--gpg-sign={args.gpg}')
+    command.append(repo.as_posix())
+    subprocess.run(command, check=True)
+
+
+def _human(size: int) -> str:
+    value = float(size)
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if value < 1024:
+            break
+        value /= 1024
+    else:
+        unit = 'TiB'
+    return f'{value:.1f} {unit}'
+
+
+def print_sizes(repo: pathlib.Path) -> None:
+    """Print how much a user needs to download to update each ref."""
+    available = deltas(repo)
+    for ref, newest in refs(repo).items():
+        print(ref)
+        sizes = available.get(newest, {})
+        if not sizes:
+            print('  no deltas, updates download changed files individually')
+        for from_, size in sorted(sizes.items(), key=lambda x: x[1]):
+            print(f'  from {from_[:12] if from_ else "nothing"}: {_human(size)}')
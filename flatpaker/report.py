@@ -0,0 +1,223 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Collect timing and size information about builds.
+
+Nothing is collected unless `enable` has been called, and when disabled every
+function here costs no more than a check of a global.
+
+This also keeps track of the commands that are running for each title, so that
+they can be cancelled.
+"""
+
+from __future__ import annotations
+import contextlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+
+    class Phase(typing.TypedDict):
+
+        wall: float
+        cpu: float
+
+    class Title(typing.TypedDict, total=False):
+
+        description: str
+        phases: typing.Dict[str, Phase]
+        modules: typing.Dict[str, float]
+        installed_size: int
+        repo_delta_size: int
+        optimize_saved_size: int
+
+
+_TITLES: typing.Optional[typing.Dict[str, Title]] = None
+_LOCK = threading.Lock()
+_START = 0.0
+
+# Commands that can be cancelled, by title
+_RUNNING: typing.Dict[str, subprocess.Popen[str]] = {}
+
+# Lines that flatpak-builder prints when it moves from one module or stage to
+# the next
+_MODULE = re.compile(r'^Building module (\S+) in ')
+_STAGES = ('Building module ', 'Cleaning up', 'Finishing app', 'Exporting ')
+
+# Printed by the asset optimizer inside the build
+_OPTIMIZED = re.compile(r'^flatpaker-optimize: saved (-?\d+) bytes')
+
+# Printed by flatpak build-export, which flatpak-builder runs to export. This
+# is the size of the objects that weren't already in the repo.
+_EXPORTED = re.compile(r'^Content Bytes Written: (\d+)')
+
+
+def enable() -> None:
+    global _TITLES, _START
+    _TITLES = {}
+    _START = time.perf_counter()
+
+
+def enabled() -> bool:
+    return _TITLES is not None
+
+
+def _title(title: str) -> Title:
+    assert _TITLES is not None, 'should only be called when enabled'
+    return _TITLES.setdefault(title, {})
+
+
+def record(title: str, key: typing.Literal['description', 'installed_size', 'repo_delta_size', 'optimize_saved_size'],
+           value: typing.Union[str, int]) -> None:
+    """Record a single value about a title."""
+    if _TITLES is None:
+        return
+    with _LOCK:
+        _title(title)[key] = value  # type: ignore[literal-required]
+
+
+def _record_phase(title: str, name: str, wall: float, cpu: float) -> None:
+    with _LOCK:
+        phases = _title(title).setdefault('phases', {})
+        # A phase may happen more than once, such as hashing
+        prev = phases.get(name, {'wall': 0.0, 'cpu': 0.0})
+        phases[name] = {'wall': prev['wall'] + wall, 'cpu': prev['cpu'] + cpu}
+
+
+class Timer:
+
+    """Measure the wall and CPU time of the current thread.
+
+    Started on creation, and recorded with `stop`.
+    """
+
+    def __init__(self) -> None:
+        self.wall = time.perf_counter() if _TITLES is not None else 0.0
+        self.cpu = time.thread_time() if _TITLES is not None else 0.0
+
+    def stop(self, title: str, name: str) -> None:
+        if _TITLES is None:
+            return
+        _record_phase(title, name, time.perf_counter() - self.wall, time.thread_time() - self.cpu)
+
+
+@contextlib.contextmanager
+def phase(title: str, name: str) -> typing.Iterator[None]:
+    """Record the time spent in a block."""
+    if _TITLES is None:
+        yield
+        return
+    timer = Timer()
+    yield
+    timer.stop(title, name)
+
+
+def cancel(title: str) -> bool:
+    """Stop the cancellable command running for a title, if there is one.
+
+    The `run` call running that command raises CalledProcessError.
+
+    :return: True if a command was stopped
+    """
+    with _LOCK:
+        proc = _RUNNING.get(title)
+        if proc is None:
+            return False
+        proc.terminate()
+        return True
+
+
+@contextlib.contextmanager
+def _cancellable(title: str, proc: subprocess.Popen[str], cancellable: bool) -> typing.Iterator[None]:
+    if not cancellable:
+        yield
+        return
+    with _LOCK:
+        _RUNNING[title] = proc
+    try:
+        yield
+    finally:
+        with _LOCK:
+            del _RUNNING[title]
+
+
+def run(title: str, name: str, command: typing.List[str], cancellable: bool = False,
+        exports: bool = False) -> None:
+    """Run a command, recording how long it takes.
+
+    For flatpak-builder, the time spent downloading, and building each module
+    is recorded as well, by watching its output.
+
+    :param cancellable: If True the command may be stopped with `cancel`
+    :param exports: If True the command exports to the repo, and how much the
+        repo grew is recorded from its output
+    :raises subprocess.CalledProcessError: If the command fails
+    """
+    if _TITLES is None:
+        if not cancellable:
+            subprocess.run(command, check=True)
+            return
+        with subprocess.Popen(command, text=True) as p, _cancellable(title, p, cancellable):
+            p.wait()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, command)
+        return
+
+    start = time.perf_counter()
+    modules: typing.Dict[str, float] = {}
+    current: typing.Optional[str] = None
+    mark = start
+    first = True
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True, errors='replace', bufsize=1)
+    assert proc.stdout is not None, 'for mypy'
+    with _cancellable(title, proc, cancellable):
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            saved = _OPTIMIZED.match(line)
+            if saved:
+                record(title, 'optimize_saved_size', int(saved.group(1)))
+            exported = _EXPORTED.match(line) if exports else None
+            if exported:
+                record(title, 'repo_delta_size', int(exported.group(1)))
+            if line.startswith(_STAGES):
+                now = time.perf_counter()
+                if current is not None:
+                    modules[current] = modules.get(current, 0.0) + now - mark
+                elif first and _MODULE.match(line):
+                    # Everything before the first module is fetching and
+                    # extracting sources
+                    _record_phase(title, f'{name}:download', now - start, 0.0)
+                first = False
+                m = _MODULE.match(line)
+                current = m.group(1) if m else None
+                mark = now
+
+    # Use wait4 to get the CPU time of this child, as getrusage can't tell
+    # apart children of different threads
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    _record_phase(title, name, time.perf_counter() - start, usage.ru_utime + usage.ru_stime)
+    if modules:
+        with _LOCK:
+            _title(title).setdefault('modules', {}).update(modules)
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+def write(path: str) -> None:
+    """Write the collected information to a json file."""
+    assert _TITLES is not None, 'should only be called when enabled'
+    with open(path, 'w') as f:
+        json.dump({
+            'wall': time.perf_counter() - _START,
+            'titles': _TITLES,
+        }, f, indent=4, sort_keys=True)
@@ -0,0 +1,151 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Validation of descriptions against flatpaker.schema.json.
+
+This implements the subset of json schema that the schema uses. The schema is
+compiled into a tree of closures once, so validating a description doesn't
+need to walk the schema again.
+"""
+
+from __future__ import annotations
+import functools
+import importlib.resources
+import json
+import typing
+
+Validator = typing.Callable[[object, str], typing.Iterator[str]]
+
+# Keywords that only document the schema
+_ANNOTATIONS = frozenset({'$schema', '$id', '$defs', 'title', 'description'})
+
+_TYPES: typing.Dict[str, typing.Tuple[type, ...]] = {
+    'string': (str, ),
+    'number': (int, float),
+    'integer': (int, ),
+    'boolean': (bool, ),
+    'object': (dict, ),
+    'array': (list, ),
+}
+
+
+def _where(path: str) -> str:
+    return path or 'the top level'
+
+
+def _compile(schema: typing.Dict[str, typing.Any], root: typing.Dict[str, typing.Any]) -> Validator:
+    """Compile a schema into a function that yields each error in an instance.
+
+    :raises ValueError: If the schema uses a keyword that isn't implemented
+    """
+    unknown = set(schema) - _ANNOTATIONS - {
+        '$ref', 'type', 'enum', 'properties', 'required', 'additionalProperties', 'items', 'oneOf'}
+    if unknown:
+        raise ValueError(f'schema keywords are not supported: {", ".join(sorted(unknown))}')
+
+    checks: typing.List[Validator] = []
+
+    if '$ref' in schema:
+        target: typing.Any = root
+        for part in schema['$ref'].lstrip('#/').split('/'):
+            target = target[part]
+        # Resolve the reference lazily, so that a recursive reference doesn't
+        # compile forever
+        ref: typing.List[Validator] = []
+
+        def check_ref(instance: object, path: str) -> typing.Iterator[str]:
+            if not ref:
+                ref.append(_compile(target, root))
+            yield from ref[0](instance, path)
+
+        checks.append(check_ref)
+
+    if 'type' in schema:
+        name = schema['type']
+        types = _TYPES[name]
+
+        def check_type(instance: object, path: str) -> typing.Iterator[str]:
+            # bool is a subclass of int, but not a number in json
+            if not isinstance(instance, types) or (isinstance(instance, bool) and name != 'boolean'):
+                yield f'{_where(path)}: expected a {name}, not {instance!r}'
+
+        checks.append(check_type)
+
+    if 'enum' in schema:
+        values = schema['enum']
+
+        def check_enum(instance: object, path: str) -> typing.Iterator[str]:
+            if instance not in values:
+                yield f'{_where(path)}: {instance!r} is not one of {", ".join(repr(v) for v in values)}'
+
+        checks.append(check_enum)
+
+    if {'properties', 'required', 'additionalProperties'} & set(schema):
+        properties = {k: _compile(v, root) for k, v in schema.get('properties', {}).items()}
+        required = schema.get('required', [])
+        additional = schema.get('additionalProperties', True)
+        extra: typing.Optional[Validator] = _compile(additional, root) if isinstance(additional, dict) else None
+
+        def check_object(instance: object, path: str) -> typing.Iterator[str]:
+            if not isinstance(instance, dict):
+                return
+            for r in required:
+                if r not in instance:
+                    yield f'{_where(path)}: {r} is required'
+            for k, v in instance.items():
+                sub = f'{path}.{k}' if path else k
+                if k in properties:
+                    yield from properties[k](v, sub)
+                elif extra is not None:
+                    yield from extra(v, sub)
+                elif additional is False:
+                    yield f'{_where(path)}: unknown key {k}'
+
+        checks.append(check_object)
+
+    if 'items' in schema:
+        item = _compile(schema['items'], root)
+
+        def check_items(instance: object, path: str) -> typing.Iterator[str]:
+            if isinstance(instance, list):
+                for i, v in enumerate(instance):
+                    yield from item(v, f'{path}[{i}]')
+
+        checks.append(check_items)
+
+    if 'oneOf' in schema:
+        options = [_compile(s, root) for s in schema['oneOf']]
+
+        def check_one_of(instance: object, path: str) -> typing.Iterator[str]:
+            results = [list(o(instance, path)) for o in options]
+            matched = sum(1 for r in results if not r)
+            if matched == 0:
+                reasons = ' or '.join(f'({"; ".join(r)})' for r in results)
+                yield f'{_where(path)}: does not match any of the allowed forms: {reasons}'
+            elif matched > 1:
+                yield f'{_where(path)}: matches more than one of the allowed forms'
+
+        checks.append(check_one_of)
+
+    def check(instance: object, path: str) -> typing.Iterator[str]:
+        for c in checks:
+            yield from c(instance, path)
+
+    return check
+
+
+@functools.lru_cache(maxsize=None)
+def validator() -> Validator:
+    """Load and compile the description schema."""
+    schema_file = importlib.resources.files('flatpaker') / 'data' / 'flatpaker.schema.json'
+    schema = json.loads(schema_file.read_text())
+    return _compile(schema, schema)
+
+
+def validate(instance: object) -> typing.List[str]:
+    """Validate a loaded toml description.
+
+    :return: A description of every problem found, which is empty if the
+        description is valid
+    """
+    return list(validator()(instance, ''))
@@ -4,21 +4,39 @@
 from __future__ import annotations
 from xml.etree import ElementTree as ET
 import contextlib
+import fcntl
 import hashlib
+import json
+import os
 import pathlib
+import re
 import shutil
 import subprocess
 import tempfile
 import textwrap
+import threading
 import typing
 
+from . import report
+
 if typing.TYPE_CHECKING:
-    from .description import Description
+    from .description import Archive, Description, File
 
     from .entry import BaseArguments
 
+    # A generated file, either written to disk, or a name and its contents
+    GeneratedFile = typing.Union[pathlib.Path, typing.Tuple[str, typing.Union[str, bytes]]]
+
 RUNTIME_VERSION = "24.08"
 
+# Read files in 1MiB chunks when hashing, so that multi-gigabyte archives don't
+# have to fit in memory
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Files smaller than this are cheaper to hash than to look up, and are usually
+# generated fresh for each build anyway
+_DIGEST_CACHE_MIN_SIZE = 16 * 1024 * 1024
+
 
 def _subelem(elem: ET.Element, tag: str, text: typing.Optional[str] = None, **extra: str) -> ET.Element:
     new = ET.SubElement(elem, tag, extra)
@@ -26,22 +44,27 @@ def _subelem(elem: ET.Element, tag: str, text: typing.Optional[str] = None, **ex
     return new
 
 
+def _location(source: typing.Union[Archive, File]) -> typing.Dict[str, object]:
+    if 'url' in source:
+        return {'url': source['url'], 'sha256': source['sha256'].lower()}
+    return {'path': source['path'].as_posix(), 'sha256': sha256(source['path'])}
+
+
 def extract_sources(description: Description) -> typing.List[typing.Dict[str, object]]:
     sources: typing.List[typing.Dict[str, object]] = []
 
     if 'sources' in description:
+        # Sources with a url are downloaded into the mirror, which is passed to
+        # flatpak-builder, and already have a verified digest
         for a in description['sources']['archives']:
             sources.append({
-                'path': a['path'].as_posix(),
-                'sha256': sha256(a['path']),
+                **_location(a),
                 'type': 'archive',
                 'strip-components': a.get('strip_components', 1),
             })
         for source in description['sources'].get('files', []):
-            p = source['path']
             sources.append({
-                'path': p.as_posix(),
-                'sha256': sha256(p),
+                **_location(source),
                 'type': 'file',
             })
         for a in description['sources'].get('patches', []):
@@ -54,9 +77,8 @@ def extract_sources(description: Description) -> typing.List[typing.Dict[str, ob
     return sources
 
 
-def create_appdata(description: Description, workdir: pathlib.Path, appid: str) -> pathlib.Path:
-    p = workdir / f'{appid}.metainfo.xml'
-
+def appdata(description: Description, appid: str) -> bytes:
+    """Generate the appstream metainfo for a description."""
     root = ET.Element('component', type="desktop-application")
     _subelem(root, 'id', appid)
     _subelem(root, 'name', description['common']['name'])
@@ -92,31 +114,181 @@ def create_appdata(description: Description, workdir: pathlib.Path, appid: str)
         for date, version in description['appdata']['releases'].items():
             _subelem(cr, 'release', version=version, date=date)
 
-    tree = ET.ElementTree(root)
-    ET.indent(tree)
-    tree.write(p, encoding='utf-8', xml_declaration=True)
+    ET.indent(root)
+    return ET.tostring(root, encoding='utf-8', xml_declaration=True)
+
 
+def create_appdata(description: Description, workdir: pathlib.Path, appid: str,
+                   contents: typing.Optional[bytes] = None) -> pathlib.Path:
+    """Write the appstream metainfo, generating it unless it is passed."""
+    p = workdir / f'{appid}.metainfo.xml'
+    _write_if_changed(p, contents if contents is not None else appdata(description, appid))
     return p
 
 
-def create_desktop(description: Description, workdir: pathlib.Path, appid: str) -> pathlib.Path:
-    p = workdir / f'{appid}.desktop'
-    with p.open('w') as f:
-        f.write(textwrap.dedent(f'''\
-            [Desktop Entry]
-            Name={description['common']['name']}
-            Exec=game.sh
-            Type=Application
-            Categories={';'.join(['Game'] + description['common'].get('categories', []))};
-            Icon={appid}
-            '''))
+def desktop(description: Description, appid: str) -> str:
+    """Generate the desktop file for a description."""
+    return textwrap.dedent(f'''\
+        [Desktop Entry]
+        Name={description['common']['name']}
+        Exec=game.sh
+        Type=Application
+        Categories={';'.join(['Game'] + description['common'].get('categories', []))};
+        Icon={appid}
+        ''')
 
+
+def create_desktop(description: Description, workdir: pathlib.Path, appid: str,
+                   contents: typing.Optional[str] = None) -> pathlib.Path:
+    """Write the desktop file, generating it unless it is passed."""
+    p = workdir / f'{appid}.desktop'
+    _write_if_changed(p, (contents if contents is not None else desktop(description, appid)).encode())
     return p
 
 
-def sha256(path: pathlib.Path) -> str:
+def _write_if_changed(path: pathlib.Path, data: bytes) -> None:
+    # Leaving an identical file alone keeps its mtime, so anything caching on
+    # it sees it as unchanged
+    try:
+        if path.read_bytes() == data:
+            return
+    except FileNotFoundError:
+        pass
+    path.write_bytes(data)
+
+
+def dump_json(struct: object) -> str:
+    """Serialize json canonically.
+
+    Keys are sorted and the formatting is fixed, so the same manifest is always
+    the same bytes, and can be compared or cached by its digest.
+    """
+    return json.dumps(struct, indent=4, sort_keys=True) + '\n'
+
+
+def write_json(path: pathlib.Path, struct: object) -> None:
+    """Write json canonically, leaving the file alone if it wouldn't change."""
+    _write_if_changed(path, dump_json(struct).encode())
+
+
+def cache_dir() -> pathlib.Path:
+    root = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return pathlib.Path(root) / 'flatpaker'
+
+
+def mirror_dir() -> pathlib.Path:
+    """The local mirror of downloaded sources.
+
+    This uses the same layout as flatpak-builder's downloads, so that it can be
+    passed to --extra-sources.
+    """
+    return cache_dir() / 'mirror'
+
+
+def _load_json_cache(cache: pathlib.Path) -> typing.Dict[str, typing.Any]:
+    try:
+        with cache.open('r') as f:
+            raw = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return raw if isinstance(raw, dict) else {}
+
+
+_JSON_CACHE_LOCK = threading.Lock()
+
+
+def _update_json_cache(cache: pathlib.Path, key: str, value: typing.Any) -> None:
+    # Re-read the cache so that concurrent flatpaker instances don't drop each
+    # other's entries, then atomically replace it.
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    with _JSON_CACHE_LOCK:
+        entries = _load_json_cache(cache)
+        entries[key] = value
+        with tempfile.NamedTemporaryFile('w', dir=cache.parent, delete=False) as f:
+            json.dump(entries, f)
+        os.replace(f.name, cache)
+
+
+def _hash_file(path: pathlib.Path) -> str:
+    h = hashlib.sha256()
     with path.open('rb') as f:
-        return hashlib.sha256(f.read()).hexdigest()
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _digest_key(path: pathlib.Path, st: os.stat_result) -> typing.Tuple[str, typing.List[int]]:
+    return path.absolute().as_posix(), [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def cached_sha256(path: pathlib.Path) -> typing.Optional[str]:
+    """Get the sha256 of a file from the cache, without calculating it."""
+    key, stamp = _digest_key(path, path.stat())
+    cached = _load_json_cache(cache_dir() / 'digests.json').get(key)
+    if cached is not None and cached[:3] == stamp:
+        return typing.cast('str', cached[3])
+    return None
+
+
+def sha256(path: pathlib.Path) -> str:
+    """Calculate the sha256 of a file.
+
+    Large files are cached in $XDG_CACHE_HOME/flatpaker, keyed by their path,
+    size, mtime and inode, so that unchanged archives are not re-hashed.
+    """
+    st = path.stat()
+    if st.st_size < _DIGEST_CACHE_MIN_SIZE:
+        return _hash_file(path)
+
+    cached = cached_sha256(path)
+    if cached is not None:
+        return cached
+
+    key, stamp = _digest_key(path, st)
+    digest = _hash_file(path)
+    _update_json_cache(cache_dir() / 'digests.json', key, [*stamp, digest])
+    return digest
+
+
+def fingerprint(manifest: typing.Dict[str, typing.Any]) -> str:
+    """Calculate a fingerprint over everything that goes into a build.
+
+    The manifest is hashed in its canonical form, so this covers everything
+    flatpaker generates, and every source that it has a sha256 for. Sources
+    that are only given by path, such as patches, are hashed as well.
+    Directory sources are only used for caches of earlier builds, which don't
+    change the result, so they are left out.
+    """
+    h = hashlib.sha256()
+    h.update(dump_json(manifest).encode())
+    modules = list(manifest.get('modules', []))
+    while modules:
+        module = modules.pop(0)
+        modules.extend(m for m in module.get('modules', []) if isinstance(m, dict))
+        for s in module.get('sources', []):
+            if 'path' in s and 'sha256' not in s and s.get('type') != 'dir':
+                h.update(sha256(pathlib.Path(s['path'])).encode())
+    return h.hexdigest()
+
+
+def _export_key(repo: str, appid: str) -> str:
+    return f'{os.path.abspath(repo)}/{appid}'
+
+
+def exported_fingerprint(repo: str, appid: str) -> typing.Optional[str]:
+    """Get the fingerprint of the last successful export of appid to repo."""
+    if not os.path.isdir(repo):
+        return None
+    return typing.cast('typing.Optional[str]',
+                       _load_json_cache(cache_dir() / 'exports.json').get(_export_key(repo, appid)))
+
+
+def record_fingerprint(repo: str, appid: str, fp: str) -> None:
+    _update_json_cache(cache_dir() / 'exports.json', _export_key(repo, appid), fp)
+
+
+def get_appid(description: Description) -> str:
+    return f"{description['common']['reverse_url']}.{sanitize_name(description['common']['name'])}"
 
 
 def sanitize_name(name: str) -> str:
@@ -128,60 +300,386 @@ def sanitize_name(name: str) -> str:
         .replace("'", '')
 
 
-def build_flatpak(args: BaseArguments, workdir: pathlib.Path, appid: str) -> None:
+def disk_usage(path: pathlib.Path) -> int:
+    """The size of all of the files in a directory.
+
+    Hardlinked files are only counted once, as flatpak-builder hardlinks
+    heavily between its cache and checkouts.
+    """
+    total = 0
+    seen: typing.Set[typing.Tuple[int, int]] = set()
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                st = os.lstat(os.path.join(root, f))
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+def parse_size(size: typing.Union[str, int]) -> int:
+    """Convert a size like "512M" or "20G" into bytes."""
+    if isinstance(size, int):
+        return size
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+# The state directories that are currently being used by this process, which
+# must not be evicted
+_ACTIVE_STATE_DIRS: typing.Set[pathlib.Path] = set()
+_STATE_DIR_LOCK = threading.Lock()
+
+
+def default_state_root() -> pathlib.Path:
+    return cache_dir() / 'flatpak-builder'
+
+
+@contextlib.contextmanager
+def state_dir(root: pathlib.Path, appid: str) -> typing.Iterator[pathlib.Path]:
+    """Use a per appid flatpak-builder state directory under root.
+
+    The directory is marked as recently used, and protected from eviction
+    while in use. It is also locked while in use, so that several processes
+    sharing a root, such as build farm workers, take turns using it.
+    """
+    d = (root / appid).absolute()
+    root.mkdir(parents=True, exist_ok=True)
+    with open(root / f'{appid}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Another process may have evicted it while waiting for the lock
+        d.mkdir(exist_ok=True)
+        os.utime(d)
+        with _STATE_DIR_LOCK:
+            _ACTIVE_STATE_DIRS.add(d)
+        try:
+            yield d
+        finally:
+            os.utime(d)
+            with _STATE_DIR_LOCK:
+                _ACTIVE_STATE_DIRS.discard(d)
+
+
+def evict_state_dirs(root: pathlib.Path, max_size: int) -> typing.List[str]:
+    """Remove the least recently used state directories until root fits in max_size.
+
+    Directories in use by this process, or locked by another process sharing
+    root, are skipped.
+
+    :return: the names of the removed directories
+    """
+    if not root.is_dir():
+        return []
+    with _STATE_DIR_LOCK:
+        active = set(_ACTIVE_STATE_DIRS)
+
+    dirs = sorted((d for d in root.iterdir() if d.is_dir()), key=lambda d: d.stat().st_mtime)
+    sizes = {d: disk_usage(d) for d in dirs}
+    total = sum(sizes.values())
+
+    evicted: typing.List[str] = []
+    for d in dirs:
+        if total <= max_size:
+            break
+        if d.absolute() in active:
+            continue
+        with open(root / f'{d.name}.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            shutil.rmtree(d, ignore_errors=True)
+        total -= sizes[d]
+        evicted.append(d.name)
+    return evicted
+
+
+def build_flatpak(args: BaseArguments, workdir: pathlib.Path, appid: str,
+                  export_lock: typing.Optional[threading.Lock] = None,
+                  harvest: typing.Optional[typing.Callable[[pathlib.Path], None]] = None) -> None:
+    """Build a flatpak, then export and/or install it.
+
+    Each appid gets its own build and state directory so that several
+    flatpak-builder instances may run at once. State directories are kept
+    under args.state_dir, so that flatpak-builder's module cache can be used
+    by later builds. The export step writes to a shared repo (or user
+    installation), so it is serialized through `export_lock` when one is
+    provided.
+
+    If `harvest` is provided the module build directories are kept, and it is
+    called with their location once the build is done, before they are
+    removed.
+    """
+    with state_dir(pathlib.Path(args.state_dir), appid) as statedir:
+        _build_flatpak(args, workdir, appid, statedir.as_posix(), export_lock, harvest)
+
+    if args.state_dir_max_size is not None:
+        for evicted in evict_state_dirs(pathlib.Path(args.state_dir), parse_size(args.state_dir_max_size)):
+            print(f'Evicted flatpak-builder cache for {evicted}')
+
+
+def _build_flatpak(args: BaseArguments, workdir: pathlib.Path, appid: str, statedir: str,
+                   export_lock: typing.Optional[threading.Lock],
+                   harvest: typing.Optional[typing.Callable[[pathlib.Path], None]]) -> None:
+    builddir = pathlib.Path('build', appid).absolute().as_posix()
+    manifest = (workdir / f'{appid}.json').absolute().as_posix()
+
     build_command: typing.List[str] = [
-        'flatpak-builder', '--force-clean', '--user', 'build',
-        (workdir / f'{appid}.json').absolute().as_posix(),
+        'flatpak-builder', '--force-clean', '--user', '--state-dir', statedir,
+    ]
+    if harvest is not None:
+        build_command.append('--keep-build-dirs')
+    if mirror_dir().is_dir():
+        build_command.extend(['--extra-sources', mirror_dir().as_posix()])
+    build_command.extend([builddir, manifest])
+    report.run(appid, 'flatpak-builder:build', build_command, cancellable=True)
+    if report.enabled():
+        report.record(appid, 'installed_size', disk_usage(pathlib.Path(builddir, 'files')))
+
+    if harvest is not None:
+        builddirs = pathlib.Path(statedir, 'build')
+        harvest(builddirs)
+        shutil.rmtree(builddirs, ignore_errors=True)
+
+    if not (args.export or args.install):
+        return
+
+    # When batching, each build exports to its own staging repo, which doesn't
+    # need to be serialized
+    repo = staging_repo(appid).as_posix() if args.batch_export else args.repo
+    export_command: typing.List[str] = [
+        'flatpak-builder', '--export-only', '--user', '--state-dir', statedir,
     ]
-
     if args.export:
-        build_command.extend(['--repo', args.repo])
+        export_command.extend(['--repo', repo])
         if args.gpg:
-            build_command.extend(['--gpg-sign', args.gpg])
+            export_command.extend(['--gpg-sign', args.gpg])
     if args.install:
-        build_command.extend(['--install'])
+        export_command.extend(['--install'])
+    export_command.extend([builddir, manifest])
+
+    if args.batch_export:
+        shutil.rmtree(repo, ignore_errors=True)
+        report.run(appid, 'flatpak-builder:export', export_command)
+        return
+
+    # How much the repo grew is taken from the export's output, rather than
+    # by measuring the repo, which would take longer than exporting
+    with export_lock or contextlib.nullcontext():
+        report.run(appid, 'flatpak-builder:export', export_command, exports=args.export)
+
+
+def runtime_installed(id_: str, branch: str) -> bool:
+    """Whether a runtime is installed for the user."""
+    return subprocess.run(['flatpak', 'info', '--user', f'{id_}//{branch}'],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def install_runtime(title: str, repo: pathlib.Path, id_: str, branch: str) -> None:
+    """Install a runtime for the user from a local repo.
+
+    Games can only be built against a runtime that is installed. When
+    flatpak-builder builds a runtime it only installs the Sdk, so the runtime
+    the games use is installed here.
+
+    :raises subprocess.CalledProcessError: If any flatpak command fails
+    """
+    remote = f'{id_}-origin'
+    url = repo.absolute().as_uri()
+    report.run(title, 'flatpak:remote-add', [
+        'flatpak', 'remote-add', '--user', '--no-gpg-verify', '--if-not-exists', remote, url])
+    # The repo may have moved since the remote was added, such as a staging repo
+    report.run(title, 'flatpak:remote-modify', ['flatpak', 'remote-modify', '--user', f'--url={url}', remote])
+    report.run(title, 'flatpak:install', [
+        'flatpak', 'install', '--user', '--reinstall', '--noninteractive', remote, f'{id_}//{branch}'])
+
+
+def staging_repo(appid: str) -> pathlib.Path:
+    """Where a build is exported to when batching exports."""
+    return pathlib.Path('build', '.staging', appid).absolute()
+
+
+def _new_objects_size(staging: pathlib.Path, repo: pathlib.Path) -> int:
+    """The size of the objects in a staging repo that aren't in the repo.
+
+    This is what copying its commits adds to the repo, found without walking
+    the whole repo.
+    """
+    objects = staging / 'objects'
+    return sum(p.stat().st_size for p in objects.glob('*/*')
+               if not (repo / 'objects' / p.relative_to(objects)).exists())
+
+
+def _refs(repo: pathlib.Path) -> typing.List[str]:
+    heads = repo / 'refs' / 'heads'
+    return sorted(p.relative_to(heads).as_posix() for p in heads.glob('**/*') if p.is_file())
+
+
+def publish(args: BaseArguments, appids: typing.List[str]) -> None:
+    """Move builds from their staging repos into the repo, and update it once.
+
+    Exporting each build directly to the repo regenerates its summary and
+    appstream data for every build, which gets slower as the repo grows.
+    Instead, each staged commit is copied over without updating the summary,
+    and the summary is updated once at the end.
+
+    :raises subprocess.CalledProcessError: If any flatpak command fails, which
+        leaves the staging repos in place
+    """
+    repo = pathlib.Path(args.repo)
+    gpg = [f'--gpg-sign={args.gpg}'] if args.gpg else []
+    staged = [staging_repo(a) for a in appids]
+    if not staged:
+        return
+
+    for appid, staging in zip(appids, staged):
+        if report.enabled():
+            report.record(appid, 'repo_delta_size', _new_objects_size(staging, repo))
+        if not repo.exists():
+            # flatpak can't create a repo when copying commits, so the first
+            # staging repo becomes the repo. Its commits are already signed.
+            shutil.copytree(staging, repo, symlinks=True)
+        else:
+            report.run(appid, 'flatpak:build-commit-from', [
+                'flatpak', 'build-commit-from', '--no-update-summary', f'--src-repo={staging}',
+                *gpg, repo.as_posix(), *_refs(staging)])
 
-    subprocess.run(build_command, check=True)
+    report.run(args.repo, 'flatpak:build-update-repo', [
+        'flatpak', 'build-update-repo', *gpg, repo.as_posix()])
+
+    if args.cleanup:
+        for staging in staged:
+            shutil.rmtree(staging, ignore_errors=True)
 
 
 @contextlib.contextmanager
-def tmpdir(name: str, cleanup: bool = True) -> typing.Iterator[pathlib.Path]:
-    tdir = pathlib.Path(tempfile.gettempdir()) / name
-    tdir.mkdir(parents=True, exist_ok=True)
-    yield tdir
-    if cleanup:
-        shutil.rmtree(tdir)
+def tmpdir(name: str, cleanup: bool = True, key: str = '') -> typing.Iterator[pathlib.Path]:
+    """A work directory for generating files in.
+
+    The directory is named after name and a digest of key, which should be a
+    fingerprint of what is generated in it, so different builds never share a
+    directory. Builds with the same name hold a lock while they use it, so they
+    wait for each other, even from other processes sharing the temporary
+    directory. Directories left behind by earlier builds with the same name
+    are removed, so only the latest one is kept with cleanup disabled.
+
+    :param name: A name that is safe to use in a path, such as an appid
+    :param cleanup: If True, delete the directory afterwards
+    :param key: What distinguishes this directory from others with the same name
+    """
+    root = pathlib.Path(tempfile.gettempdir(), 'flatpaker')
+    root.mkdir(parents=True, exist_ok=True)
+    tdir = root / f'{name}-{hashlib.sha256(key.encode()).hexdigest()[:16]}'
+
+    # The lock file is left behind, removing it would race with another
+    # process that has opened it, but not yet locked it. There is only one for
+    # each name, so they don't build up.
+    with open(root / f'{name}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        stale = re.compile(re.escape(name) + r'-[0-9a-f]{16}')
+        for d in root.iterdir():
+            if d != tdir and stale.fullmatch(d.name):
+                shutil.rmtree(d, ignore_errors=True)
+        tdir.mkdir(exist_ok=True)
+        yield tdir
+        if cleanup:
+            shutil.rmtree(tdir)
+
+
+def _generated_source(file_: GeneratedFile) -> typing.Dict[str, typing.Any]:
+    if isinstance(file_, pathlib.Path):
+        return {
+            'path': file_.as_posix(),
+            'sha256': sha256(file_),
+            'type': 'file',
+        }
+    name, contents = file_
+    return {
+        'contents': contents.decode() if isinstance(contents, bytes) else contents,
+        'dest-filename': name,
+        'type': 'inline',
+    }
+
 
+def _generated_name(file_: GeneratedFile) -> str:
+    return file_.name if isinstance(file_, pathlib.Path) else file_[0]
 
-def bd_desktop(file_: pathlib.Path) -> typing.Dict[str, typing.Any]:
+
+def bd_desktop(file_: GeneratedFile) -> typing.Dict[str, typing.Any]:
     return {
         'buildsystem': 'simple',
         'name': 'desktop_file',
+        'sources': [_generated_source(file_)],
+        'build-commands': [
+            f'install -D -m644 {_generated_name(file_)} -t /app/share/applications',
+        ],
+    }
+
+
+def bd_appdata(file_: GeneratedFile) -> typing.Dict[str, typing.Any]:
+    return {
+        'buildsystem': 'simple',
+        'name': 'appdata_file',
+        'sources': [_generated_source(file_)],
+        'build-commands': [
+            f'install -D -m644 {_generated_name(file_)} -t /app/share/metainfo',
+        ],
+    }
+
+
+def bd_icons(icons: typing.Dict[int, pathlib.Path], appid: str) -> typing.Dict[str, typing.Any]:
+    return {
+        'buildsystem': 'simple',
+        'name': 'icons',
         'sources': [
             {
                 'path': file_.as_posix(),
                 'sha256': sha256(file_),
                 'type': 'file',
             }
+            for _, file_ in sorted(icons.items())
         ],
         'build-commands': [
-            f'install -D -m644 {file_.name} -t /app/share/applications',
+            f'install -D -m644 {file_.name} /app/share/icons/hicolor/{size}x{size}/apps/{appid}.png'
+            for size, file_ in sorted(icons.items())
         ],
     }
 
 
-def bd_appdata(file_: pathlib.Path) -> typing.Dict[str, typing.Any]:
+def optimize_script() -> pathlib.Path:
+    """The script that optimizes assets inside of the build sandbox."""
+    return pathlib.Path(__file__).parent / 'optimize.py'
+
+
+def bd_optimize(rpa: typing.Optional[str] = None) -> typing.Dict[str, typing.Any]:
+    """Losslessly recompress the assets of the installed game.
+
+    This is a separate module after the game, so that it runs after every file
+    has been installed, but before cleanup.
+
+    :param rpa: A Ren'Py game directory to pack loose assets into an archive in
+    """
+    script = optimize_script()
+    command = f'python3 {script.name} -j "${{FLATPAK_BUILDER_N_JOBS:-$(nproc)}}" /app/lib/game'
+    if rpa is not None:
+        command += f' --rpa {rpa}'
     return {
         'buildsystem': 'simple',
-        'name': 'appdata_file',
+        'name': 'optimize',
         'sources': [
             {
-                'path': file_.as_posix(),
-                'sha256': sha256(file_),
+                'path': script.as_posix(),
+                'sha256': sha256(script),
                 'type': 'file',
             }
         ],
-        'build-commands': [
-            f'install -D -m644 {file_.name} -t /app/share/metainfo',
-        ],
+        'build-commands': [command],
     }
@@ -0,0 +1,247 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+"""Rebuild descriptions when they, or their sources, change.
+
+This uses inotify directly through libc, as there is no binding in the
+standard library. Directories are watched rather than files, as many editors
+save by writing a new file and renaming it over the old one.
+"""
+
+from __future__ import annotations
+import concurrent.futures
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import struct
+import sys
+import threading
+import typing
+
+from . import fetch, report, util
+from .description import load_description
+
+if typing.TYPE_CHECKING:
+    from .description import Description
+    from .entry import BaseArguments
+
+    Builder = typing.Callable[[BaseArguments, Description, typing.Optional[threading.Lock]], bool]
+
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+# Modifications are only acted on when the file is closed, a large archive
+# being copied in would otherwise trigger a build for every write
+_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+
+    """A minimal inotify wrapper."""
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd: int = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs: typing.Dict[int, pathlib.Path] = {}
+
+    def add(self, path: pathlib.Path) -> None:
+        """Watch a directory for changes to the files in it.
+
+        inotify gives the same watch for a directory reached by different
+        paths, so the path should be resolved, or changes may be reported
+        under a different path than expected.
+        """
+        wd: int = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'could not watch {path}')
+        self._dirs[wd] = path
+
+    def read(self, timeout: typing.Optional[float]) -> typing.Set[pathlib.Path]:
+        """Wait for changes.
+
+        :param timeout: How long to wait, or None to wait forever
+        :return: The files that changed, which is empty if the timeout passed
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changed: typing.Set[pathlib.Path] = set()
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self._dirs and name:
+                changed.add(self._dirs[wd] / os.fsdecode(name))
+        return changed
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def _sources(description: Description) -> typing.Set[pathlib.Path]:
+    """The local files a description is built from, resolved."""
+    sources = description.get('sources')
+    if sources is None:
+        return set()
+    return {
+        s['path'].resolve() for s in [*sources['archives'], *sources.get('files', []), *sources.get('patches', [])]
+        if 'url' not in s
+    }
+
+
+class Watcher:
+
+    """Watch a directory of descriptions, and rebuild the ones that change.
+
+    Each description is built at most once at a time. If a description changes
+    while it is being built, its flatpak-builder build is stopped, and it is
+    built again once that has finished.
+    """
+
+    def __init__(self, args: BaseArguments, root: pathlib.Path, builder: Builder,
+                 jobs: int = 1, debounce: float = 1.0):
+        self.args = args
+        # Paths are resolved everywhere, as changes are reported under the
+        # resolved path of the directory
+        self.root = root.resolve()
+        self.builder = builder
+        self.debounce = debounce
+        self.inotify = Inotify()
+        self.executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        self.export_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self._watched: typing.Set[pathlib.Path] = set()
+        # The sources of each description, and the appid it builds
+        self._sources: typing.Dict[pathlib.Path, typing.Set[pathlib.Path]] = {}
+        self._appids: typing.Dict[pathlib.Path, str] = {}
+        self._running: typing.Set[pathlib.Path] = set()
+        self._again: typing.Set[pathlib.Path] = set()
+        self._stopping = False
+
+    def _watch(self, directory: pathlib.Path) -> None:
+        directory = directory.resolve()
+        with self._lock:
+            if directory not in self._watched and directory.is_dir():
+                self.inotify.add(directory)
+                self._watched.add(directory)
+
+    def track(self, toml: pathlib.Path) -> typing.Optional[Description]:
+        """Load a description, and watch it and its sources.
+
+        :return: The description, or None if it could not be loaded
+        """
+        self._watch(toml.parent)
+        try:
+            description = load_description(toml.as_posix())
+        except (OSError, ValueError) as e:
+            print(e, file=sys.stderr)
+            with self._lock:
+                self._sources.setdefault(toml, set())
+            return None
+
+        sources = _sources(description)
+        for s in sources:
+            self._watch(s.parent)
+        with self._lock:
+            self._sources[toml] = sources
+            self._appids[toml] = util.get_appid(description)
+        return description
+
+    def scan(self) -> None:
+        """Find and track every description under the root."""
+        self._watch(self.root)
+        for toml in sorted(self.root.glob('**/*.toml')):
+            self.track(toml.resolve())
+
+    def affected(self, changed: typing.Set[pathlib.Path]) -> typing.Set[pathlib.Path]:
+        """Find the descriptions affected by changes to files."""
+        with self._lock:
+            found = {t for t, sources in self._sources.items() if t in changed or sources & changed}
+        # New descriptions
+        found.update(c.resolve() for c in changed
+                     if c.suffix == '.toml' and c.is_relative_to(self.root) and c.exists())
+        return found
+
+    def schedule(self, toml: pathlib.Path) -> None:
+        """Build a description, or rebuild it once its current build stops."""
+        with self._lock:
+            if self._stopping:
+                return
+            if toml in self._running:
+                self._again.add(toml)
+                appid = self._appids.get(toml)
+                if appid is not None and report.cancel(appid):
+                    print(f'{toml} changed, stopping its build')
+                return
+            self._running.add(toml)
+        self.executor.submit(self._build, toml)
+
+    def _build(self, toml: pathlib.Path) -> None:
+        try:
+            # Reload the description, as it may have changed, along with
+            # which sources it uses
+            description = self.track(toml)
+            if description is not None:
+                # Sources from a url aren't watched, as they can only change
+                # along with the description, but they may not be mirrored yet
+                fetch.fetch([description])
+                print(f'Building {toml}')
+                if not self.builder(self.args, description, self.export_lock):
+                    print(f'{toml} is unchanged since its last export')
+                else:
+                    print(f'Built {toml}')
+        except Exception as e:
+            with self._lock:
+                cancelled = toml in self._again
+            if not cancelled:
+                print(f'Building {toml} failed: {e}', file=sys.stderr)
+        finally:
+            with self._lock:
+                self._running.discard(toml)
+                again = toml in self._again
+                self._again.discard(toml)
+            if again:
+                self.schedule(toml)
+
+    def run(self) -> None:
+        """Wait for changes, and rebuild what they affect, until interrupted."""
+        self.scan()
+        print(f'Watching {len(self._sources)} descriptions in {self.root}')
+        try:
+            while True:
+                changed = self.inotify.read(None)
+                # Wait for the changes to settle, so that saving several files
+                # or copying in a large archive only causes one build
+                while True:
+                    more = self.inotify.read(self.debounce)
+                    if not more:
+                        break
+                    changed |= more
+                for toml in sorted(self.affected(changed)):
+                    self.schedule(toml)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            with self._lock:
+                self._stopping = True
+                appids = [self._appids[t] for t in self._running if t in self._appids]
+            for appid in appids:
+                report.cancel(appid)
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.inotify.close()
@@ -0,0 +1,109 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import hashlib
+import json
+import pathlib
+import textwrap
+import typing
+import zipfile
+
+import pytest
+
+if typing.TYPE_CHECKING:
+    class GameFactory(typing.Protocol):
+        def __call__(self, engine: str = ..., *, directory: typing.Optional[pathlib.Path] = ...,
+                     url: bool = ..., sha256: typing.Optional[str] = ..., pictures: int = ...,
+                     name: str = ...) -> pathlib.Path: ...
+
+    class RuntimePinner(typing.Protocol):
+        def __call__(self, engine: str, version: str, source: pathlib.Path) -> None: ...
+
+
+# The files of a minimal game for each engine
+_FILES: typing.Dict[str, typing.Dict[str, str]] = {
+    'renpy': {
+        'Game.py': '',
+        'Game.sh': '',
+        'game/script.rpy': 'label start:\n    return\n',
+        'renpy/__init__.py': '',
+        'renpy/vc_version.py': "version = '8.3.4'\n",
+        'lib/py3-linux-x86_64/python': '',
+    },
+    'rpgmaker': {
+        **{name: '' for name in ['nw', 'lib/libnw.so', 'locales/en-US.pak', 'locales/de.pak', 'resources.pak',
+                                 'icon/icon.png', 'package.json', 'www/js/plugins.js']},
+        'www/data/System.json': json.dumps({'title1Name': 'Title'}),
+        'www/img/titles1/Title.png': '',
+    },
+}
+
+
+@pytest.fixture(autouse=True)
+def _xdg(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv('XDG_CACHE_HOME', (tmp_path / 'cache').as_posix())
+    monkeypatch.setenv('XDG_CONFIG_HOME', (tmp_path / 'config').as_posix())
+
+
+@pytest.fixture
+def pin_runtime(tmp_path: pathlib.Path) -> RuntimePinner:
+    """Set the source of an engine's shared runtime in the configuration file.
+
+    The source is given by its file:// url.
+    """
+    config = tmp_path / 'config' / 'flatpaker' / 'config.toml'
+
+    def pin(engine: str, version: str, source: pathlib.Path) -> None:
+        config.parent.mkdir(parents=True, exist_ok=True)
+        with config.open('a') as f:
+            f.write(textwrap.dedent(f'''\
+                [runtimes.{engine}."{version}"]
+                url = "{source.as_uri()}"
+                sha256 = "{hashlib.sha256(source.read_bytes()).hexdigest()}"
+                '''))
+
+    return pin
+
+
+@pytest.fixture
+def make_game(tmp_path: pathlib.Path) -> GameFactory:
+    """Write a game archive and a description of it.
+
+    The archive is referred to by path, or by a file:// url if `url` is
+    True, in which case `sha256` overrides its digest. RPGMaker games can
+    have `pictures` unused images added. Games in the same directory need
+    different names.
+
+    :return: The path to the description
+    """
+    def make(engine: str = 'renpy', *, directory: typing.Optional[pathlib.Path] = None,
+             url: bool = False, sha256: typing.Optional[str] = None, pictures: int = 0,
+             name: str = 'Game') -> pathlib.Path:
+        directory = directory or tmp_path
+        directory.mkdir(parents=True, exist_ok=True)
+        game = directory / f'{name}-1.0-pc.zip'
+        with zipfile.ZipFile(game, 'w') as z:
+            for file, data in _FILES[engine].items():
+                z.writestr(f'{name}-1.0-pc/{file}', data)
+            for i in range(pictures):
+                z.writestr(f'{name}-1.0-pc/www/img/pictures/Unused{i}.png', '')
+
+        if url:
+            source = f'url = "{game.as_uri()}"\nsha256 = "{sha256 or hashlib.sha256(game.read_bytes()).hexdigest()}"'
+        else:
+            source = f'path = "{game.name}"'
+        toml = directory / f'{name.lower()}.toml'
+        toml.write_text(textwrap.dedent('''\
+            [common]
+            name = "{}"
+            reverse_url = "com.example"
+            engine = "{}"
+            [appdata]
+            summary = "A game"
+            description = "A game"
+            [[sources.archives]]
+            ''').format(name, engine) + source + '\n')
+        return toml
+
+    return make
@@ -0,0 +1,49 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import pathlib
+import types
+import typing
+
+import pytest
+
+from flatpaker import api, entry, util
+
+if typing.TYPE_CHECKING:
+    from conftest import GameFactory
+
+
+@pytest.mark.parametrize('engine', ['renpy', 'rpgmaker'])
+def test_generate_fetches_missing_sources(make_game: GameFactory, engine: str) -> None:
+    description = api.load_description(make_game(engine, url=True).as_posix())
+    assert not description['sources']['archives'][0]['path'].exists()
+
+    result = api.generate(description)
+
+    assert description['sources']['archives'][0]['path'].exists()
+    sources = [s for m in result.manifest['modules'] for s in m.get('sources', [])]
+    assert any(s.get('url', '').endswith('Game-1.0-pc.zip') for s in sources)
+
+
+def test_generate_bad_digest(make_game: GameFactory) -> None:
+    description = api.load_description(make_game(url=True, sha256='0' * 64).as_posix())
+    with pytest.raises(ValueError, match='Game-1.0-pc.zip'):
+        api.generate(description)
+
+
+@pytest.mark.parametrize('engine', ['renpy', 'rpgmaker'])
+def test_generate_matches_build(make_game: GameFactory, monkeypatch: pytest.MonkeyPatch, engine: str) -> None:
+    built: typing.Dict[str, str] = {}
+
+    def build_flatpak(args: object, workdir: pathlib.Path, appid: str, *rest: object) -> None:
+        built[appid] = (workdir / f'{appid}.json').read_text()
+
+    monkeypatch.setattr(util, 'build_flatpak', build_flatpak)
+    description = api.load_description(make_game(engine).as_posix())
+    args = types.SimpleNamespace(
+        shared_runtime=True, optimize_assets='lossless', warm_cache=True, export=False, cleanup=True)
+    entry.build(typing.cast('entry.BaseArguments', args), description)
+
+    result = api.generate(description, shared_runtime=True, optimize='lossless', warm_cache=True)
+    assert built[result.appid] == api.dump_json(result.manifest)
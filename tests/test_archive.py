@@ -0,0 +1,35 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import pathlib
+import types
+import typing
+import zipfile
+
+import pytest
+
+from flatpaker import archive, entry
+
+
+def _rpgmaker(path: pathlib.Path, core: str) -> pathlib.Path:
+    with zipfile.ZipFile(path, 'w') as z:
+        for name in ['nw', 'package.json', 'www/index.html']:
+            z.writestr(f'Game/{name}', '')
+        z.writestr(f'Game/{core}', f'// {core.rsplit("/", 1)[-1]} v1.2.3\n')
+    return path
+
+
+@pytest.mark.parametrize('core', ['www/js/rpg_core.js', 'www/js/rmmz_core.js', 'js/rmmz_core.js'])
+def test_rpgmaker_version(tmp_path: pathlib.Path, core: str) -> None:
+    assert archive.detect_engine(_rpgmaker(tmp_path / 'game.zip', core)) == ('rpgmaker', '1.2.3')
+
+
+def test_detect_reports_unreadable_archives(tmp_path: pathlib.Path, capsys: pytest.CaptureFixture[str]) -> None:
+    game = _rpgmaker(tmp_path / 'game.zip', 'js/rmmz_core.js')
+    args = types.SimpleNamespace(archives=[(tmp_path / 'missing.zip').as_posix(), game.as_posix()])
+
+    assert not entry.detect_all(typing.cast('entry.DetectArguments', args))
+    out, err = capsys.readouterr()
+    assert out == f'{game}: rpgmaker 1.2.3\n'
+    assert err.startswith(f'{tmp_path / "missing.zip"}: ')
@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import pathlib
+import types
+import typing
+
+import pytest
+
+from flatpaker import api, entry, util
+from flatpaker.impl import renpy
+
+if typing.TYPE_CHECKING:
+    from conftest import GameFactory, RuntimePinner
+
+
+def test_build_all_serial_records_failures(monkeypatch: pytest.MonkeyPatch) -> None:
+    built: typing.List[str] = []
+    published: typing.List[bool] = []
+
+    def build(args: object, name: str, lock: object = None) -> bool:
+        if name == 'bad.toml':
+            raise FileNotFoundError(name)
+        built.append(name)
+        return True
+
+    monkeypatch.setattr(entry, 'fetch_all', lambda args: True)
+    monkeypatch.setattr(entry, '_load_and_build', build)
+    monkeypatch.setattr(entry, 'publish_staged', lambda args: published.append(True) or True)
+
+    args = types.SimpleNamespace(descriptions=['a.toml', 'bad.toml', 'b.toml'], jobs=1, batch_export=True)
+    assert not entry.build_all(typing.cast('entry.BuildArguments', args))
+    assert built == ['a.toml', 'b.toml']
+    assert published == [True]
+
+
+@pytest.mark.parametrize('export, with_runtime', [(False, True), (True, False)])
+def test_shared_runtime_is_installed_before_the_game(
+        make_game: GameFactory, pin_runtime: RuntimePinner, tmp_path: pathlib.Path,
+        monkeypatch: pytest.MonkeyPatch, export: bool, with_runtime: bool) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(entry, '_RUNTIMES_BUILT', set())
+    description = api.load_description(make_game().as_posix())
+    sdk = tmp_path / 'sdk.tar.bz2'
+    sdk.write_bytes(b'sdk')
+    pin_runtime('renpy', '8.3.4', sdk)
+    calls: typing.List[typing.Tuple[object, ...]] = []
+
+    def build_flatpak(args: entry.BaseArguments, workdir: pathlib.Path, appid: str, *rest: object) -> None:
+        calls.append(('build', appid, args.export, args.batch_export))
+        if args.batch_export:
+            util.staging_repo(appid).mkdir(parents=True)
+
+    def install_runtime(title: str, repo: pathlib.Path, id_: str, branch: str) -> None:
+        calls.append(('install', repo.is_dir(), id_, branch))
+
+    monkeypatch.setattr(util, 'build_flatpak', build_flatpak)
+    monkeypatch.setattr(util, 'runtime_installed', lambda id_, branch: False)
+    monkeypatch.setattr(util, 'install_runtime', install_runtime)
+
+    # A worker exports the game to a staging repo, but not the runtime, which
+    # another worker built for the repo
+    args = types.SimpleNamespace(
+        shared_runtime=True, optimize_assets=None, warm_cache=False, export=export, batch_export=export,
+        install=False, cleanup=True, force=False, repo=(tmp_path / 'repo').as_posix())
+    assert entry.build(typing.cast('entry.BaseArguments', args), description, with_runtime=with_runtime)
+
+    runtime = f'{renpy.RUNTIME_ID}-8.3.4'
+    appid = util.get_appid(description)
+    assert calls == [
+        ('build', runtime, True, True),
+        ('install', True, renpy.RUNTIME_ID, '8.3.4'),
+        ('build', appid, export, export),
+    ]
+    # The runtime's own staging repo is only for installing it
+    assert not util.staging_repo(runtime).exists()
+    assert list(entry.take_staged()) == ([appid] if export else [])
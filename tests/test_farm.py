@@ -0,0 +1,161 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import io
+import json
+import pathlib
+import tarfile
+import threading
+import time
+import types
+import typing
+import urllib.request
+
+import pytest
+
+from flatpaker import farm, util
+from flatpaker.description import load_description
+
+if typing.TYPE_CHECKING:
+    from conftest import GameFactory
+    from flatpaker.description import Description
+
+
+def _coordinator() -> farm.Coordinator:
+    coordinator = farm.Coordinator({}, retries=0)
+    coordinator.add(farm.Job('/rt.toml', 'runtime', 10, None, runtime=True))
+    coordinator.add(farm.Job('/a.toml', 'a', 5, None, requires='runtime'))
+    coordinator.add(farm.Job('/b.toml', 'b', 1, None))
+    return coordinator
+
+
+def test_runtime_is_built_before_the_games_using_it() -> None:
+    coordinator = _coordinator()
+
+    status, job = coordinator.next('w1')
+    assert status == 200 and job is not None
+    assert (job['appid'], job['runtime']) == ('runtime', True)
+    status, other = coordinator.next('w2')
+    assert status == 200 and other is not None and other['appid'] == 'b'
+    # a waits for the runtime
+    assert coordinator.next('w2') == (204, None)
+
+    assert coordinator.finish(job['lease'], {}, None)
+    status, job = coordinator.next('w1')
+    assert status == 200 and job is not None
+    assert (job['appid'], job['runtime']) == ('a', False)
+
+
+def test_games_fail_with_their_runtime() -> None:
+    coordinator = _coordinator()
+
+    _, job = coordinator.next('w1')
+    assert job is not None
+    coordinator.fail(job['lease'], 'boom')
+
+    assert coordinator.failed == ['/a.toml']
+    _, job = coordinator.next('w1')
+    assert job is not None and job['appid'] == 'b'
+
+
+def _tar(*members: typing.Tuple[str, bytes]) -> io.BytesIO:
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode='w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    f.seek(0)
+    return f
+
+
+@pytest.mark.parametrize('name', ['other/objects', '../b/objects', 'b/../../objects', '/b/objects'])
+def test_results_outside_the_staging_repos_are_rejected(
+        name: str, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    coordinator = _coordinator()
+    _, job = coordinator.next('w1')
+    _, job = coordinator.next('w1')
+    assert job is not None and job['appid'] == 'b'
+
+    assert coordinator.finish(job['lease'], {'b': 'fp'}, _tar((name, b'evil')))
+    assert coordinator.failed == ['/b.toml']
+    assert 'b' not in coordinator.staged
+    assert [p for p in tmp_path.rglob('*') if p.is_file()] == []
+
+
+def test_jobs_are_retried_without_a_heartbeat() -> None:
+    coordinator = farm.Coordinator({}, heartbeat_timeout=0.1, retries=1)
+    coordinator.add(farm.Job('/b.toml', 'b', 1, None))
+
+    _, lost = coordinator.next('w1')
+    assert lost is not None
+    time.sleep(0.2)
+    coordinator._reap()
+
+    _, job = coordinator.next('w2')
+    assert job is not None and job['appid'] == 'b' and job['lease'] != lost['lease']
+    assert not coordinator.heartbeat(lost['lease'])
+    assert not coordinator.finish(lost['lease'], {}, None)
+    assert coordinator.heartbeat(job['lease'])
+
+
+def test_workers(make_game: GameFactory, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(farm, '_POLL', 0.05)
+    a = make_game(name='A').absolute()
+    b = make_game(name='B').absolute()
+    a_id = util.get_appid(load_description(a.as_posix()))
+    coordinator = farm.Coordinator({'force': True}, heartbeat_timeout=0.4, retries=1)
+    coordinator.add(farm.Job(a.as_posix(), 'runtime', 10, None, runtime=True))
+    coordinator.add(farm.Job(a.as_posix(), a_id, 5, None, requires='runtime'))
+    coordinator.add(farm.Job(b.as_posix(), util.get_appid(load_description(b.as_posix())), 1, None))
+
+    built: typing.List[typing.Tuple[str, str]] = []
+    lock = threading.Lock()
+
+    def builder(args: farm.BaseArguments, description: Description, previous: typing.Optional[str],
+                runtime: bool) -> typing.Dict[str, str]:
+        assert typing.cast('typing.Any', args).force
+        name = 'runtime' if runtime else util.get_appid(description)
+        repo = util.staging_repo(name)
+        (repo / 'objects').mkdir(parents=True)
+        (repo / 'objects' / 'commit').write_text(name)
+        with lock:
+            built.append((threading.current_thread().name, name))
+        return {name: f'{name}-fingerprint'}
+
+    results: typing.Dict[str, bool] = {}
+
+    def work(name: str) -> None:
+        # Each worker keeps its staging repos, as they are where the
+        # coordinator extracts the uploads to
+        args = typing.cast('farm.BaseArguments', types.SimpleNamespace(cleanup=False))
+        results[name] = farm.Worker(args, url, name, builder).run()
+
+    with coordinator.serve('127.0.0.1', 0) as (host, port):
+        url = f'http://{host}:{port}'
+        # A worker that takes the runtime and dies, which is noticed when it
+        # stops sending heartbeats
+        request = urllib.request.Request(f'{url}/next', data=json.dumps({'worker': 'dead'}).encode())
+        with urllib.request.urlopen(request, timeout=5) as r:
+            assert json.load(r)['appid'] == 'runtime'
+
+        workers = [threading.Thread(target=work, args=(n,), name=n) for n in ['w1', 'w2']]
+        for w in workers:
+            w.start()
+        coordinator.wait()
+    for w in workers:
+        w.join()
+
+    assert results == {'w1': True, 'w2': True}
+    assert coordinator.failed == []
+    assert sorted(coordinator.built) == sorted([a.as_posix(), b.as_posix()])
+    names = [n for _, n in built]
+    assert sorted(names) == sorted(coordinator.staged)
+    assert names.index('runtime') < names.index(a_id)
+    assert coordinator.staged == {n: f'{n}-fingerprint' for n in names}
+    # The uploads replace the staging repos they were built in
+    for name in names:
+        assert (util.staging_repo(name) / 'objects' / 'commit').read_text() == name
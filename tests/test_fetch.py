@@ -0,0 +1,111 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import hashlib
+import http.server
+import threading
+import time
+import typing
+
+import pytest
+
+from flatpaker import fetch
+
+if typing.TYPE_CHECKING:
+    from flatpaker.description import Description
+
+
+class _Server(http.server.ThreadingHTTPServer):
+
+    """Serve files from memory, slowly, counting how many are sent at once."""
+
+    def __init__(self, files: typing.Dict[str, bytes], delay: float = 0.0):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.files = files
+        self.delay = delay
+        self.requests: typing.List[str] = []
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    def url(self, name: str) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/{name}'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    server: _Server
+
+    def do_GET(self) -> None:
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            self.server.active += 1
+            self.server.most_active = max(self.server.most_active, self.server.active)
+        try:
+            time.sleep(self.server.delay)
+            data = self.server.files[self.path.lstrip('/')]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def log_message(self, *args: typing.Any) -> None:
+        pass
+
+
+@pytest.fixture
+def server() -> typing.Iterator[_Server]:
+    s = _Server({f'{i}.zip': f'game {i}'.encode() for i in range(6)})
+    thread = threading.Thread(target=s.serve_forever, args=(0.05,))
+    thread.start()
+    yield s
+    s.shutdown()
+    s.server_close()
+    thread.join()
+
+
+def _description(*urls: typing.Tuple[str, bytes]) -> Description:
+    archives = []
+    for url, data in urls:
+        sha256 = hashlib.sha256(data).hexdigest()
+        archives.append({'url': url, 'sha256': sha256, 'path': fetch.mirror_path(url, sha256)})
+    return typing.cast('Description', {'sources': {'archives': archives}})
+
+
+def test_fetch_over_http(server: _Server) -> None:
+    description = _description((server.url('0.zip'), b'game 0'))
+    # Sources shared by several descriptions are only downloaded once
+    fetch.fetch([description, description])
+
+    assert description['sources']['archives'][0]['path'].read_bytes() == b'game 0'
+    assert server.requests == ['/0.zip']
+    assert not fetch.missing(description)
+
+
+def test_fetch_limits_concurrent_downloads(server: _Server) -> None:
+    server.delay = 0.2
+    description = _description(*((server.url(f'{i}.zip'), f'game {i}'.encode()) for i in range(6)))
+    fetch.fetch([description], jobs=2)
+
+    assert len(server.requests) == 6
+    assert server.most_active == 2
+
+
+def test_fetch_bad_digest(server: _Server) -> None:
+    description = _description((server.url('0.zip'), b'something else'))
+    with pytest.raises(ValueError, match='0.zip'):
+        fetch.fetch([description])
+    assert not any(description['sources']['archives'][0]['path'].parent.iterdir())
+
+
+def test_fetch_stalled_server(server: _Server, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(fetch, '_TIMEOUT', 0.1)
+    server.delay = 0.5
+    description = _description((server.url('0.zip'), b'game 0'))
+    with pytest.raises(ValueError, match='0.zip.*timed out'):
+        fetch.fetch([description])
+    assert not description['sources']['archives'][0]['path'].exists()
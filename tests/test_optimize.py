@@ -0,0 +1,68 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import pathlib
+import pickle
+import shutil
+import typing
+import zlib
+
+from flatpaker import optimize
+
+
+def _read_rpa(path: pathlib.Path) -> typing.Dict[str, bytes]:
+    """Read every file in an RPA-3.0 archive."""
+    with path.open('rb') as f:
+        header = f.readline().split()
+        offset, key = int(header[1], 16), int(header[2], 16)
+        f.seek(offset)
+        index = pickle.loads(zlib.decompress(f.read()))
+        files: typing.Dict[str, bytes] = {}
+        for name, [(start, length, prefix)] in index.items():
+            f.seek(start ^ key)
+            files[name] = prefix + f.read((length ^ key) - len(prefix))
+    return files
+
+
+def _load(game: pathlib.Path, name: str) -> bytes:
+    """Load a file the way Ren'Py does, loose files first, then archives in
+    reverse sorted order of their names."""
+    loose = game / name
+    if loose.exists():
+        return loose.read_bytes()
+    for archive in sorted((p for p in game.iterdir() if p.suffix == '.rpa'), key=lambda p: p.stem, reverse=True):
+        files = _read_rpa(archive)
+        if name in files:
+            return files[name]
+    raise FileNotFoundError(name)
+
+
+def _make_rpa(path: pathlib.Path, files: typing.Dict[str, bytes], tmp: pathlib.Path) -> None:
+    tmp.mkdir()
+    for name, data in files.items():
+        (tmp / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp / name).write_bytes(data)
+    name = optimize.rpa_name(tmp.as_posix())
+    optimize.repack(tmp.as_posix())
+    shutil.move(tmp / name, path)
+
+
+def test_repack_keeps_loose_files_overriding_archives(tmp_path: pathlib.Path) -> None:
+    game = tmp_path / 'game'
+    game.mkdir()
+    for archive in ['archive', 'images', 'scripts']:
+        _make_rpa(game / f'{archive}.rpa', {'bg.png': archive.encode(), f'{archive}.ogg': b'only'},
+                  tmp_path / archive)
+    (game / 'bg.png').write_bytes(b'loose')
+
+    before = {n: _load(game, n) for n in ['bg.png', 'archive.ogg', 'images.ogg', 'scripts.ogg']}
+    assert before['bg.png'] == b'loose'
+
+    assert optimize.repack(game.as_posix()) == 1
+    assert not (game / 'bg.png').exists()
+    assert {n: _load(game, n) for n in before} == before
+
+
+def test_repack_name_without_archives(tmp_path: pathlib.Path) -> None:
+    assert optimize.rpa_name(tmp_path.as_posix()) == 'flatpaker.rpa'
@@ -0,0 +1,55 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import hashlib
+import pathlib
+import typing
+
+from flatpaker import api, entry, util
+from flatpaker.impl import renpy
+
+if typing.TYPE_CHECKING:
+    from conftest import GameFactory, RuntimePinner
+
+
+def test_compile_cache_is_not_a_game_source(make_game: GameFactory, tmp_path: pathlib.Path) -> None:
+    description = api.load_description(make_game().as_posix())
+    appid = util.get_appid(description)
+    renpy.compile_cache(appid).mkdir(parents=True)
+
+    modules = api.generate(description).manifest['modules']
+    names = [m['name'] for m in modules]
+    game = modules[names.index(util.sanitize_name(description['common']['name']))]
+    compile_ = modules[names.index(renpy.COMPILE_MODULE)]
+
+    assert names.index(renpy.COMPILE_MODULE) > names.index(game['name'])
+    assert not any(s['type'] == 'dir' for s in game['sources'])
+    assert compile_['sources'] == [
+        {'type': 'dir', 'path': renpy.compile_cache(appid).as_posix(), 'dest': '.flatpaker-compile-cache'}]
+
+    # The compiled files are taken from the compile module's build directory
+    harvested = tmp_path / 'build' / f'{renpy.COMPILE_MODULE}-1' / '.flatpaker-harvest'
+    (harvested / 'engine').mkdir(parents=True)
+    (harvested / 'engine' / 'script.rpyc').write_bytes(b'compiled')
+    renpy.harvest(description, appid, tmp_path / 'build')
+    assert (renpy.compile_cache(appid) / 'engine' / 'script.rpyc').read_bytes() == b'compiled'
+
+
+def test_shared_runtime(make_game: GameFactory, pin_runtime: RuntimePinner, tmp_path: pathlib.Path) -> None:
+    description = api.load_description(make_game().as_posix())
+    # Without a runtime for its version, the game ships the engine
+    assert api.generate(description, shared_runtime=True).manifest['runtime'] == 'org.freedesktop.Platform'
+
+    sdk = tmp_path / 'renpy-8.3.4-sdk.tar.bz2'
+    sdk.write_bytes(b'sdk')
+    pin_runtime('renpy', '8.3.4', sdk)
+    manifest = api.generate(description, shared_runtime=True).manifest
+    assert (manifest['runtime'], manifest['runtime-version']) == (renpy.RUNTIME_ID, '8.3.4')
+    assert manifest['sdk'].endswith(('//master', f'//{util.RUNTIME_VERSION}'))
+
+    # The runtime is built from the pinned SDK, not from the game
+    runtime = renpy.runtime_manifest(entry.runtime_source('renpy', '8.3.4'), '8.3.4')
+    assert (runtime['id-platform'], runtime['branch'], runtime['build-runtime']) == (renpy.RUNTIME_ID, '8.3.4', True)
+    assert runtime['modules'][0]['sources'] == [
+        {'url': sdk.as_uri(), 'sha256': hashlib.sha256(b'sdk').hexdigest(), 'type': 'archive', 'strip-components': 1}]
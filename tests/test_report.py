@@ -0,0 +1,35 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import pathlib
+
+import pytest
+
+from flatpaker import report, util
+
+
+@pytest.fixture(autouse=True)
+def _report(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(report, '_TITLES', None)
+    report.enable()
+
+
+def test_repo_delta_from_export_output() -> None:
+    command = ['sh', '-c', 'echo "Content Total: 3"; echo "Content Bytes Written: 1234 (1.2 kB)"']
+    report.run('a', 'flatpak-builder:export', command, exports=True)
+    report.run('b', 'flatpak-builder:export', command)
+
+    assert report._title('a')['repo_delta_size'] == 1234
+    assert 'repo_delta_size' not in report._title('b')
+
+
+def test_new_objects_size(tmp_path: pathlib.Path) -> None:
+    for repo, objects in [('staging', {'aa/1.filez': 10, 'aa/2.filez': 20, 'bb/3.commit': 5}),
+                          ('repo', {'aa/1.filez': 10})]:
+        for name, size in objects.items():
+            (tmp_path / repo / 'objects' / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / repo / 'objects' / name).write_bytes(b'x' * size)
+
+    assert util._new_objects_size(tmp_path / 'staging', tmp_path / 'repo') == 25
+    assert util._new_objects_size(tmp_path / 'staging', tmp_path / 'missing') == 35
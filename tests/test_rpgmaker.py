@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import io
+import pathlib
+import tarfile
+import typing
+
+from flatpaker import api, entry, util
+from flatpaker.impl import rpgmaker
+
+if typing.TYPE_CHECKING:
+    from conftest import GameFactory, RuntimePinner
+    from flatpaker.description import Description
+
+
+def _game(make_game: GameFactory, **kwargs: typing.Any) -> Description:
+    return api.load_description(make_game('rpgmaker', **kwargs).as_posix())
+
+
+def _commands(manifest: typing.Dict[str, typing.Any]) -> typing.List[str]:
+    return [c for m in manifest['modules'] for c in m.get('build-commands', [])]
+
+
+def _nwjs(path: pathlib.Path, nw: bytes = b'') -> pathlib.Path:
+    """Write a release of nw.js, with the same files as the games have."""
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, data in [('nw', nw), ('lib/libnw.so', b''), ('locales/en-US.pak', b''),
+                           ('locales/de.pak', b''), ('resources.pak', b'')]:
+            info = tarfile.TarInfo(f'{path.name[:-len(".tar.gz")]}/{name}')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def test_shared_runtime_has_the_same_nwjs(
+        make_game: GameFactory, pin_runtime: RuntimePinner, tmp_path: pathlib.Path) -> None:
+    description = _game(make_game)
+    pin_runtime('rpgmaker', '0.29.3', _nwjs(tmp_path / 'nwjs-v0.29.3-linux-x64.tar.gz', nw=b'other'))
+    # The game keeps its own nw.js unless a runtime has the same one
+    manifest = api.generate(description, shared_runtime=True).manifest
+    assert manifest['runtime'] == 'org.freedesktop.Platform'
+    assert not any(c.startswith('rm -rf') for c in _commands(manifest))
+
+    pin_runtime('rpgmaker', '0.29.4', _nwjs(tmp_path / 'nwjs-v0.29.4-linux-x64.tar.gz'))
+    manifest = api.generate(description, shared_runtime=True).manifest
+    assert (manifest['runtime'], manifest['runtime-version']) == (rpgmaker.RUNTIME_ID, '0.29.4')
+    assert 'rm -rf lib locales nw resources.pak' in _commands(manifest)
+    assert f"echo  'exec {rpgmaker.RUNTIME_DIR}/nw /app/lib/game' > /app/bin/game.sh" in _commands(manifest)
+
+
+def test_shared_runtime_prunes_locales(
+        make_game: GameFactory, pin_runtime: RuntimePinner, tmp_path: pathlib.Path) -> None:
+    description = _game(make_game)
+    pin_runtime('rpgmaker', '0.29.4', _nwjs(tmp_path / 'nwjs-v0.29.4-linux-x64.tar.gz'))
+    found = entry.shared_runtime(description)
+    assert found is not None
+    impl, version = found
+    source = entry.runtime_source('rpgmaker', version)
+    assert impl.runtime_manifest(source, version)['modules'][0]['build-commands'][:2] == [
+        f'mkdir -p {rpgmaker.RUNTIME_DIR}', f'mv lib locales nw resources.pak {rpgmaker.RUNTIME_DIR}/']
+
+    assert not any('en-US' in c for c in _commands(impl.runtime_manifest(source, version)))
+    assert any('en-US' in c for c in _commands(impl.runtime_manifest(source, version, 'lossless')))
+
+
+def test_unused_assets_dont_grow_the_manifest(tmp_path: pathlib.Path, make_game: GameFactory) -> None:
+    manifests = []
+    # In directories with names of the same length, as the paths are in the manifests
+    for name, pictures in [('few', 1), ('all', 500)]:
+        description = _game(make_game, directory=tmp_path / name, pictures=pictures)
+        manifests.append(api.generate(description, optimize='repack').manifest)
+    few, many = manifests
+
+    assert len(util.dump_json(few)) == len(util.dump_json(many))
+    assert len(_commands(few)) == len(_commands(many))
+
+    [module] = [m for m in many['modules'] if m['name'] == 'unused_assets']
+    unused = pathlib.Path(module['sources'][0]['path']).read_bytes().split(b'\0')[:-1]
+    assert len(unused) == 500
+    assert b'/app/lib/game/www/img/pictures/Unused0.png' in unused
+    assert not any(b'Title' in u for u in unused)
@@ -0,0 +1,40 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import fcntl
+import pathlib
+import tempfile
+
+import pytest
+
+from flatpaker import util
+
+
+def test_evict_skips_locked_state_dirs(tmp_path: pathlib.Path) -> None:
+    for appid in ['a', 'b']:
+        (tmp_path / appid).mkdir()
+        (tmp_path / appid / 'data').write_bytes(b'x' * 64 * 1024)
+
+    # As another worker sharing the state dir would
+    with open(tmp_path / 'a.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        assert util.evict_state_dirs(tmp_path, 0) == ['b']
+
+    assert (tmp_path / 'a').is_dir()
+    assert not (tmp_path / 'b').exists()
+
+
+def test_tmpdir_keeps_one_per_name(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(tempfile, 'tempdir', tmp_path.as_posix())
+    # A name that starts with the same name is left alone
+    with util.tmpdir('com.example.Game-2', cleanup=False, key='one') as other:
+        pass
+    for key in ['one', 'two', 'three']:
+        with util.tmpdir('com.example.Game', cleanup=False, key=key) as d:
+            (d / 'manifest.json').write_text(key)
+
+    assert sorted(p.name for p in (tmp_path / 'flatpaker').iterdir()) == sorted([
+        d.name, 'com.example.Game.lock', other.name, 'com.example.Game-2.lock',
+    ])
+    assert (d / 'manifest.json').read_text() == 'three'
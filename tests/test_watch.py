@@ -0,0 +1,29 @@
+# SPDX-License-Identifier: MIT
+# Copyright © 2024 Dylan Baker
+
+from __future__ import annotations
+import types
+import typing
+
+from flatpaker import watch
+
+if typing.TYPE_CHECKING:
+    from conftest import GameFactory
+    from flatpaker.description import Description
+
+
+def test_build_fetches_url_sources(make_game: GameFactory) -> None:
+    toml = make_game(url=True)
+    fetched: typing.List[bool] = []
+
+    def builder(args: object, description: Description, lock: object) -> bool:
+        fetched.append(description['sources']['archives'][0]['path'].exists())
+        return True
+
+    watcher = watch.Watcher(typing.cast('watch.BaseArguments', types.SimpleNamespace()), toml.parent, builder)
+    try:
+        watcher._build(toml.resolve())
+    finally:
+        watcher.executor.shutdown()
+        watcher.inotify.close()
+    assert fetched == [True]